@@ -0,0 +1,106 @@
+"""
+AI responder backends, picked by name and loaded on first use
+
+Each backend has a loader that takes the ChatServer and returns a
+responder (see AIWorkerPool for the protocol). The server wraps every
+backend it runs in a LazyResponder, so nothing is imported or set up
+until a room first asks that backend something. Importing the openai
+package takes about a second, which a server with AI off, or one only
+running offline backends, never pays.
+
+  openai  ChatGPT through the openai package (needs OPENAI_API_KEY)
+  echo    offline rules: greetings, the time, help, otherwise an echo
+  stub    canned reply after a fixed latency, for tests and load tests
+
+Offline backends cost nothing to keep around, so every server runs them
+for rooms that ask for them. register() adds another backend.
+"""
+
+import importlib.util
+import threading
+import time
+from datetime import datetime
+from ai_workers import StubResponder
+from event_log import log
+
+BACKENDS = {}   # name -> (loader, offline)
+
+
+def register(name, loader, offline=False):
+    """Make `loader(server) -> responder` available as backend `name`"""
+    BACKENDS[name] = (loader, offline)
+
+
+def backend_names():
+    return sorted(BACKENDS)
+
+
+def offline_backends():
+    return [name for name, (_, offline) in BACKENDS.items() if offline]
+
+
+def is_installed(module):
+    """Whether `module` can be imported, without importing it"""
+    return importlib.util.find_spec(module) is not None
+
+
+class LazyResponder:
+    """Calls through to the backend's responder, loading it on the first call"""
+
+    def __init__(self, name, server):
+        self.name = name
+        self.server = server
+        self.responder = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        """The backend's responder, loading it once for every thread that asks"""
+        responder = self.responder
+        if responder is not None:
+            return responder
+        with self.lock:
+            if self.responder is None:
+                started = time.perf_counter()
+                try:
+                    self.responder = BACKENDS[self.name][0](self.server)
+                except Exception as e:
+                    log.error('ai_backend_failed', "Could not load AI backend %s: %s", self.name, e)
+                    raise
+                log.info('ai_backend_loaded', "Loaded AI backend %s in %.0f ms", self.name,
+                         (time.perf_counter() - started) * 1000, backend=self.name)
+            return self.responder
+
+    @property
+    def loaded(self):
+        return self.responder is not None
+
+    def __call__(self, prompt, username, timeout=None, **options):
+        return self.load()(prompt, username, timeout, **options)
+
+
+class EchoResponder:
+    """Offline replies from a few fixed rules, instantly"""
+
+    def __call__(self, prompt, username, timeout=None, on_delta=None, conversation=None):
+        text = ' '.join(prompt.casefold().split())
+        words = set(text.strip('!?.').split())
+        if words & {'hi', 'hello', 'hey'}:
+            reply = f"Hello {username}! 👋"
+        elif 'time' in words:
+            reply = f"It's {datetime.now().strftime('%H:%M')} here on the server. 🕒"
+        elif 'help' in words:
+            reply = "I'm the offline echo bot: say hi, ask me the time, or I'll repeat what you said. 🦜"
+        else:
+            reply = f"{username} said: {prompt}"
+        if on_delta is not None:
+            on_delta(reply)
+        return reply
+
+
+def load_openai(server):
+    return server.load_chatgpt()
+
+
+register('openai', load_openai)
+register('echo', lambda server: EchoResponder(), offline=True)
+register('stub', lambda server: StubResponder(latency=server.ai_stub_latency), offline=True)
@@ -0,0 +1,280 @@
+"""
+Bounded worker pool for AI replies
+
+Chat handlers submit a job and return immediately; a fixed number of
+worker threads call the responder and hand the reply to the job's callback.
+The queue has a hard depth limit so a slow upstream API turns into fast
+rejections instead of unbounded memory growth, and every job carries a
+deadline so stale prompts are answered with a timeout rather than late.
+
+Jobs submitted with an `on_chunk` callback are streamed: the responder
+is handed an `on_delta` callback and calls it with each piece of text as
+it arrives, and the pool passes every piece on to `on_chunk(job, text)`.
+StreamBuffer batches those pieces so they go out at a steady cadence.
+
+Jobs submitted with a `conversation` key hand it to the responder, which
+may use it to include earlier turns of that conversation in the prompt.
+
+Jobs submitted with a `key` (user and room) wait `coalesce_window`
+seconds before they are queued; further prompts for the same key in that
+time are appended to the waiting job, so a burst of short lines becomes
+one AI request. An optional RateLimiter refuses new requests outright.
+"""
+
+import queue
+import threading
+import time
+from event_log import log
+
+# submit() results
+QUEUED = 'queued'
+COALESCED = 'coalesced'     # merged into a job still waiting for its window to end
+THROTTLED = 'throttled'     # refused by the rate limiter
+REJECTED = 'rejected'       # the queue was full
+
+
+class AIQueueFull(Exception):
+    """A coalesced job's window ended while the queue was full"""
+
+
+class AIJob:
+    """A single prompt waiting for an AI reply"""
+
+    __slots__ = ('prompt', 'username', 'on_done', 'context', 'responder', 'on_chunk', 'stream',
+                 'conversation', 'submitted_at', 'deadline')
+
+    def __init__(self, prompt, username, on_done, timeout, context=None, responder=None, on_chunk=None,
+                 conversation=None):
+        self.prompt = prompt
+        self.username = username
+        self.on_done = on_done
+        self.context = context      # opaque caller data handed back with the job
+        self.responder = responder  # overrides the pool's responder, e.g. per chat room
+        self.on_chunk = on_chunk    # streams the reply when set
+        self.stream = None          # state of a streamed reply, kept by the on_chunk callback
+        self.conversation = conversation
+        self.submitted_at = time.time()
+        self.deadline = self.submitted_at + timeout
+
+
+class AIWorkerPool:
+    """Serve AI jobs from a bounded queue with a fixed number of threads
+
+    `responder(prompt, username, timeout, on_delta=None, conversation=None)`
+    must return the reply text. It should give up after `timeout` seconds,
+    raising TimeoutError. If it can stream, it calls `on_delta(text)` (when
+    given) with each new piece of the reply before returning all of it;
+    `conversation` is only passed for jobs submitted with one. Each job's
+    `on_done(job, reply, error)` callback runs on a worker thread: on success
+    `error` is None, otherwise `reply` is None and `error` is the exception.
+    """
+
+    def __init__(self, responder, workers=4, max_queue=100, job_timeout=30.0, coalesce_window=0.0, limiter=None):
+        self.responder = responder
+        self.workers = workers
+        self.job_timeout = job_timeout
+        self.jobs = queue.Queue(maxsize=max_queue)
+        self.threads = []
+        self.running = False
+
+        # Jobs still collecting prompts, in the order their windows end
+        self.coalesce_window = coalesce_window
+        self.limiter = limiter
+        self.pending = {}   # key -> (monotonic time due, AIJob)
+        self.pending_lock = threading.Condition()
+
+        self.stats_lock = threading.Lock()
+        self.stats = {'submitted': 0, 'rejected': 0, 'completed': 0, 'timed_out': 0, 'failed': 0,
+                      'coalesced': 0, 'throttled': 0}
+
+    def start(self):
+        """Start the worker threads"""
+        if self.running:
+            return
+        self.running = True
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f"ai-worker-{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        if self.coalesce_window > 0:
+            thread = threading.Thread(target=self._coalescer, name="ai-coalescer", daemon=True)
+            thread.start()
+
+    def stop(self):
+        """Stop the workers; jobs still queued or collecting prompts are discarded"""
+        if not self.running:
+            return
+        self.running = False
+        with self.pending_lock:
+            self.pending.clear()
+            self.pending_lock.notify_all()
+        for _ in self.threads:
+            try:
+                self.jobs.put_nowait(None)
+            except queue.Full:
+                break
+        self.threads = []
+
+    def submit(self, prompt, username, on_done, context=None, responder=None, key=None, on_chunk=None,
+               conversation=None):
+        """Queue a prompt; returns QUEUED, COALESCED, THROTTLED or REJECTED
+
+        A prompt merged into a waiting job replaces that job's context.
+        """
+        coalesce = key is not None and self.coalesce_window > 0
+        with self.pending_lock:
+            if coalesce and key in self.pending:
+                job = self.pending[key][1]
+                job.prompt += '\n' + prompt
+                job.context = context
+                self._count('coalesced')
+                return COALESCED
+            if self.limiter is not None and self.limiter.acquire(username) is not None:
+                self._count('throttled')
+                return THROTTLED
+            job = AIJob(prompt, username, on_done, self.job_timeout, context, responder, on_chunk, conversation)
+            if coalesce:
+                self.pending[key] = (time.monotonic() + self.coalesce_window, job)
+                self.pending_lock.notify()
+                self._count('submitted')
+                return QUEUED
+        try:
+            self.jobs.put_nowait(job)
+        except queue.Full:
+            self._count('rejected')
+            return REJECTED
+        self._count('submitted')
+        return QUEUED
+
+    def queue_depth(self):
+        return self.jobs.qsize()
+
+    def get_stats(self):
+        with self.stats_lock:
+            stats = dict(self.stats)
+        stats['queue_depth'] = self.queue_depth()
+        return stats
+
+    def _count(self, key):
+        with self.stats_lock:
+            self.stats[key] += 1
+
+    def _coalescer(self):
+        """Queue each waiting job once its window has passed"""
+        while self.running:
+            with self.pending_lock:
+                now = time.monotonic()
+                due = []
+                for key, (at, job) in self.pending.items():
+                    if at > now:
+                        break
+                    due.append(key)
+                jobs = [self.pending.pop(key)[1] for key in due]
+                if not jobs:
+                    first = next(iter(self.pending.values()), None)
+                    self.pending_lock.wait(None if first is None else first[0] - now)
+                    continue
+            for job in jobs:
+                try:
+                    self.jobs.put_nowait(job)
+                except queue.Full:
+                    self._count('rejected')
+                    self._finish(job, None, AIQueueFull("AI queue full"))
+
+    def _worker(self):
+        while self.running:
+            job = self.jobs.get()
+            if job is None:
+                break
+
+            remaining = job.deadline - time.time()
+            if remaining <= 0:
+                self._count('timed_out')
+                self._finish(job, None, TimeoutError("AI job expired while queued"))
+                continue
+
+            try:
+                responder = job.responder or self.responder
+                options = {}
+                if job.on_chunk is not None:
+                    options['on_delta'] = lambda text, job=job: self._chunk(job, text)
+                if job.conversation is not None:
+                    options['conversation'] = job.conversation
+                reply = responder(job.prompt, job.username, remaining, **options)
+            except TimeoutError as e:
+                self._count('timed_out')
+                self._finish(job, None, e)
+            except Exception as e:
+                self._count('failed')
+                self._finish(job, None, e)
+            else:
+                self._count('completed')
+                self._finish(job, reply, None)
+
+    def _chunk(self, job, text):
+        try:
+            job.on_chunk(job, text)
+        except Exception as e:
+            log.error('ai_delivery_error', "Error delivering AI reply chunk to %s: %s", job.username, e)
+
+    def _finish(self, job, reply, error):
+        try:
+            job.on_done(job, reply, error)
+        except Exception as e:
+            log.error('ai_delivery_error', "Error delivering AI reply to %s: %s", job.username, e)
+
+
+class StubResponder:
+    """Offline stand-in for ChatGPT with configurable artificial latency"""
+
+    def __init__(self, latency=0.5):
+        self.latency = latency
+
+    def __call__(self, prompt, username, timeout=None, on_delta=None, conversation=None):
+        if timeout is not None and self.latency > timeout:
+            time.sleep(timeout)
+            raise TimeoutError(f"Stub responder latency {self.latency}s exceeds {timeout:.2f}s timeout")
+        reply = f"Hi {username}! 🤖 You said: {prompt}"
+        if on_delta is None:
+            time.sleep(self.latency)
+            return reply
+        # Streamed word by word over the same total latency
+        words = reply.split(' ')
+        for i, word in enumerate(words):
+            time.sleep(self.latency / len(words))
+            on_delta(word if i == 0 else ' ' + word)
+        return reply
+
+
+class StreamBuffer:
+    """Collects streamed reply text and releases it at most every `interval` seconds
+
+    The first piece is released at once, so the first words show up as
+    soon as they exist; later pieces are held until the interval since the
+    previous release has passed. Whatever is still held at the end goes
+    out with the complete reply.
+    """
+
+    __slots__ = ('reply_id', 'interval', 'pending', 'last_flush', 'chunks', 'first_at')
+
+    def __init__(self, reply_id, interval):
+        self.reply_id = reply_id
+        self.interval = interval
+        self.pending = []
+        self.last_flush = None
+        self.chunks = 0         # pieces released so far
+        self.first_at = None    # time.time() of the first release
+
+    def add(self, text, now=None):
+        """Take a piece of text; returns the text to send now, or None to keep holding it"""
+        now = time.monotonic() if now is None else now
+        self.pending.append(text)
+        if self.last_flush is not None and now - self.last_flush < self.interval:
+            return None
+        if self.first_at is None:
+            self.first_at = time.time()
+        self.last_flush = now
+        self.chunks += 1
+        text = ''.join(self.pending)
+        self.pending = []
+        return text
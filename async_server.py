@@ -0,0 +1,126 @@
+"""
+asyncio engine for the WhatsApp-like chat server
+
+AsyncChatServer serves every connection from a single event loop using
+StreamReader/StreamWriter instead of one OS thread per socket. Message
+dispatch (process_message and the join/chat/clock_sync/leave handlers) is
+inherited unchanged from ChatServer; only accepting, reading and writing
+differ. Message log reads for history pages run in the default executor,
+so a long replay doesn't hold up the loop.
+"""
+
+import asyncio
+import time
+from event_log import log
+from outbound import AsyncOutbox
+from protocol import FrameDecoder, FrameError, RECV_BUFFER_SIZE, decode_message
+from server import ChatServer
+
+
+class AsyncChatServer(ChatServer):
+    """ChatServer variant that multiplexes all clients on one event loop"""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.loop = None
+        self.server = None
+
+    def start_server(self):
+        """Start the chat server and block until it stops"""
+        try:
+            asyncio.run(self.serve())
+        except Exception as e:
+            log.error('server_error', "Server error: %s", e)
+        finally:
+            self.cleanup()
+
+    async def serve(self):
+        """Listen for connections and serve them until stopped"""
+        self.loop = asyncio.get_running_loop()
+        self.server = await asyncio.start_server(
+            self.handle_client,
+            self.host,
+            self.port,
+            backlog=self.backlog,
+            reuse_address=True,
+            reuse_port=self.reuse_port or None
+        )
+        self.running = True
+        self.start_services()
+        self.print_banner('asyncio')
+
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def handle_client(self, reader, writer):
+        """Handle individual client connection"""
+        addr = writer.get_extra_info('peername')
+        self.outboxes[writer] = self.create_outbox(writer)
+        decoder = FrameDecoder()
+        reason = 'closed'
+
+        try:
+            while self.running:
+                data = await reader.read(RECV_BUFFER_SIZE)
+                if not data:
+                    break
+                received_at = time.time()
+                self.bytes_in.inc(amount=len(data))
+
+                for payload in decoder.feed(data):
+                    try:
+                        message = decode_message(payload)
+                    except ValueError:
+                        log.warning('invalid_message', "Invalid JSON from %s", addr)
+                        continue
+                    if message.get('type') == 'clock_sync':
+                        message['server_receive_time'] = received_at
+                    self.process_message(writer, addr, message)
+                    if writer not in self.outboxes:
+                        return  # removed while handling the message, e.g. after a leave
+
+                # read() does not yield while data is buffered; let the
+                # outbox writer tasks run so a flooding client can't starve them
+                await asyncio.sleep(0)
+
+        except FrameError as e:
+            log.warning('frame_error', "Dropping client %s: %s", addr, e)
+            reason = 'frame_error'
+        except ConnectionResetError:
+            log.info('connection_reset', "Client %s disconnected unexpectedly", addr)
+            reason = 'reset'
+        except Exception as e:
+            if writer in self.outboxes:
+                log.error('client_error', "Error handling client %s: %s", addr, e)
+                reason = 'error'
+        finally:
+            self.remove_client(writer, addr, reason)
+
+    def create_outbox(self, conn):
+        outbox = AsyncOutbox(conn, max_depth=self.outbound_queue_size, policy=self.slow_consumer_policy)
+        outbox.start()
+        return outbox
+
+    def close_connection(self, conn):
+        conn.close()
+
+    def call_in_io_thread(self, callback, *args):
+        """StreamWriters may only be touched from the event loop thread"""
+        if self.loop is not None and self.loop.is_running():
+            self.loop.call_soon_threadsafe(callback, *args)
+
+    def call_off_io_thread(self, func, callback, *args):
+        """Run func(*args) in the default executor so disk reads don't stall every connection"""
+        def run():
+            try:
+                result = func(*args)
+            except Exception as e:
+                log.error('io_task_failed', "Error in %s: %s", getattr(func, '__name__', func), e)
+                return
+            self.call_in_io_thread(callback, result)
+        self.loop.run_in_executor(None, run)
+
+    def cleanup(self):
+        if self.server:
+            self.server.close()
+        super().cleanup()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Benchmark: ChatGPT calls and reply latency with and without the reply cache
+
+Drives ChatServer.get_chatgpt_response from several AI worker threads with
+a fake ChatGPT client that takes --latency seconds per call. A share of
+the prompts (--repeat-share) are common greetings written in varying
+case and punctuation, like real chat traffic; the rest are unique. Run
+once with the cache disabled and once with it enabled.
+
+Usage:
+    python benchmarks/bench_ai_cache.py --requests 2000 --workers 8 --latency 0.05
+"""
+
+import argparse
+import contextlib
+import os
+import random
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from server import ChatServer
+
+GREETINGS = ['hi', 'Hi!', 'hello', 'Hello.', 'hey', 'HEY', 'thanks', 'Thanks!', 'good morning',
+             'Good morning!', 'how are you?', 'How are you?', 'bye', 'ok', 'lol']
+
+
+class FakeChatGPT:
+    """Mimics openai.OpenAI().chat.completions: sleeps, then greets the user by name"""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = 0
+        self.lock = threading.Lock()
+        self.chat = self
+        self.completions = self
+
+    def create(self, model, messages, max_tokens, temperature, timeout=None, stream=False):
+        with self.lock:
+            self.calls += 1
+        time.sleep(self.latency)
+        system = messages[0]['content']
+        username = system.split("The user's name is ")[1].split('.')[0]
+        reply = f"Hey {username}! 😊 About \"{messages[-1]['content']}\": happy to help."
+
+        class Response:
+            pass
+        response, choice = Response(), Response()
+        choice.message = Response()
+        choice.message.content = reply
+        response.choices = [choice]
+        return response
+
+
+def make_prompts(count, repeat_share, seed=1):
+    rng = random.Random(seed)
+    return [(f"user{rng.randrange(200)}",
+             rng.choice(GREETINGS) if rng.random() < repeat_share else f"question number {i} about {rng.random()}")
+            for i in range(count)]
+
+
+def run(prompts, workers, latency, cache_size):
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        server = ChatServer(ai_backend='openai', history_dir=None, ai_cache_size=cache_size)
+    server.openai_client = FakeChatGPT(latency)
+    pending = list(prompts)
+    latencies = []
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                if not pending:
+                    return
+                username, prompt = pending.pop()
+            started = time.perf_counter()
+            reply = server.get_chatgpt_response(prompt, username, timeout=10)
+            assert username in reply, reply
+            with lock:
+                latencies.append(time.perf_counter() - started)
+
+    threads = [threading.Thread(target=worker) for _ in range(workers)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    stats = server.ai_cache.get_stats() if server.ai_cache is not None else {}
+    return {
+        'calls': server.openai_client.calls,
+        'mean': sum(latencies) / len(latencies),
+        'p99': latencies[int(len(latencies) * 0.99)],
+        'elapsed': elapsed,
+        'hits': stats.get('hits', 0),
+        'coalesced': stats.get('coalesced', 0)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ChatGPT calls and latency with and without the reply cache")
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--workers', type=int, default=8, help="Concurrent AI worker threads")
+    parser.add_argument('--latency', type=float, default=0.05, help="Seconds per fake ChatGPT call")
+    parser.add_argument('--repeat-share', type=float, default=0.4, help="Share of prompts that are greetings")
+    parser.add_argument('--cache-size', type=int, default=1000)
+    args = parser.parse_args()
+
+    prompts = make_prompts(args.requests, args.repeat_share)
+    print(f"{'cache':>5} {'API calls':>10} {'hits':>6} {'coalesced':>10} {'mean':>9} {'p99':>9} {'elapsed':>8}")
+    for label, size in (('off', 0), ('on', args.cache_size)):
+        result = run(prompts, args.workers, args.latency, size)
+        print(f"{label:>5} {result['calls']:>10} {result['hits']:>6} {result['coalesced']:>10} "
+              f"{result['mean'] * 1000:>6.1f} ms {result['p99'] * 1000:>6.1f} ms {result['elapsed']:>6.2f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Benchmark: AI requests made for bursty typing, with and without coalescing and rate limits
+
+Simulates --users users who each type --bursts bursts of --lines quick
+lines (--gap seconds apart), pausing --pause seconds between bursts. The
+prompts go through AIWorkerPool.submit like handle_chat_message does.
+Reports how many upstream requests were made, how many lines were merged
+or refused, and the mean time from a burst's last line to its reply.
+
+Usage:
+    python benchmarks/bench_ai_limits.py --users 50 --bursts 4 --lines 4
+"""
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from ai_workers import QUEUED, AIWorkerPool, StubResponder
+from rate_limit import RateLimiter
+
+
+class CountingResponder(StubResponder):
+    def __init__(self, latency):
+        super().__init__(latency)
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, prompt, username, timeout=None):
+        with self.lock:
+            self.calls += 1
+        return super().__call__(prompt, username, timeout)
+
+
+def run(args, coalesce_window, limiter):
+    responder = CountingResponder(args.latency)
+    pool = AIWorkerPool(responder, workers=args.workers, max_queue=10000, job_timeout=60,
+                        coalesce_window=coalesce_window, limiter=limiter)
+    pool.start()
+    waits = []
+    lock = threading.Lock()
+    outstanding = threading.Semaphore(0)
+    submitted = [0]
+
+    def on_done(job, reply, error):
+        with lock:
+            waits.append(time.monotonic() - job.context)
+        outstanding.release()
+
+    def user(name):
+        for _ in range(args.bursts):
+            for line in range(args.lines):
+                if line:
+                    time.sleep(args.gap)
+                result = pool.submit(f"line {line}", name, on_done, context=time.monotonic(), key=(name, 'lobby'))
+                if result == QUEUED:
+                    with lock:
+                        submitted[0] += 1
+            time.sleep(args.pause)
+
+    threads = [threading.Thread(target=user, args=(f"user{i}",)) for i in range(args.users)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for _ in range(submitted[0]):
+        outstanding.acquire()
+    pool.stop()
+    stats = pool.get_stats()
+    return responder.calls, stats['coalesced'], stats['throttled'], sum(waits) / max(1, len(waits))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Upstream AI requests for bursty typing")
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--bursts', type=int, default=4, help="Bursts per user")
+    parser.add_argument('--lines', type=int, default=4, help="Lines per burst")
+    parser.add_argument('--gap', type=float, default=0.1, help="Seconds between lines of a burst")
+    parser.add_argument('--pause', type=float, default=1.0, help="Seconds between bursts")
+    parser.add_argument('--latency', type=float, default=0.05, help="Seconds per fake AI call")
+    parser.add_argument('--workers', type=int, default=8)
+    args = parser.parse_args()
+
+    lines = args.users * args.bursts * args.lines
+    print(f"{lines} lines from {args.users} users")
+    print(f"{'setup':<28} {'requests':>9} {'merged':>7} {'refused':>8} {'wait':>9}")
+    setups = [
+        ('none', 0.0, None),
+        ('coalesce 300 ms', 0.3, None),
+        ('coalesce + 10/min, burst 3', 0.3, RateLimiter(10 / 60, 3)),
+    ]
+    for label, window, limiter in setups:
+        calls, merged, refused, wait = run(args, window, limiter)
+        print(f"{label:<28} {calls:>9} {merged:>7} {refused:>8} {wait * 1000:>6.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Benchmark: ChatGPT prompt size and server memory as conversations grow
+
+Drives ChatServer.get_chatgpt_response with a fake ChatGPT client that
+records the estimated tokens of every prompt it is sent. Compared are
+keeping a conversation's full history (what naively adding context would
+do) and the bounded ConversationStore, with and without summaries.
+
+The first table follows one conversation for --turns turns. The second
+has --users users chat --user-turns turns each, and reports the memory
+held for all of them against the --memory-mb cap.
+
+Usage:
+    python benchmarks/bench_ai_memory.py --turns 1000 --users 20000
+"""
+
+import argparse
+import contextlib
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from conversations import estimate_tokens, turn_bytes
+from server import ChatServer
+
+REPLY = "Sure! 😊 " + "Here is a reasonably detailed answer to your question. " * 5
+
+
+class Response:
+    pass
+
+
+class RecordingChatGPT:
+    """Mimics openai.OpenAI().chat.completions; remembers the last prompt's size"""
+
+    def __init__(self):
+        self.prompt_tokens = 0
+        self.chat = self
+        self.completions = self
+
+    def create(self, model, messages, max_tokens, temperature, timeout=None, stream=False):
+        self.prompt_tokens = sum(estimate_tokens(message['content']) for message in messages)
+        response, choice = Response(), Response()
+        choice.message = Response()
+        choice.message.content = REPLY
+        response.choices = [choice]
+        return response
+
+
+def make_server(memory_turns, memory_mb=8, summarize=False):
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        server = ChatServer(ai_backend='openai', history_dir=None, ai_cache_size=0, ai_memory_turns=memory_turns,
+                            ai_memory_bytes=memory_mb * 1024 * 1024, ai_memory_summarize=summarize)
+    server.openai_client = RecordingChatGPT()
+    return server
+
+
+def ask(server, username, room, text):
+    key = server.conversation_key(username, room)
+    server.get_chatgpt_response(text, username, conversation=key)
+    if key is not None:
+        server.summarize_conversation(key)
+    return server.openai_client.prompt_tokens
+
+
+def one_conversation(turns, memory_turns):
+    checkpoints = sorted({10, 100, turns} & set(range(1, turns + 1)))
+    print(f"One conversation, prompt tokens at turn {', '.join(map(str, checkpoints))}")
+    print(f"{'setup':<24} " + ' '.join(f"{turn:>8}" for turn in checkpoints))
+
+    # Full history: every earlier question and reply goes along
+    history_tokens = estimate_tokens(REPLY)
+    full = []
+    for turn in range(1, turns + 1):
+        question = f"question {turn} about something I said before"
+        prompt = history_tokens + estimate_tokens(question)
+        history_tokens = prompt + estimate_tokens(REPLY)
+        if turn in checkpoints:
+            full.append(prompt)
+    print(f"{'full history':<24} " + ' '.join(f"{tokens:>8}" for tokens in full))
+
+    for label, summarize in (('memory', False), ('memory + summaries', True)):
+        server = make_server(memory_turns, summarize=summarize)
+        sizes = []
+        for turn in range(1, turns + 1):
+            tokens = ask(server, 'alice', 'lobby', f"question {turn} about something I said before")
+            if turn in checkpoints:
+                sizes.append(tokens)
+        print(f"{label:<24} " + ' '.join(f"{tokens:>8}" for tokens in sizes))
+
+
+def many_users(users, user_turns, memory_turns, memory_mb):
+    full_bytes = users * user_turns * (turn_bytes("question 0 about something") + turn_bytes(REPLY))
+    server = make_server(memory_turns, memory_mb)
+    for turn in range(user_turns):
+        for user in range(users):
+            ask(server, f"user{user}", 'lobby', f"question {turn} about something")
+    stats = server.conversations.get_stats()
+    print(f"\n{users} users x {user_turns} turns, memory cap {memory_mb} MiB")
+    print(f"{'setup':<24} {'conversations':>13} {'memory':>10}")
+    print(f"{'full history':<24} {users:>13} {full_bytes / 1024 / 1024:>6.1f} MiB")
+    print(f"{'memory':<24} {stats['conversations']:>13} {stats['bytes'] / 1024 / 1024:>6.1f} MiB "
+          f"({stats['evicted']} evicted)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prompt size and memory of AI conversation memory")
+    parser.add_argument('--turns', type=int, default=1000, help="Turns of the single conversation")
+    parser.add_argument('--memory-turns', type=int, default=10)
+    parser.add_argument('--users', type=int, default=20000)
+    parser.add_argument('--user-turns', type=int, default=5)
+    parser.add_argument('--memory-mb', type=int, default=8)
+    args = parser.parse_args()
+
+    one_conversation(args.turns, args.memory_turns)
+    many_users(args.users, args.user_turns, args.memory_turns, args.memory_mb)
+
+
+if __name__ == "__main__":
+    main()
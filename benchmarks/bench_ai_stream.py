@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Benchmark: time until a ChatGPT reply's first words reach the room, streamed or not
+
+Drives ChatServer.get_chatgpt_response with a fake ChatGPT client that
+sends a --tokens token reply, one token every --token-ms milliseconds
+after --ttft-ms of thinking, like the real streaming API. Without
+streaming nothing can be shown before the whole reply exists; with it,
+the pieces are batched by StreamBuffer like on_ai_chunk does, and the
+first one goes out as soon as it arrives. Reported per --interval-ms:
+time to first text, time to the whole reply and ai_chunk frames per reply.
+
+Usage:
+    python benchmarks/bench_ai_stream.py --replies 20 --tokens 60 --token-ms 20
+"""
+
+import argparse
+import contextlib
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from ai_workers import StreamBuffer
+from server import ChatServer
+
+
+class Response:
+    pass
+
+
+class FakeStreamingChatGPT:
+    """Mimics openai.OpenAI().chat.completions, including stream=True"""
+
+    def __init__(self, tokens, ttft, token_time):
+        self.tokens = [f"word{i} " for i in range(tokens)]
+        self.ttft = ttft
+        self.token_time = token_time
+        self.chat = self
+        self.completions = self
+
+    def create(self, model, messages, max_tokens, temperature, timeout=None, stream=False):
+        if not stream:
+            time.sleep(self.ttft + self.token_time * len(self.tokens))
+            response, choice = Response(), Response()
+            choice.message = Response()
+            choice.message.content = ''.join(self.tokens)
+            response.choices = [choice]
+            return response
+        return self.stream()
+
+    def stream(self):
+        time.sleep(self.ttft)
+        for token in self.tokens:
+            time.sleep(self.token_time)
+            chunk, choice = Response(), Response()
+            choice.delta = Response()
+            choice.delta.content = token
+            chunk.choices = [choice]
+            yield chunk
+
+
+def run(server, replies, interval):
+    """Mean seconds to first text and to the whole reply, and frames per reply"""
+    first, whole, frames = 0.0, 0.0, 0
+    for i in range(replies):
+        started = time.perf_counter()
+        if interval is None:
+            server.get_chatgpt_response(f"question {i}", 'alice', timeout=60)
+            elapsed = time.perf_counter() - started
+            first += elapsed
+            whole += elapsed
+            frames += 1
+            continue
+        stream = StreamBuffer('bench', interval)
+        sent = []
+
+        def on_delta(text):
+            if stream.add(text) is not None:
+                sent.append(time.perf_counter())
+
+        server.get_chatgpt_response(f"question {i}", 'alice', timeout=60, on_delta=on_delta)
+        first += sent[0] - started
+        whole += time.perf_counter() - started
+        frames += len(sent) + 1     # the chunks and the closing ai_done
+    return first / replies, whole / replies, frames / replies
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time to first AI reply text, streamed vs not")
+    parser.add_argument('--replies', type=int, default=20)
+    parser.add_argument('--tokens', type=int, default=60, help="Tokens per reply")
+    parser.add_argument('--ttft-ms', type=float, default=300, help="Upstream time to first token")
+    parser.add_argument('--token-ms', type=float, default=20, help="Upstream time per further token")
+    parser.add_argument('--interval-ms', type=float, nargs='+', default=[0, 50, 200],
+                        help="StreamBuffer intervals to try")
+    args = parser.parse_args()
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        server = ChatServer(ai_backend='openai', history_dir=None, ai_cache_size=0)
+    server.openai_client = FakeStreamingChatGPT(args.tokens, args.ttft_ms / 1000, args.token_ms / 1000)
+
+    print(f"{'mode':<16} {'first text':>11} {'whole reply':>12} {'frames':>7}")
+    setups = [('whole reply', None)] + [(f"stream {ms:g} ms", ms / 1000) for ms in args.interval_ms]
+    for label, interval in setups:
+        first, whole, frames = run(server, args.replies, interval)
+        print(f"{label:<16} {first * 1000:>8.0f} ms {whole * 1000:>9.0f} ms {frames:>7.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark: CPU per broadcast, per-recipient encoding vs encode-once
+
+Builds a ChatServer with N fake recipients whose outbound queues are never
+drained by a writer, then measures process CPU time per broadcast for:
+
+  per-recipient  json.dumps + encode for every recipient (the old path)
+  encode-once    broadcast_message: one frame shared by every queue
+
+Usage:
+    python benchmarks/bench_broadcast.py --recipients 10 1000
+"""
+
+import argparse
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from outbound import ThreadedOutbox
+from protocol import FrameCache
+from server import ChatServer
+
+
+class FakeConn:
+    """Stands in for a client socket; the outbox writer is never started"""
+
+
+def build_server(recipients):
+    server = ChatServer(ai_backend='stub')
+    for i in range(recipients):
+        conn = FakeConn()
+        server.clients.add(conn, {'username': f'user{i}', 'address': ('127.0.0.1', 40000 + i), 'joined_at': time.time()})
+        server.outboxes[conn] = ThreadedOutbox(conn, max_depth=10 ** 9)
+    return server
+
+
+def per_recipient_broadcast(server, message):
+    for conn in server.clients:
+        server.enqueue_message(conn, FrameCache(message))
+
+
+def measure(server, broadcast, message, iterations):
+    cpu = 0.0
+    for _ in range(iterations):
+        started = time.process_time()
+        broadcast(message)
+        cpu += time.process_time() - started
+        for outbox in server.outboxes.values():
+            outbox.frames.clear()
+    return cpu / iterations
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CPU per broadcast at different fan-outs")
+    parser.add_argument('--recipients', type=int, nargs='+', default=[10, 1000])
+    parser.add_argument('--iterations', type=int, default=0,
+                        help="Broadcasts per measurement (default: scaled to fan-out)")
+    args = parser.parse_args()
+
+    message = {
+        'type': 'chat_message',
+        'username': 'alice',
+        'message': 'Hey everyone, is the meeting still on for 3pm? 🙂',
+        'timestamp': time.time(),
+        'sender_address': ('127.0.0.1', 51234)
+    }
+
+    print(f"{'recipients':>10} {'per-recipient':>15} {'encode-once':>13} {'speedup':>8}")
+    for recipients in args.recipients:
+        server = build_server(recipients)
+        iterations = args.iterations or max(20, 200000 // recipients)
+        old = measure(server, lambda m: per_recipient_broadcast(server, m), message, iterations)
+        new = measure(server, server.broadcast_message, message, iterations)
+        print(f"{recipients:>10} {old * 1e6:>12.1f} us {new * 1e6:>10.1f} us {old / new:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+"""
+Compare wire codecs: payload bytes and encode/decode CPU per message
+
+Only codecs installed in this interpreter are measured; install orjson
+and/or msgpack to include them.
+
+Usage:
+    python benchmarks/bench_codecs.py
+"""
+
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from protocol import CODECS, decode_message, encode_message
+
+SAMPLE = {
+    'type': 'chat_message',
+    'username': 'alice',
+    'message': 'Hey everyone, is the meeting still on for 3pm? 🙂',
+    'timestamp': 1760000000.123456,
+    'sender_address': ('127.0.0.1', 51234)
+}
+
+
+def per_call_us(func, arg, iterations):
+    started = time.process_time()
+    for _ in range(iterations):
+        func(arg)
+    return (time.process_time() - started) / iterations * 1e6
+
+
+def main(iterations=100000):
+    print(f"{'codec':<8} {'bytes':>6} {'encode':>10} {'decode':>10}")
+    for name, codec in CODECS.items():
+        payload = encode_message(SAMPLE, codec)
+        encode_us = per_call_us(codec.encode, SAMPLE, iterations)
+        decode_us = per_call_us(decode_message, payload, iterations)
+        print(f"{name:<8} {len(payload):>6} {encode_us:>7.2f} us {decode_us:>7.2f} us")
+
+
+if __name__ == "__main__":
+    main()
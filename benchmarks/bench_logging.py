@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark: time a handler thread spends logging one chat line
+
+Several threads each log the same chat line that handle_chat_message
+produces, either with print() (the old way) or through event_log's queue.
+The output goes to a sink that takes --write-us microseconds per write,
+like a terminal or a loaded disk, behind a lock like sys.stdout's.
+Reported is the caller's wall time per line, which is what a client
+waits behind; the queued run also reports the time to drain the queue.
+
+Usage:
+    python benchmarks/bench_logging.py --threads 1 8 --write-us 0 50
+"""
+
+import argparse
+import contextlib
+import os
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from event_log import LogService, log
+
+
+class SlowSink:
+    """File-like object whose writes take a fixed time, one at a time"""
+
+    def __init__(self, write_seconds):
+        self.write_seconds = write_seconds
+        self.lock = threading.Lock()
+
+    def write(self, text):
+        with self.lock:
+            if self.write_seconds:
+                deadline = time.perf_counter() + self.write_seconds
+                while time.perf_counter() < deadline:
+                    pass
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+def log_with_print(i):
+    print(f" [12:00:00] alice: message {i}")
+
+
+def log_with_queue(i):
+    log.info('chat', "[%s] %s: %s", '12:00:00', 'alice', f"message {i}", username='alice', room='lobby')
+
+
+def run_threads(func, threads, lines):
+    def worker():
+        for i in range(lines):
+            func(i)
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    started = time.perf_counter()
+    for worker_thread in workers:
+        worker_thread.start()
+    for worker_thread in workers:
+        worker_thread.join()
+    return (time.perf_counter() - started) / (threads * lines)
+
+
+def measure(threads, lines, write_seconds):
+    sink = SlowSink(write_seconds)
+    with contextlib.redirect_stdout(sink):
+        printed = run_threads(log_with_print, threads, lines)
+
+        service = LogService(queue_size=threads * lines + 1)
+        service.handlers[0].setStream(sink)
+        service.start()
+        queued = run_threads(log_with_queue, threads, lines)
+        started = time.perf_counter()
+        service.stop()
+        drained = time.perf_counter() - started
+    return printed, queued, drained
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Caller time per log line, print() vs queued logging")
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 8])
+    parser.add_argument('--write-us', type=float, nargs='+', default=[0, 50],
+                        help="Time the output takes per write, in microseconds")
+    parser.add_argument('--lines', type=int, default=5000, help="Lines per thread")
+    args = parser.parse_args()
+
+    print(f"{'threads':>7} {'write':>8} {'print()':>10} {'queued':>9} {'drain':>9}")
+    for write_us in args.write_us:
+        for threads in args.threads:
+            printed, queued, drained = measure(threads, args.lines, write_us / 1e6)
+            print(f"{threads:>7} {write_us:>5.0f} us {printed * 1e6:>7.1f} us {queued * 1e6:>6.1f} us "
+                  f"{drained:>7.2f} s")
+
+
+if __name__ == "__main__":
+    main()
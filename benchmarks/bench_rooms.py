@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark: CPU per room broadcast, membership scan vs room index
+
+Builds a ChatServer with many small rooms of fake clients whose outbound
+queues are never drained by a writer, then measures process CPU time per
+chat message for:
+
+  scan    walk every client and check its rooms (fan-out without an index)
+  index   broadcast_message: only the room's members from the room index
+
+Usage:
+    python benchmarks/bench_rooms.py --rooms 100 10000 --members 3
+"""
+
+import argparse
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from outbound import ThreadedOutbox
+from protocol import FrameCache
+from server import ChatServer
+
+
+class FakeConn:
+    """Stands in for a client socket; the outbox writer is never started"""
+
+
+def build_server(rooms, members):
+    server = ChatServer(ai_backend='stub', history_dir=None)
+    for r in range(rooms):
+        for m in range(members):
+            conn = FakeConn()
+            client = {
+                'username': f'user{r}-{m}', 'address': ('127.0.0.1', 40000), 'joined_at': time.time(), 'rooms': set()
+            }
+            server.clients.add(conn, client)
+            server.outboxes[conn] = ThreadedOutbox(conn, max_depth=10 ** 9)
+            server.rooms.join(f'room{r}', conn, client['rooms'])
+    return server
+
+
+def scan_broadcast(server, message):
+    frames = FrameCache(message)
+    room = message['room']
+    for conn in server.clients:
+        if room in server.clients[conn]['rooms']:
+            server.enqueue_message(conn, frames)
+
+
+def measure(server, broadcast, rooms, iterations):
+    cpu = 0.0
+    for i in range(iterations):
+        message = {
+            'type': 'chat_message',
+            'username': 'alice',
+            'message': 'Hey everyone, is the meeting still on for 3pm? 🙂',
+            'timestamp': time.time(),
+            'room': f'room{i % rooms}'
+        }
+        started = time.process_time()
+        broadcast(message)
+        cpu += time.process_time() - started
+    for outbox in server.outboxes.values():
+        outbox.frames.clear()
+    return cpu / iterations
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CPU per room broadcast with and without the room index")
+    parser.add_argument('--rooms', type=int, nargs='+', default=[100, 10000])
+    parser.add_argument('--members', type=int, default=3, help="Clients per room")
+    parser.add_argument('--iterations', type=int, default=2000)
+    args = parser.parse_args()
+
+    print(f"{'rooms':>7} {'clients':>8} {'scan':>12} {'index':>10} {'speedup':>8}")
+    for rooms in args.rooms:
+        server = build_server(rooms, args.members)
+        iterations = min(args.iterations, max(50, 2000000 // (rooms * args.members)))
+        old = measure(server, lambda m: scan_broadcast(server, m), rooms, iterations)
+        new = measure(server, server.broadcast_message, rooms, args.iterations)
+        print(f"{rooms:>7} {rooms * args.members:>8} {old * 1e6:>9.1f} us {new * 1e6:>7.1f} us {old / new:>7.0f}x")
+
+
+if __name__ == "__main__":
+    main()
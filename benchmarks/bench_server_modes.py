@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""
+Compare the threaded and asyncio server engines
+
+For each engine and connection count the script starts `server.py` in a
+subprocess, opens N idle connections, samples the server's resident memory,
+then has every connection run closed-loop clock_sync round trips for a fixed
+time and reports messages/sec. clock_sync is used because it exercises the
+full read -> process_message -> reply path without a ChatGPT call.
+
+Connections do not send `join`: presence notifications are broadcast to
+every other client, so joining N clients costs O(N^2) messages and would
+dominate the measurement.
+
+Usage:
+    python benchmarks/bench_server_modes.py --connections 100 1000 10000
+"""
+
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from protocol import FrameDecoder, RECV_BUFFER_SIZE, encode_frame
+
+
+def read_rss_kb(pid):
+    """Resident set size of a process in KB (Linux only)"""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def read_thread_count(pid):
+    try:
+        return len(os.listdir(f'/proc/{pid}/task'))
+    except OSError:
+        return None
+
+
+def wait_for_port(host, port, timeout=15.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection((host, port), timeout=0.5):
+                return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+
+async def open_connections(host, port, count, batch=500):
+    """Open `count` connections, a batch at a time to stay within the backlog"""
+    connections = []
+    for start in range(0, count, batch):
+        tasks = [asyncio.open_connection(host, port) for _ in range(min(batch, count - start))]
+        connections.extend(await asyncio.gather(*tasks))
+    return connections
+
+
+async def ping_loop(reader, writer, stop_at, counter):
+    """Send clock_sync requests back to back and count the replies"""
+    decoder = FrameDecoder()
+    while time.time() < stop_at:
+        writer.write(encode_frame({'type': 'clock_sync', 'client_time': time.time()}))
+        await writer.drain()
+        replies = []
+        while not replies:
+            data = await reader.read(RECV_BUFFER_SIZE)
+            if not data:
+                return
+            replies = decoder.feed(data)
+        counter[0] += len(replies)
+
+
+async def run_load(host, port, count, duration, server_pid):
+    connections = await open_connections(host, port, count)
+    # Connections complete in the kernel backlog before the server accepts
+    # them; wait until it has stopped starting threads before sampling
+    threads = read_thread_count(server_pid)
+    while True:
+        await asyncio.sleep(1.0)
+        settled, threads = threads, read_thread_count(server_pid)
+        if threads == settled:
+            break
+    rss_kb = read_rss_kb(server_pid)
+
+    counter = [0]
+    started = time.time()
+    stop_at = started + duration
+    await asyncio.gather(*(ping_loop(r, w, stop_at, counter) for r, w in connections))
+    elapsed = time.time() - started
+
+    for _, writer in connections:
+        writer.close()
+    return rss_kb, threads, counter[0] / elapsed
+
+
+def bench(mode, count, args):
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, 'server.py'),
+         '--mode', mode, '--port', str(args.port), '--backlog', str(args.backlog), '--no-history'],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        cwd=ROOT
+    )
+    try:
+        if not wait_for_port('127.0.0.1', args.port):
+            raise RuntimeError(f"{mode} server did not start")
+        return asyncio.run(run_load('127.0.0.1', args.port, count, args.duration, server.pid))
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--connections', type=int, nargs='+', default=[100, 1000, 10000])
+    parser.add_argument('--modes', nargs='+', default=['threaded', 'asyncio'])
+    parser.add_argument('--duration', type=float, default=5.0, help="Seconds of load per run")
+    parser.add_argument('--port', type=int, default=50101)
+    parser.add_argument('--backlog', type=int, default=4096)
+    args = parser.parse_args()
+
+    print(f"{'mode':<10} {'conns':>7} {'server RSS':>12} {'threads':>8} {'msgs/sec':>10}")
+    for count in args.connections:
+        for mode in args.modes:
+            rss_kb, threads, rate = bench(mode, count, args)
+            rss = f"{rss_kb / 1024:.1f} MB" if rss_kb else "n/a"
+            print(f"{mode:<10} {count:>7} {rss:>12} {threads or 'n/a':>8} {rate:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Benchmark: time from launching server.py until it accepts connections
+
+Starts the server --runs times per setup and connects as soon as the
+port is open. "openai imported up front" runs the server after an
+`import openai`, which is what every start cost when server.py imported
+it at the top. Setups using openai need the package; they are skipped
+without it.
+
+Usage:
+    python benchmarks/bench_startup.py --runs 10
+"""
+
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from ai_backends import is_installed
+
+SERVER = os.path.join(ROOT, 'server.py')
+EAGER = "import openai, runpy, sys; sys.argv = sys.argv[1:]; runpy.run_path(sys.argv[0], run_name='__main__')"
+
+
+def time_to_listen(command, port, timeout=30.0):
+    started = time.perf_counter()
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                               env=dict(os.environ, OPENAI_API_KEY=os.environ.get('OPENAI_API_KEY', 'unused')))
+    try:
+        while time.perf_counter() - started < timeout:
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                return time.perf_counter() - started
+            except OSError:
+                time.sleep(0.002)
+        raise TimeoutError(f"Server didn't listen within {timeout}s: {command}")
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time until a freshly started server accepts connections")
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--port', type=int, default=50091)
+    args = parser.parse_args()
+
+    flags = ['--port', str(args.port), '--no-history', '--no-udp-time', '--no-metrics']
+    setups = [
+        ('AI off', [sys.executable, SERVER, '--ai-backend', 'off'] + flags, False),
+        ('stub backend', [sys.executable, SERVER, '--ai-backend', 'stub'] + flags, False),
+        ('openai backend, lazy', [sys.executable, SERVER, '--ai-backend', 'openai'] + flags, True),
+        ('openai imported up front', [sys.executable, '-c', EAGER, SERVER, '--ai-backend', 'openai'] + flags, True),
+    ]
+    print(f"{'setup':<26} {'median':>9} {'min':>9}")
+    for label, command, needs_openai in setups:
+        if needs_openai and not is_installed('openai'):
+            print(f"{label:<26} {'skipped, openai not installed':>30}")
+            continue
+        times = [time_to_listen(command, args.port) for _ in range(args.runs)]
+        print(f"{label:<26} {statistics.median(times) * 1000:>6.0f} ms {min(times) * 1000:>6.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Measure how many probes per second the UDP time service answers
+
+The service runs alone in a subprocess. The load generator keeps a window
+of probes in flight from one UDP socket and counts valid replies. On a
+single-core machine both share the core, so the service alone would do
+better than what is reported.
+
+Usage:
+    python benchmarks/bench_time_service.py --duration 5 --window 64
+"""
+
+import argparse
+import multiprocessing
+import os
+import socket
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from time_service import MAGIC, TIME_PACKET, TimeService
+
+
+def serve(port, ready, stop):
+    service = TimeService('127.0.0.1', port)
+    service.start()
+    ready.set()
+    stop.wait()
+    service.stop()
+
+
+def blast(port, duration, window):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1024 * 1024)
+    sock.connect(('127.0.0.1', port))
+    sock.settimeout(0.2)
+    probe = TIME_PACKET.pack(MAGIC, 0.0, 0.0, 0.0)
+
+    replies = 0
+    lost = 0
+    started = time.time()
+    stop_at = started + duration
+    for _ in range(window):
+        sock.send(probe)
+    while time.time() < stop_at:
+        try:
+            data = sock.recv(64)
+        except socket.timeout:
+            lost += window     # refill the window after a stall
+            for _ in range(window):
+                sock.send(probe)
+            continue
+        if data[:4] == MAGIC:
+            replies += 1
+            sock.send(probe)
+    elapsed = time.time() - started
+    sock.close()
+    return replies / elapsed, lost
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--port', type=int, default=50102)
+    parser.add_argument('--duration', type=float, default=5.0)
+    parser.add_argument('--window', type=int, default=64, help="Probes kept in flight")
+    args = parser.parse_args()
+
+    ready = multiprocessing.Event()
+    stop = multiprocessing.Event()
+    server = multiprocessing.Process(target=serve, args=(args.port, ready, stop), daemon=True)
+    server.start()
+    ready.wait(10)
+    try:
+        rate, lost = blast(args.port, args.duration, args.window)
+    finally:
+        stop.set()
+        server.join()
+    print(f"window {args.window}: {rate:,.0f} probes/sec answered, {lost} lost")
+
+
+if __name__ == "__main__":
+    main()
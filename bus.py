@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+"""
+Inter-node bus for running several server processes as one chat
+
+A node is one ChatServer process. Nodes can share a port on one host
+(SO_REUSEPORT) or run on different hosts. Each node publishes what its
+own clients produce to the bus: chat messages, AI replies, join/leave
+notifications, direct messages and its local client count. Every other node broadcasts
+those to its clients and logs the chat messages in its own history. So
+all nodes show the same conversation, and `clients_count` adds up the
+whole cluster.
+
+Bus envelopes are ordinary protocol frames:
+
+    {'kind': 'chat' | 'broadcast' | 'direct' | 'count' | 'node_up' | 'node_down',
+     'node': <sending node id>, 'message': {...}, 'count': <int>}
+
+The default bus is BrokerBus. It is a client of the broker in this file
+(`python bus.py --listen tcp:127.0.0.1:50003`), which relays every frame
+from one node to all others without decoding it. The broker only reads
+each node's hello, and tells the other nodes when a node connects
+(`node_up`) or disconnects (`node_down`). Anything implementing the Bus
+methods can replace BrokerBus.
+"""
+
+import abc
+import argparse
+import asyncio
+import os
+import socket
+import threading
+from event_log import log
+from outbound import DROP_OLDEST, ThreadedOutbox
+from protocol import (CODECS, HEADER, HEADER_SIZE, JSON_CODEC, FrameDecoder, FrameError,
+                      RECV_BUFFER_SIZE, decode_message, encode_frame)
+
+DEFAULT_BUS_ADDRESS = 'tcp:127.0.0.1:50003'
+BUS_CODEC = CODECS.get('orjson', JSON_CODEC)
+MAX_NODE_BACKLOG = 64 * 1024 * 1024     # bytes a node may fall behind before the broker drops it
+
+
+def parse_address(address):
+    """'tcp:host:port' or 'unix:/path' -> (family, sockaddr)"""
+    scheme, _, rest = address.partition(':')
+    if scheme == 'unix':
+        return socket.AF_UNIX, rest
+    if scheme == 'tcp':
+        host, _, port = rest.rpartition(':')
+        return socket.AF_INET, (host or '127.0.0.1', int(port))
+    raise ValueError(f"Bus address must be tcp:host:port or unix:/path, got {address!r}")
+
+
+class Bus(abc.ABC):
+    """Interface between one node and the rest of the cluster"""
+
+    @abc.abstractmethod
+    def start(self, node_id, on_envelopes):
+        """Connect; `on_envelopes(list)` is later called on a bus thread with what other nodes published"""
+
+    @abc.abstractmethod
+    def publish(self, envelope):
+        """Send an envelope to every other node; must not block"""
+
+    @abc.abstractmethod
+    def close(self):
+        """Disconnect from the cluster"""
+
+    def get_stats(self):
+        return {}
+
+
+class BrokerBus(Bus):
+    """Bus client for the relay broker, over TCP or a Unix socket"""
+
+    def __init__(self, address=DEFAULT_BUS_ADDRESS, max_pending=100000):
+        self.address = address
+        self.max_pending = max_pending
+        self.sock = None
+        self.outbox = None
+        self.thread = None
+        self.received = 0
+        self.connected = False
+
+    def start(self, node_id, on_envelopes):
+        family, sockaddr = parse_address(self.address)
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        self.sock.connect(sockaddr)
+        if family == socket.AF_INET:
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.connected = True
+
+        # Publishing only queues the frame; a writer thread batches them out
+        self.outbox = ThreadedOutbox(self.sock, max_depth=self.max_pending, policy=DROP_OLDEST)
+        self.outbox.start()
+        self.publish({'kind': 'hello', 'node': node_id})
+
+        self.thread = threading.Thread(target=self._reader, args=(on_envelopes,), name="bus-reader", daemon=True)
+        self.thread.start()
+
+    def publish(self, envelope):
+        try:
+            self.outbox.put(encode_frame(envelope, BUS_CODEC))
+        except ConnectionError:
+            pass    # bus gone; the node keeps serving its own clients
+
+    def _reader(self, on_envelopes):
+        decoder = FrameDecoder()
+        try:
+            while True:
+                data = self.sock.recv(RECV_BUFFER_SIZE)
+                if not data:
+                    break
+                envelopes = [decode_message(payload) for payload in decoder.feed(data)]
+                if envelopes:
+                    self.received += len(envelopes)
+                    on_envelopes(envelopes)
+        except (OSError, FrameError, ValueError) as e:
+            log.error('bus_error', "Bus connection error: %s", e)
+        finally:
+            if self.connected:
+                log.warning('bus_lost', "Lost connection to the bus; serving local clients only")
+            self.connected = False
+
+    def close(self):
+        if self.outbox is not None:
+            self.outbox.close()
+        if self.sock is not None:
+            self.connected = False
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.sock.close()
+
+    def get_stats(self):
+        stats = self.outbox.get_stats() if self.outbox else {}
+        stats.update({'address': self.address, 'connected': self.connected, 'received': self.received})
+        return stats
+
+
+class Broker:
+    """Relays frames from each node to every other node"""
+
+    def __init__(self, address=DEFAULT_BUS_ADDRESS):
+        self.address = address
+        self.nodes = {}     # StreamWriter -> node id
+        self.server = None
+
+    async def serve(self):
+        family, sockaddr = parse_address(self.address)
+        if family == socket.AF_UNIX:
+            if os.path.exists(sockaddr):
+                os.remove(sockaddr)
+            self.server = await asyncio.start_unix_server(self.handle_node, sockaddr)
+        else:
+            self.server = await asyncio.start_server(self.handle_node, *sockaddr, reuse_address=True)
+        print(f" Bus broker listening on {self.address}")
+        async with self.server:
+            await self.server.serve_forever()
+
+    def relay(self, source, data):
+        for writer in list(self.nodes):
+            if writer is source:
+                continue
+            transport = writer.transport
+            if transport.get_write_buffer_size() > MAX_NODE_BACKLOG:
+                print(f" Dropping node {self.nodes.get(writer)}: {MAX_NODE_BACKLOG} bytes behind")
+                self.nodes.pop(writer, None)
+                writer.close()
+                continue
+            writer.write(data)
+
+    async def handle_node(self, reader, writer):
+        sock = writer.get_extra_info('socket')
+        if sock is not None and sock.family == socket.AF_INET:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        decoder = FrameDecoder()
+        node = None
+        try:
+            # The first frame names the node
+            while node is None:
+                data = await reader.read(RECV_BUFFER_SIZE)
+                if not data:
+                    return
+                payloads = decoder.feed(data)
+                if payloads:
+                    node = decode_message(payloads[0]).get('node', '?')
+                    self.relay(writer, encode_frame({'kind': 'node_up', 'node': node}, BUS_CODEC))
+                    self.nodes[writer] = node
+                    print(f" Node {node} connected ({len(self.nodes)} nodes)")
+                    for payload in payloads[1:]:
+                        self.relay(writer, encode_frame_bytes(payload))
+
+            while True:
+                data = await reader.read(RECV_BUFFER_SIZE)
+                if not data:
+                    break
+                if not decoder.pending_bytes() and data_is_whole_frames(data):
+                    self.relay(writer, data)    # common case: forward the read as-is
+                else:
+                    for payload in decoder.feed(data):
+                        self.relay(writer, encode_frame_bytes(payload))
+                if writer not in self.nodes:
+                    break
+                await asyncio.sleep(0)
+        except (ConnectionError, OSError, FrameError, ValueError) as e:
+            print(f" Node {node} error: {e}")
+        finally:
+            if self.nodes.pop(writer, None) is not None:
+                print(f" Node {node} disconnected ({len(self.nodes)} nodes)")
+                self.relay(writer, encode_frame({'kind': 'node_down', 'node': node}, BUS_CODEC))
+            writer.close()
+
+
+def encode_frame_bytes(payload):
+    """Re-frame an already encoded payload"""
+    return HEADER.pack(len(payload)) + payload
+
+
+def data_is_whole_frames(data):
+    """True if `data` is exactly a sequence of complete frames"""
+    pos = 0
+    end = len(data)
+    while pos + HEADER_SIZE <= end:
+        pos += HEADER_SIZE + HEADER.unpack_from(data, pos)[0]
+    return pos == end
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Relay broker joining chat server nodes")
+    parser.add_argument('--listen', default=DEFAULT_BUS_ADDRESS, help="tcp:host:port or unix:/path")
+    args = parser.parse_args()
+    try:
+        asyncio.run(Broker(args.listen).serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
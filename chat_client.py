@@ -0,0 +1,453 @@
+"""
+UI-free chat client library
+
+BaseChatClient holds the protocol state every client needs: the username,
+the negotiated codec, history paging and the server clock offset (see
+clock_sync.py). Clock probes go to the server's UDP time service when
+join_success advertises one, and over the TCP stream otherwise or when
+UDP gets no answer. Sends carry the client's hybrid logical clock and
+every stamped message received advances it (see hlc.py); apps that
+display events can run them through hlc.ReorderBuffer. It builds
+the outgoing messages and digests the incoming ones. Two transports build
+on it:
+
+  - ChatClient: a blocking socket with a reader thread. Incoming messages
+    go to `on_message` (called on the reader thread). Without a callback
+    they are queued and read with receive() or `for message in client`.
+  - AsyncChatClient: asyncio streams. Incoming messages go to `on_message`
+    (called on the event loop) or are read with `await receive()` or
+    `async for message in client`.
+
+The connection starts in the server's lobby; join_room() and leave_room()
+change room membership and send_chat(text, room) talks in a room. The
+paging state below follows the lobby's history; pages of other rooms
+carry their own cursor.
+
+Sends never wait for a reply, so any number of requests can be in flight
+on one connection. send_many() writes a batch of messages with one
+syscall. A reader thread (or a task) per connection and no widgets make it
+cheap to run hundreds of bot connections in one process. Nothing is
+printed; noteworthy events go to the 'chat_client' logger.
+
+    client = ChatClient()
+    client.connect("bot")
+    client.send_chat("hello")
+    for message in client:
+        print(message)
+"""
+
+import abc
+import asyncio
+import logging
+import queue
+import socket
+import threading
+import time
+from clock_sync import ClockSync
+from hlc import HybridLogicalClock
+from rooms import DEFAULT_ROOM
+from time_service import TimeClient
+from protocol import (CODECS, JSON_CODEC, FrameDecoder, FrameError, FrameWriter, RECV_BUFFER_SIZE,
+                      available_codecs, decode_message, encode_frame)
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 50001
+HISTORY_PAGE_SIZE = 50
+UDP_FALLBACK_AFTER = 3      # unanswered UDP probes before syncing over TCP instead
+
+logger = logging.getLogger('chat_client')
+
+
+class BaseChatClient(abc.ABC):
+    """Protocol state and message builders shared by both transports"""
+
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, on_message=None, on_disconnect=None,
+                 codecs=None, udp_time=True):
+        self.host = host
+        self.port = port
+        self.on_message = on_message
+        self.on_disconnect = on_disconnect
+        self.codecs = codecs or available_codecs()
+
+        self.username = None
+        self.connected = False
+        self.codec = JSON_CODEC  # switched by join_success
+
+        # Clock synchronization: bursts of probes, min-delay filtering, drift and slewing
+        self.clock = ClockSync()
+        self.hlc = HybridLogicalClock()
+        self.udp_time = udp_time
+        self.time_port = None       # advertised in join_success
+        self.udp_failed = False
+
+        self.rooms = set()          # confirmed by join_success / room_joined
+
+        # Lobby history paging: offset of the oldest message received and whether more exist
+        self.oldest_offset = None
+        self.history_has_more = False
+        self.history_pending = False
+
+    def _reset(self, username):
+        self.username = username
+        self.codec = JSON_CODEC
+        self.time_port = None
+        self.udp_failed = False
+        self.rooms = set()
+        self.oldest_offset = None
+        self.history_has_more = False
+        self.history_pending = False
+
+    # ------------------------------------------------------------------
+    # Outgoing
+
+    @abc.abstractmethod
+    def send(self, message):
+        """Send one message to the server"""
+
+    @abc.abstractmethod
+    def send_many(self, messages):
+        """Send several messages in one write"""
+
+    def join_message(self, history_limit=None):
+        message = {
+            'type': 'join',
+            'username': self.username,
+            'timestamp': time.time(),
+            'codecs': self.codecs,
+            'hlc': self.hlc.now()
+        }
+        if history_limit is not None:
+            message['history_limit'] = history_limit
+        return message
+
+    def send_chat(self, text, room=None):
+        message = {
+            'type': 'chat',
+            'message': text,
+            'username': self.username,
+            'timestamp': time.time(),
+            'hlc': self.hlc.now()
+        }
+        if room is not None:
+            message['room'] = room
+        self.send(message)
+
+    def send_direct(self, to, text):
+        """Private message to every connection of user `to`"""
+        self.send({
+            'type': 'direct_message',
+            'to': to,
+            'message': text,
+            'timestamp': time.time(),
+            'hlc': self.hlc.now()
+        })
+
+    def join_room(self, room, ai=None, history_limit=None):
+        """Join (or create) a room; `ai` picks the AI backend of a new room, 'off' for none"""
+        message = {'type': 'join_room', 'room': room, 'hlc': self.hlc.now()}
+        if ai is not None:
+            message['ai'] = ai
+        if history_limit is not None:
+            message['history_limit'] = history_limit
+        self.send(message)
+
+    def leave_room(self, room):
+        self.send({'type': 'leave_room', 'room': room, 'hlc': self.hlc.now()})
+
+    def sync_clock(self):
+        """Start a burst of clock probes; each reply triggers the next"""
+        if self.udp_time and self.time_port and not self.udp_failed:
+            self._run_in_background(self._udp_sync_burst)
+        else:
+            self.send(self.clock.start_burst())
+
+    def _udp_sync_burst(self):
+        """Run a whole probe burst against the UDP time service (blocking)"""
+        time_client = TimeClient(self.host, self.time_port)
+        self.clock.start_burst()
+        replies = 0
+        try:
+            for attempt in range(2 * self.clock.burst_size):
+                if not self.clock.probing() or (not replies and attempt >= UDP_FALLBACK_AFTER):
+                    break
+                reply = time_client.probe()
+                if reply is None:
+                    continue    # lost datagram; just probe again
+                replies += 1
+                message, received_at = reply
+                if self.clock.add_response(message, received_at):
+                    message['sync_complete'] = True
+                    self._call_from_thread(self._deliver, message)
+        finally:
+            time_client.close()
+
+        if not replies:
+            logger.info("No reply from UDP time service on port %s; syncing over TCP", self.time_port)
+            self.udp_failed = True  # callers can check this to see the fallback
+            self._call_from_thread(self.sync_clock)
+
+    def request_history(self, before_offset=None, limit=HISTORY_PAGE_SIZE, room=None):
+        message = {'type': 'history_request', 'before_offset': before_offset, 'limit': limit}
+        if room is None:
+            self.history_pending = True
+        else:
+            message['room'] = room
+        self.send(message)
+
+    def request_older_history(self, limit=HISTORY_PAGE_SIZE):
+        """Ask for the page before the oldest message received; False if there is none to ask for"""
+        if not self.connected or self.history_pending or not self.history_has_more:
+            return False
+        self.request_history(self.oldest_offset, limit)
+        return True
+
+    def leave_message(self):
+        return {'type': 'leave', 'username': self.username, 'timestamp': time.time()}
+
+    # ------------------------------------------------------------------
+    # Incoming
+
+    def _receive(self, payloads, received_at):
+        for payload in payloads:
+            message = decode_message(payload)
+            self._handle(message, received_at)
+            self._deliver(message)
+
+    def _handle(self, message, received_at):
+        """Update connection state from a server message before it is delivered"""
+        msg_type = message.get('type')
+        if 'hlc' in message:
+            self.hlc.update(message['hlc'])
+
+        if msg_type == 'join_success':
+            # Older servers don't negotiate and keep using JSON
+            codec = CODECS.get(message.get('codec'))
+            if codec:
+                self.codec = codec
+            self.time_port = message.get('time_port')
+            self.rooms = {message.get('room', DEFAULT_ROOM)}
+
+        elif msg_type == 'room_joined':
+            self.rooms.add(message['room'])
+
+        elif msg_type == 'room_left':
+            self.rooms.discard(message['room'])
+
+        elif msg_type == 'clock_sync_response':
+            message['client_receive_time'] = received_at
+            if self.clock.add_response(message, received_at):
+                message['sync_complete'] = True
+            elif self.clock.probing():
+                self.send(self.clock.probe_message())
+
+        elif msg_type == 'history' and message.get('room', DEFAULT_ROOM) == DEFAULT_ROOM:
+            # Tell views whether this is the join replay or an older page
+            message['older_page'] = self.oldest_offset is not None
+            self.history_has_more = message.get('has_more', False)
+            if message.get('before_offset') is not None:
+                self.oldest_offset = message['before_offset']
+            self.history_pending = False
+
+    @abc.abstractmethod
+    def _deliver(self, message):
+        """Hand a received message to on_message, or queue it for the caller"""
+
+    @abc.abstractmethod
+    def _run_in_background(self, func):
+        """Run func() without blocking the caller"""
+
+    @abc.abstractmethod
+    def _call_from_thread(self, func, *args):
+        """Run func(*args) where the transport allows it, from any thread"""
+
+    @property
+    def server_time_offset(self):
+        return self.clock.offset()
+
+    @property
+    def last_sync_time(self):
+        return self.clock.last_sync_time
+
+    def server_time(self):
+        """Current time on the server's clock, as a Unix timestamp"""
+        return time.time() + self.clock.offset()
+
+
+class ChatClient(BaseChatClient):
+    """Blocking client: thread-safe sends, a reader thread for incoming messages"""
+
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, on_message=None, on_disconnect=None,
+                 codecs=None, udp_time=True):
+        super().__init__(host, port, on_message, on_disconnect, codecs, udp_time)
+        self.sock = None
+        self.writer = None
+        self.thread = None
+        self.incoming = queue.SimpleQueue()
+
+    def connect(self, username, history_limit=None, timeout=10.0):
+        """Open the connection and send join; replies arrive asynchronously"""
+        self._reset(username)
+        self.sock = socket.create_connection((self.host, self.port), timeout=timeout)
+        self.sock.settimeout(None)
+        self.writer = FrameWriter(self.sock)
+        self.connected = True
+        self.thread = threading.Thread(target=self._read_loop, args=(self.sock,), daemon=True)
+        self.thread.start()
+        self.send(self.join_message(history_limit))
+
+    def send(self, message):
+        self.writer.send_frame(encode_frame(message, self.codec))
+
+    def send_many(self, messages):
+        codec = self.codec
+        self.writer.send_frames([encode_frame(message, codec) for message in messages])
+
+    def receive(self, timeout=None):
+        """Next queued message, or None once the connection has closed
+
+        Raises queue.Empty if `timeout` expires. Only used without `on_message`.
+        """
+        return self.incoming.get(timeout=timeout)
+
+    def __iter__(self):
+        while True:
+            message = self.receive()
+            if message is None:
+                return
+            yield message
+
+    def close(self):
+        """Send leave and close the connection"""
+        if not self.connected:
+            return
+        try:
+            self.send(self.leave_message())
+        except OSError:
+            pass
+        self.connected = False
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+    def _read_loop(self, sock):
+        decoder = FrameDecoder()
+        try:
+            while True:
+                data = sock.recv(RECV_BUFFER_SIZE)
+                if not data:
+                    break
+                self._receive(decoder.feed(data), time.time())
+        except (OSError, FrameError, ValueError):
+            pass
+        finally:
+            self.connected = False
+            if self.on_message is None:
+                self.incoming.put(None)
+            if self.on_disconnect:
+                self.on_disconnect()
+
+    def _deliver(self, message):
+        if self.on_message:
+            self.on_message(message)
+        else:
+            self.incoming.put(message)
+
+    def _run_in_background(self, func):
+        threading.Thread(target=func, daemon=True).start()
+
+    def _call_from_thread(self, func, *args):
+        func(*args)     # sends and delivery are already thread-safe
+
+
+class AsyncChatClient(BaseChatClient):
+    """asyncio client: buffered, pipelined sends and a reader task
+
+    send() only buffers; call drain() to apply backpressure.
+    """
+
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, on_message=None, on_disconnect=None,
+                 codecs=None, udp_time=True):
+        super().__init__(host, port, on_message, on_disconnect, codecs, udp_time)
+        self.reader = None
+        self.writer = None
+        self.task = None
+        self.loop = None
+        self.incoming = None
+
+    async def connect(self, username, history_limit=None):
+        """Open the connection and send join; replies arrive asynchronously"""
+        self._reset(username)
+        self.loop = asyncio.get_running_loop()
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self.incoming = asyncio.Queue()
+        self.connected = True
+        self.send(self.join_message(history_limit))
+        self.task = self.loop.create_task(self._read_loop(self.reader))
+
+    def send(self, message):
+        self.writer.write(encode_frame(message, self.codec))
+
+    def send_many(self, messages):
+        codec = self.codec
+        self.writer.writelines([encode_frame(message, codec) for message in messages])
+
+    async def drain(self):
+        await self.writer.drain()
+
+    async def receive(self):
+        """Next queued message, or None once the connection has closed"""
+        return await self.incoming.get()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        message = await self.receive()
+        if message is None:
+            raise StopAsyncIteration
+        return message
+
+    async def close(self):
+        """Send leave and close the connection"""
+        if not self.connected:
+            return
+        try:
+            self.send(self.leave_message())
+            await self.writer.drain()
+        except (ConnectionError, OSError):
+            pass
+        self.connected = False
+        self.writer.close()
+        if self.task is not None:
+            self.task.cancel()
+
+    async def _read_loop(self, reader):
+        decoder = FrameDecoder()
+        try:
+            while True:
+                data = await reader.read(RECV_BUFFER_SIZE)
+                if not data:
+                    break
+                self._receive(decoder.feed(data), time.time())
+        except (ConnectionError, OSError, FrameError, ValueError):
+            pass
+        finally:
+            self.connected = False
+            if self.on_message is None:
+                self.incoming.put_nowait(None)
+            if self.on_disconnect:
+                self.on_disconnect()
+
+    def _deliver(self, message):
+        if self.on_message:
+            self.on_message(message)
+        else:
+            self.incoming.put_nowait(message)
+
+    def _run_in_background(self, func):
+        self.loop.run_in_executor(None, func)
+
+    def _call_from_thread(self, func, *args):
+        self.loop.call_soon_threadsafe(func, *args)
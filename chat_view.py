@@ -0,0 +1,316 @@
+"""
+Virtualized chat rendering for the Tkinter client
+
+Messages live in a compact model (ChatMessage records with __slots__) that
+is separate from any widget. ChatView lays the records out once, measuring
+each bubble's height when it is added and keeping a running list of bubble
+tops. It then draws canvas items only for the bubbles that intersect the
+viewport. Scrolling moves the canvas view and draws whatever came into
+view, deleting what left it. Appending and scrolling therefore cost the
+same with 10 messages or 100,000.
+"""
+
+import bisect
+import tkinter.font as tkfont
+from itertools import accumulate
+
+WRAP_LENGTH = 280       # message text wrap width, as the old Label wraplength
+CONTAINER_PADX = 15     # gap between canvas edge and message row
+BUBBLE_PADX = 30        # extra inset of sent/received bubbles
+SYSTEM_PADX = 50        # inset of centered system bubbles
+ROW_GAP = 10            # vertical space between bubbles
+TEXT_PADX = 15
+USERNAME_PADY = 5
+MESSAGE_PADY = 8
+TIME_PADY = 3
+BORDER = 1
+OVERSCAN = 4            # bubbles drawn beyond each edge of the viewport
+
+
+class ChatMessage:
+    """One chat bubble's data plus its cached layout size"""
+
+    __slots__ = ('text', 'kind', 'username', 'time_str', 'width', 'height', 'text_height')
+
+    def __init__(self, text, kind, username, time_str):
+        self.text = text
+        self.kind = kind            # 'sent', 'received' or 'system'
+        self.username = username
+        self.time_str = time_str
+        self.width = 0
+        self.height = 0
+        self.text_height = 0
+
+
+class ChatView:
+    """Draws only the visible ChatMessages directly on a Canvas"""
+
+    def __init__(self, canvas, colors, scrollbar=None, on_reach_top=None):
+        self.canvas = canvas
+        self.colors = colors
+        self.scrollbar = scrollbar
+        self.on_reach_top = on_reach_top
+
+        self.message_font = tkfont.Font(family="Helvetica", size=11)
+        self.username_font = tkfont.Font(family="Helvetica", size=9, weight="bold")
+        self.time_font = tkfont.Font(family="Helvetica", size=8)
+        self.message_line = self.message_font.metrics('linespace')
+        self.username_line = self.username_font.metrics('linespace')
+        self.time_line = self.time_font.metrics('linespace')
+        self.word_widths = {}
+
+        # Canvas text bboxes can differ from lines * linespace by a pixel or
+        # two; calibrate once so estimates normally match what gets drawn
+        probe = canvas.create_text(0, 0, text="Ag", anchor='nw', font=self.message_font)
+        bbox = canvas.bbox(probe)
+        canvas.delete(probe)
+        self.message_extra = (bbox[3] - bbox[1]) - self.message_line if bbox else 0
+
+        self.messages = []
+        self.heights = []
+        self.tops = []
+        self.total_height = 0
+        self.drawn = {}             # message index -> canvas item ids
+        self.view_width = 0
+
+        canvas.configure(yscrollcommand=self.on_yview)
+        canvas.bind('<Configure>', self._on_resize)
+
+    # ------------------------------------------------------------------
+    # Model
+
+    def append(self, message, scroll=True):
+        """Add a message below everything else"""
+        self.extend([message], scroll=scroll)
+
+    def extend(self, messages, scroll=True):
+        """Add several messages below everything else with a single redraw"""
+        for message in messages:
+            self._measure(message)
+            self.messages.append(message)
+            self.heights.append(message.height)
+            self.tops.append(self.total_height)
+            self.total_height += message.height
+        self._update_scrollregion()
+        if scroll:
+            self.scroll_to_bottom()
+        else:
+            self.refresh()
+
+    def prepend(self, messages):
+        """Insert older messages above everything, keeping the viewport steady"""
+        if not messages:
+            return
+        first_visible_y = self.canvas.canvasy(0)
+        added = 0
+        for message in messages:
+            self._measure(message)
+            added += message.height
+
+        self.messages[:0] = messages
+        self.heights[:0] = [message.height for message in messages]
+        self._relayout()
+        self._clear_drawn()
+        self._update_scrollregion()
+        self.canvas.yview_moveto((first_visible_y + added) / max(self.total_height, 1))
+        self.refresh()
+
+    def update(self, message):
+        """Re-measure a message whose text changed and redraw it in place"""
+        for index in range(len(self.messages) - 1, -1, -1):
+            # Growing bubbles are near the bottom; search from there
+            if self.messages[index] is message:
+                break
+        else:
+            return
+        at_bottom = self.canvas.yview()[1] >= 1.0
+        self._measure(message)
+        self.heights[index] = message.height
+        self._relayout(index)
+        for drawn_index in [i for i in self.drawn if i >= index]:
+            self.canvas.delete(*self.drawn.pop(drawn_index))
+        self._update_scrollregion()
+        if at_bottom:
+            self.scroll_to_bottom()
+        else:
+            self.refresh()
+
+    def clear(self):
+        self._clear_drawn()
+        self.messages = []
+        self.heights = []
+        self.tops = []
+        self.total_height = 0
+        self._update_scrollregion()
+
+    def __len__(self):
+        return len(self.messages)
+
+    def _relayout(self, start=0):
+        """Recompute bubble tops from `start` after heights changed"""
+        tops = list(accumulate(self.heights[start:], initial=self.tops[start] if start else 0))
+        self.total_height = tops.pop()
+        self.tops[start:] = tops
+
+    # ------------------------------------------------------------------
+    # Measuring
+
+    def _measure(self, message):
+        lines, text_width = self._wrap(message.text)
+        message.text_height = lines * self.message_line + self.message_extra
+        width = text_width
+        height = 2 * BORDER + message.text_height + 2 * MESSAGE_PADY
+        height += self.time_line + 2 * TIME_PADY
+        width = max(width, self.time_font.measure(message.time_str))
+        if message.kind == 'received' and message.username:
+            height += self.username_line + 2 * USERNAME_PADY
+            width = max(width, self.username_font.measure(f"@{message.username}"))
+        message.width = width + 2 * TEXT_PADX + 2 * BORDER
+        message.height = height + ROW_GAP
+
+    def _wrap(self, text):
+        """Estimate wrapped line count and widest line the way Tk wraps text"""
+        lines = 0
+        widest = 0
+        for paragraph in text.split('\n'):
+            width = self.message_font.measure(paragraph)
+            if width <= WRAP_LENGTH:
+                # The common case: a short message is one measure() call
+                lines += 1
+                widest = max(widest, width)
+                continue
+            space = self._word_width(' ')
+            line_width = 0
+            lines += 1
+            for word in paragraph.split(' '):
+                word_width = self._word_width(word)
+                if line_width and line_width + space + word_width > WRAP_LENGTH:
+                    lines += 1
+                    line_width = 0
+                if word_width > WRAP_LENGTH:
+                    # Tk breaks words longer than the wrap width
+                    extra = int(word_width // WRAP_LENGTH)
+                    lines += extra
+                    line_width = word_width - extra * WRAP_LENGTH
+                else:
+                    line_width += (space if line_width else 0) + word_width
+            widest = WRAP_LENGTH
+        return max(lines, 1), widest
+
+    def _word_width(self, word):
+        width = self.word_widths.get(word)
+        if width is None:
+            width = self.message_font.measure(word)
+            if len(self.word_widths) < 50000:
+                self.word_widths[word] = width
+        return width
+
+    # ------------------------------------------------------------------
+    # Viewport
+
+    def on_yview(self, first, last):
+        """yscrollcommand: sync the scrollbar and draw what came into view"""
+        if self.scrollbar is not None:
+            self.scrollbar.set(first, last)
+        self.refresh()
+        if float(first) <= 0.0 and float(last) < 1.0 and self.on_reach_top:
+            self.on_reach_top()
+
+    def scroll_to_bottom(self):
+        self.canvas.yview_moveto(1.0)
+        self.refresh()
+
+    def refresh(self):
+        """Draw the bubbles intersecting the viewport and drop the rest"""
+        if not self.messages:
+            return
+        top = self.canvas.canvasy(0)
+        bottom = top + self.canvas.winfo_height()
+        first = max(bisect.bisect_right(self.tops, top) - 1 - OVERSCAN, 0)
+        last = min(bisect.bisect_left(self.tops, bottom) + OVERSCAN, len(self.messages))
+
+        for index in [i for i in self.drawn if i < first or i >= last]:
+            self.canvas.delete(*self.drawn.pop(index))
+
+        corrected = None
+        for index in range(first, last):
+            if index not in self.drawn:
+                if self._draw(index) and corrected is None:
+                    corrected = index
+
+        if corrected is not None:
+            # An estimate was off; shift everything below and redraw
+            self._relayout(corrected)
+            self._clear_drawn()
+            self._update_scrollregion()
+            self.refresh()
+
+    def _draw(self, index):
+        """Create the canvas items for one bubble; True if its height estimate was wrong"""
+        message = self.messages[index]
+        canvas = self.canvas
+        view_width = self.view_width or canvas.winfo_width()
+        y = self.tops[index] + ROW_GAP // 2
+
+        if message.kind == 'sent':
+            bubble_color = self.colors['message_sent']
+            right = view_width - CONTAINER_PADX - BUBBLE_PADX
+            left = right - message.width
+        elif message.kind == 'received':
+            bubble_color = self.colors['message_received']
+            left = CONTAINER_PADX + BUBBLE_PADX
+        else:
+            bubble_color = self.colors['system_message']
+            left = max((view_width - message.width) // 2, CONTAINER_PADX + SYSTEM_PADX)
+        right = left + message.width
+        bottom = y + message.height - ROW_GAP
+
+        items = [canvas.create_rectangle(left, y, right, bottom, fill=bubble_color, outline='#000000', width=BORDER)]
+        text_x = left + BORDER + TEXT_PADX
+        cursor = y + BORDER
+
+        if message.kind == 'received' and message.username:
+            items.append(canvas.create_text(
+                text_x, cursor + USERNAME_PADY, text=f"@{message.username}", anchor='nw',
+                font=self.username_font, fill=self.colors['teal']
+            ))
+            cursor += self.username_line + 2 * USERNAME_PADY
+
+        text_item = canvas.create_text(
+            text_x, cursor + MESSAGE_PADY, text=message.text, anchor='nw', width=WRAP_LENGTH,
+            justify='left', font=self.message_font, fill=self.colors['dark_gray']
+        )
+        items.append(text_item)
+        cursor += message.text_height + 2 * MESSAGE_PADY
+
+        items.append(canvas.create_text(
+            right - BORDER - TEXT_PADX, cursor + TIME_PADY, text=message.time_str, anchor='ne',
+            font=self.time_font, fill='#666666'
+        ))
+        self.drawn[index] = items
+
+        bbox = canvas.bbox(text_item)
+        actual = bbox[3] - bbox[1] if bbox else message.text_height
+        if actual != message.text_height:
+            delta = actual - message.text_height
+            message.text_height = actual
+            message.height += delta
+            self.heights[index] = message.height
+            return True
+        return False
+
+    def _clear_drawn(self):
+        for items in self.drawn.values():
+            self.canvas.delete(*items)
+        self.drawn.clear()
+
+    def _update_scrollregion(self):
+        width = self.view_width or self.canvas.winfo_width()
+        self.canvas.configure(scrollregion=(0, 0, width, self.total_height))
+
+    def _on_resize(self, event):
+        if event.width != self.view_width:
+            self.view_width = event.width
+            self._clear_drawn()
+            self._update_scrollregion()
+            self.refresh()
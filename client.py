@@ -1,10 +1,15 @@
 import tkinter as tk
 from tkinter import ttk, messagebox, simpledialog
-import socket
-import threading
-import json
+import queue
 import time
-from datetime import datetime, timedelta
+from datetime import datetime
+from chat_client import ChatClient
+from chat_view import ChatMessage, ChatView
+from hlc import ReorderBuffer
+
+GUI_TICK_MS = 16                # ~60 Hz message pump
+MAX_MESSAGES_PER_TICK = 1000    # leftovers wait for the next tick so input stays responsive
+ORDERED_TYPES = ('chat_message', 'ai_done', 'user_joined', 'user_left')   # shown in HLC order
 
 class WhatsAppClient:
     def __init__(self, root):
@@ -13,12 +18,16 @@ class WhatsAppClient:
         self.root.geometry("450x700")
         self.root.configure(bg="#075E54")
         
-        # Client state
-        self.client_socket = None
-        self.connected = False
-        self.username = None
-        self.server_time_offset = 0  # For clock synchronization
-        self.last_sync_time = 0
+        # Messages decoded by the network thread, drained in batches on the Tk thread
+        self.incoming = queue.SimpleQueue()
+        self.render_batch = None
+        self.reorder = ReorderBuffer()
+        self.streaming = {}         # reply_id -> ChatMessage growing with its ai_chunk frames
+        self.grown = []             # streamed bubbles to redraw at the end of the tick
+        
+        # Protocol, codec and clock state live in the UI-free client
+        self.client = ChatClient('127.0.0.1', 50001, on_message=self.incoming.put)
+        self.history_loading = False  # set while a history page is being laid out
         
         # WhatsApp colors
         self.colors = {
@@ -35,6 +44,7 @@ class WhatsAppClient:
         
         self.setup_ui()
         self.start_clock_sync_timer()
+        self.root.after(GUI_TICK_MS, self.pump_messages)
         
     def setup_ui(self):
         """Setup the user interface"""
@@ -91,19 +101,16 @@ class WhatsAppClient:
         chat_container = tk.Frame(self.root, bg=self.colors['light_gray'])
         chat_container.pack(fill='both', expand=True)
         
-        # Canvas and scrollbar for chat
+        # Canvas and scrollbar for chat; only visible bubbles are drawn
         self.chat_canvas = tk.Canvas(chat_container, bg=self.colors['light_gray'], highlightthickness=0)
         scrollbar = ttk.Scrollbar(chat_container, orient="vertical", command=self.chat_canvas.yview)
-        self.chat_frame = tk.Frame(self.chat_canvas, bg=self.colors['light_gray'])
-        
-        self.chat_frame.bind(
-            "<Configure>",
-            lambda e: self.chat_canvas.configure(scrollregion=self.chat_canvas.bbox("all"))
+        self.chat_view = ChatView(
+            self.chat_canvas,
+            self.colors,
+            scrollbar=scrollbar,
+            on_reach_top=self.request_older_history
         )
         
-        self.chat_canvas.create_window((0, 0), window=self.chat_frame, anchor="nw")
-        self.chat_canvas.configure(yscrollcommand=scrollbar.set)
-        
         self.chat_canvas.pack(side="left", fill="both", expand=True)
         scrollbar.pack(side="right", fill="y")
         
@@ -195,84 +202,89 @@ class WhatsAppClient:
         )
         server_info.pack(side='right', padx=20, pady=15)
         
-    def add_message(self, message, msg_type='sent', username=None, timestamp=None):
-        """Add message to chat area"""
-        # Message container
-        msg_container = tk.Frame(self.chat_frame, bg=self.colors['light_gray'])
-        msg_container.pack(fill='x', padx=15, pady=5)
-        
-        # Determine colors and alignment
-        if msg_type == 'sent':
-            bubble_color = self.colors['message_sent']
-            align = 'right'
-            anchor = 'e'
-        elif msg_type == 'received':
-            bubble_color = self.colors['message_received']
-            align = 'left'
-            anchor = 'w'
-        else:  # system message
-            bubble_color = self.colors['system_message']
-            align = 'center'
-            anchor = 'center'
-        
-        # Message bubble
-        msg_frame = tk.Frame(msg_container, bg=bubble_color, relief='solid', bd=1)
-        
-        if align == 'center':
-            msg_frame.pack(anchor='center', padx=50)
-        elif align == 'right':
-            msg_frame.pack(side='right', anchor=anchor, padx=30)
-        else:
-            msg_frame.pack(side='left', anchor=anchor, padx=30)
-        
-        # Username for received messages
-        if msg_type == 'received' and username:
-            username_label = tk.Label(
-                msg_frame,
-                text=f"@{username}",
-                font=("Helvetica", 9, "bold"),
-                bg=bubble_color,
-                fg=self.colors['teal'],
-                padx=15,
-                pady=5
-            )
-            username_label.pack(anchor='w')
-        
-        # Message text
-        msg_label = tk.Label(
-            msg_frame,
-            text=message,
-            font=("Helvetica", 11),
-            bg=bubble_color,
-            fg=self.colors['dark_gray'],
-            wraplength=280,
-            justify='left',
-            padx=15,
-            pady=8
-        )
-        msg_label.pack()
-        
-        # Timestamp
+    def make_chat_message(self, message, msg_type='sent', username=None, timestamp=None):
+        """Build the display record for a message"""
         if timestamp:
             time_str = self.format_timestamp(timestamp)
         else:
             time_str = self.get_synchronized_time().strftime("%H:%M")
-            
-        time_label = tk.Label(
-            msg_frame,
-            text=time_str,
-            font=("Helvetica", 8),
-            bg=bubble_color,
-            fg='#666666',
-            padx=15,
-            pady=3
-        )
-        time_label.pack(anchor='e')
+        return ChatMessage(message, msg_type, username, time_str)
         
-        # Auto-scroll to bottom
-        self.root.update_idletasks()
-        self.chat_canvas.configure(scrollregion=self.chat_canvas.bbox("all"))
-        self.chat_canvas.yview_moveto(1.0)
+    def add_message(self, message, msg_type='sent', username=None, timestamp=None):
+        """Add message to chat area and scroll to it"""
+        self.add_record(self.make_chat_message(message, msg_type, username, timestamp))
+        
+    def add_record(self, record):
+        if self.render_batch is not None:
+            # Inside pump_messages: rendered together at the end of the tick
+            self.render_batch.append(record)
+        else:
+            self.chat_view.append(record)
+            
+    def pump_messages(self):
+        """Drain received messages on a fixed tick with one layout and scroll per batch"""
+        self.render_batch = []
+        try:
+            for _ in range(MAX_MESSAGES_PER_TICK):
+                try:
+                    message = self.incoming.get_nowait()
+                except queue.Empty:
+                    break
+                if message.get('type') in ORDERED_TYPES and 'hlc' in message:
+                    # Held briefly so events from racing server threads show in HLC order
+                    self.reorder.push(message)
+                    continue
+                if message.get('type') == 'history':
+                    # History is laid out by the view itself; keep ordering intact
+                    self.flush_render_batch()
+                self.handle_server_message(message)
+            for message in self.reorder.pop_ready():
+                self.handle_server_message(message)
+        finally:
+            self.flush_render_batch()
+            self.render_batch = None
+            for record in self.grown:
+                self.chat_view.update(record)
+            self.grown = []
+        self.root.after(GUI_TICK_MS, self.pump_messages)
+        
+    def flush_render_batch(self):
+        if self.render_batch:
+            self.chat_view.extend(self.render_batch)
+            self.render_batch = []
+        
+    @property
+    def connected(self):
+        return self.client.connected
+        
+    @property
+    def username(self):
+        return self.client.username
+        
+    def add_history(self, message):
+        """Show a page of logged messages: the join replay or an older page"""
+        messages = message.get('messages', [])
+        records = [self.make_history_message(logged) for logged in messages]
+        
+        # Layout below fires scroll callbacks; don't let them request another page
+        self.history_loading = True
+        try:
+            if message.get('older_page'):
+                self.chat_view.prepend(records)
+            else:
+                self.chat_view.extend(records)
+        finally:
+            self.history_loading = False
+        
+    def make_history_message(self, logged):
+        username = logged.get('username')
+        msg_type = 'sent' if username == self.username else 'received'
+        return self.make_chat_message(logged.get('message', ''), msg_type, username, logged.get('timestamp'))
+        
+    def request_older_history(self):
+        """Ask the server for the page before the oldest message shown"""
+        if not self.history_loading:
+            self.client.request_older_history()
         
     def toggle_connection(self):
         """Toggle connection to server"""
@@ -293,54 +305,29 @@ class WhatsAppClient:
         if not username:
             return
             
-        self.username = username
-        
         try:
-            # Create socket connection
-            self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.client_socket.connect(('127.0.0.1', 50001))
-            self.connected = True
+            # Connect, send join and start the listening thread
+            self.reorder = ReorderBuffer()
+            self.streaming = {}
+            self.client.connect(username)
             self.connection_time = time.time()  # Track connection time
             
-            # Send join message
-            join_message = {
-                'type': 'join',
-                'username': self.username,
-                'timestamp': time.time()
-            }
-            self.send_to_server(join_message)
-            
             # Update UI
             self.status_label.config(text=f"Connected as {self.username}", fg=self.colors['teal'])
             self.connect_button.config(text="Disconnect", bg="#D32F2F", fg=self.colors['white'])
             self.root.title(f"WhatsApp Clone - {self.username}")
             
-            # Start listening thread
-            self.listen_thread = threading.Thread(target=self.listen_for_messages, daemon=True)
-            self.listen_thread.start()
-            
             # Initial clock sync
             self.sync_clock()
             
         except Exception as e:
             messagebox.showerror("Connection Error", f"Could not connect to server: {str(e)}")
-            self.connected = False
             
     def disconnect_from_server(self):
         """Disconnect from server"""
-        if self.connected and self.client_socket:
-            # Send leave message
-            leave_message = {
-                'type': 'leave',
-                'username': self.username,
-                'timestamp': time.time()
-            }
-            self.send_to_server(leave_message)
-            
-            self.client_socket.close()
-            
-        self.connected = False
-        self.username = None
+        # Sends leave and closes the socket
+        self.client.close()
+        self.history_loading = False
         
         # Update UI
         self.status_label.config(text="Disconnected", fg="#FF6B6B")
@@ -362,13 +349,7 @@ class WhatsAppClient:
             
         try:
             # Send to server
-            chat_message = {
-                'type': 'chat',
-                'message': message_text,
-                'username': self.username,
-                'timestamp': time.time()
-            }
-            self.send_to_server(chat_message)
+            self.client.send_chat(message_text)
             
             # Add to local chat (will be confirmed by server)
             self.add_message(message_text, 'sent')
@@ -379,25 +360,6 @@ class WhatsAppClient:
         except Exception as e:
             messagebox.showerror("Send Error", f"Could not send message: {str(e)}")
             
-    def send_to_server(self, message):
-        """Send JSON message to server"""
-        if self.client_socket:
-            json_message = json.dumps(message)
-            self.client_socket.send(json_message.encode('utf-8'))
-            
-    def listen_for_messages(self):
-        """Listen for messages from server"""
-        while self.connected:
-            try:
-                data = self.client_socket.recv(1024).decode('utf-8')
-                if data:
-                    message = json.loads(data)
-                    self.root.after(0, lambda: self.handle_server_message(message))
-                else:
-                    break
-            except:
-                break
-                
     def handle_server_message(self, message):
         """Handle different types of messages from server"""
         msg_type = message.get('type')
@@ -411,6 +373,12 @@ class WhatsAppClient:
             timestamp = message.get('timestamp')
             self.add_message(text, 'received', username, timestamp)
             
+        elif msg_type == 'ai_chunk':
+            self.add_ai_chunk(message)
+            
+        elif msg_type == 'ai_done':
+            self.finish_ai_reply(message)
+            
         elif msg_type == 'user_joined':
             username = message.get('username')
             self.add_message(f"{username} joined the chat", 'system')
@@ -419,64 +387,82 @@ class WhatsAppClient:
             username = message.get('username')
             self.add_message(f"{username} left the chat", 'system')
             
+        elif msg_type == 'history':
+            self.add_history(message)
+            
         elif msg_type == 'clock_sync_response':
             self.handle_clock_sync_response(message)
             
-        elif msg_type == 'message_delivered':
+        elif msg_type == 'direct_message':
+            username = message.get('username')
+            self.add_message(f"🔒 {message.get('message')}", 'received', username, message.get('timestamp'))
+            
+        elif msg_type == 'error':
+            self.add_message(message.get('message', 'Error'), 'system')
+            
+        elif msg_type in ('message_delivered', 'message_relayed'):
             # Message delivery confirmation - could add checkmarks here
             pass
             
+    def add_ai_chunk(self, message):
+        """Start a streamed AI reply's bubble, or grow it by one chunk"""
+        reply_id = message.get('reply_id')
+        record = self.streaming.get(reply_id)
+        if record is None:
+            record = self.make_chat_message(message.get('text', ''), 'received', message.get('username'),
+                                            message.get('timestamp'))
+            self.streaming[reply_id] = record
+            self.add_record(record)
+        else:
+            record.text += message.get('text', '')
+            if record not in self.grown:
+                self.grown.append(record)
+                
+    def finish_ai_reply(self, message):
+        """Settle a streamed bubble on the final text, or show the reply if nothing streamed"""
+        record = self.streaming.pop(message.get('reply_id'), None)
+        if record is None:
+            self.add_message(message.get('message'), 'received', message.get('username'), message.get('timestamp'))
+        elif record.text != message.get('message'):
+            record.text = message.get('message')
+            if record not in self.grown:
+                self.grown.append(record)
+            
     def sync_clock(self):
-        """Perform Cristian's clock synchronization"""
+        """Synchronize with the server clock (burst of NTP-style probes)"""
         if not self.connected:
             messagebox.showwarning("Not Connected", "Connect to server first to sync clock.")
             return
             
-        client_send_time = time.time()
-        
-        sync_message = {
-            'type': 'clock_sync',
-            'client_time': client_send_time
-        }
-        self.send_to_server(sync_message)
+        self.client.sync_clock()
         
     def handle_clock_sync_response(self, message):
-        """Handle clock synchronization response using Cristian's algorithm"""
-        client_receive_time = time.time()
-        server_time = message.get('server_time')
-        client_send_time = message.get('client_request_time')
-        estimated_rtt = message.get('estimated_rtt', 0.001)
-        
-        # Cristian's algorithm: adjust for network delay
-        # Server time + half of round trip time
-        network_delay = (client_receive_time - client_send_time) / 2
-        synchronized_time = server_time + network_delay
-        
-        # Calculate offset
-        self.server_time_offset = synchronized_time - time.time()
-        self.last_sync_time = time.time()
-        
-        print(f"Clock synced: offset = {self.server_time_offset:.3f}s")
+        """Report a finished sync burst; the client applies each reply on receipt"""
+        if not message.get('sync_complete'):
+            return
+        offset = self.client.server_time_offset
+        accuracy = self.client.clock.accuracy() or 0.0
+        print(f"Clock synced: offset = {offset:.3f}s ±{accuracy * 1000:.1f}ms")
         # Only show sync message on initial connection, not regular auto-sync
         if time.time() - getattr(self, 'connection_time', 0) < 5:
-            self.add_message(f"Clock synchronized (offset: {self.server_time_offset:.3f}s)", 'system')
+            self.add_message(f"Clock synchronized (offset: {offset:.3f}s ±{accuracy * 1000:.1f}ms)", 'system')
         
     def get_synchronized_time(self):
         """Get current time synchronized with server"""
-        return datetime.fromtimestamp(time.time() + self.server_time_offset)
+        return datetime.fromtimestamp(self.client.server_time())
         
     def format_timestamp(self, timestamp):
         """Format timestamp for display"""
         return datetime.fromtimestamp(timestamp).strftime("%H:%M:%S")
         
     def start_clock_sync_timer(self):
-        """Start automatic clock synchronization every 30 seconds"""
+        """Resync automatically; the interval grows while the drift estimate holds"""
         def auto_sync():
-            if self.connected and time.time() - self.last_sync_time > 30:
+            if self.connected and self.client.clock.sync_due():
                 self.sync_clock()
-            self.root.after(30000, auto_sync)  # 30 seconds
+            self.root.after(1000, auto_sync)
             
-        self.root.after(30000, auto_sync)
+        self.root.after(1000, auto_sync)
         
     def update_time_display(self):
         """Update time display in header"""
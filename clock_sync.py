@@ -0,0 +1,205 @@
+"""
+NTP-style clock synchronization for chat clients
+
+A sync is a burst of clock_sync probes sent one after another: the next
+probe goes out when the previous reply arrives, so probes never queue
+behind each other. Each reply yields the four NTP timestamps
+
+    t1 client send    t2 server receive    t3 server transmit    t4 client receive
+
+    offset = ((t2 - t1) + (t3 - t4)) / 2
+    delay  = (t4 - t1) - (t3 - t2)
+
+so the server's own processing time is not counted as network delay. A
+reply held up behind a broadcast has a large delay, and its offset can be
+wrong by up to half of it. Only the minimum-delay sample of each burst is
+kept (NTP's clock filter).
+
+The kept samples of recent bursts feed a least-squares fit of offset
+against local time. Its slope is the drift between the two clocks. The
+drift predicts the offset between bursts. While predictions stay within
+the accuracy bound the poll interval doubles, up to `max_interval`.
+
+The applied offset is slewed towards each new estimate at `max_slew_rate`
+seconds per second instead of jumping, so displayed times never go
+backwards. Errors above `step_threshold` (including the first sync) are
+stepped.
+"""
+
+import math
+import threading
+import time
+from collections import deque, namedtuple
+
+PHI = 15e-6                 # frequency tolerance assumed for an undisciplined clock (as NTP)
+MAX_DRIFT = 500e-6          # larger fitted drifts are treated as noise
+MIN_DRIFT_SPAN = 60.0       # seconds of samples needed before drift is fitted
+BURST_TIMEOUT = 5.0         # a burst with no reply for this long is abandoned
+
+ClockSample = namedtuple('ClockSample', ['local_time', 'offset', 'delay'])
+
+
+class ClockSync:
+    """Offset and drift estimator fed by clock_sync bursts
+
+    Replies are added on the network thread while the UI reads offset();
+    both go through one lock.
+    """
+
+    def __init__(self, burst_size=8, min_interval=16.0, max_interval=1024.0, history=8,
+                 max_slew_rate=0.001, step_threshold=0.128):
+        self.burst_size = burst_size
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.max_slew_rate = max_slew_rate
+        self.step_threshold = step_threshold
+
+        self.lock = threading.Lock()
+        self.burst = []
+        self.probes_left = 0
+        self.last_probe_time = 0.0
+        self.last_delay = None      # reported to the server with the next probe
+        self.filtered = deque(maxlen=history)   # best sample of each recent burst
+
+        # offset(t) = base_offset + drift * (t - base_time) - remaining slew
+        self.base_time = None
+        self.base_offset = 0.0
+        self.base_delay = 0.0
+        self.drift = 0.0
+        self.slew_error = 0.0
+        self.slew_time = 0.0
+
+        self.interval = min_interval
+        self.last_sync_time = 0.0
+        self.syncs = 0
+
+    # ------------------------------------------------------------------
+    # Probing
+
+    def start_burst(self):
+        """Begin a burst and return its first probe message"""
+        with self.lock:
+            self.burst = []
+            self.probes_left = self.burst_size
+        return self.probe_message()
+
+    def probe_message(self):
+        self.last_probe_time = time.time()
+        message = {'type': 'clock_sync', 'client_time': self.last_probe_time}
+        if self.last_delay is not None:
+            # Lets the server track the round trips its clients see
+            message['estimated_rtt'] = self.last_delay
+            self.last_delay = None
+        return message
+
+    def probing(self):
+        """True while the current burst still wants another probe"""
+        return self.probes_left > 0
+
+    def sync_due(self, now=None):
+        now = time.time() if now is None else now
+        if self.probes_left and now - self.last_probe_time < BURST_TIMEOUT:
+            return False
+        return now - self.last_sync_time >= self.interval
+
+    def add_response(self, message, received_at):
+        """Record a clock_sync_response; True when it completes the burst"""
+        t1 = message.get('client_request_time')
+        t3 = message.get('server_time')
+        if t1 is None or t3 is None:
+            return False
+        # Older servers send only server_time; treat processing as instant
+        t2 = message.get('server_receive_time', t3)
+        sample = ClockSample(
+            received_at,
+            ((t2 - t1) + (t3 - received_at)) / 2,
+            max((received_at - t1) - (t3 - t2), 0.0)
+        )
+
+        with self.lock:
+            if not self.probes_left:
+                return False    # late reply from an abandoned burst
+            self.last_delay = sample.delay
+            self.burst.append(sample)
+            self.probes_left -= 1
+            if self.probes_left:
+                return False
+            self._finish_burst(min(self.burst, key=lambda s: s.delay), received_at)
+        return True
+
+    # ------------------------------------------------------------------
+    # Filtering
+
+    def _finish_burst(self, best, now):
+        applied = self._offset(now)
+        first = self.base_time is None
+        if not first:
+            predicted = self.base_offset + self.drift * (best.local_time - self.base_time)
+            if abs(best.offset - predicted) <= self._bound(best.local_time) + best.delay / 2:
+                self.interval = min(self.interval * 2, self.max_interval)
+            else:
+                self.interval = max(self.interval / 2, self.min_interval)
+
+        self.filtered.append(best)
+        self.drift = self._fit_drift()
+        self.base_time = best.local_time
+        self.base_offset = best.offset
+        self.base_delay = best.delay
+
+        error = self.base_offset + self.drift * (now - self.base_time) - applied
+        self.slew_error = 0.0 if first or abs(error) > self.step_threshold else error
+        self.slew_time = now
+        self.last_sync_time = now
+        self.syncs += 1
+
+    def _fit_drift(self):
+        """Least-squares slope of offset over local time, 0 until enough history"""
+        samples = self.filtered
+        if len(samples) < 3 or samples[-1].local_time - samples[0].local_time < MIN_DRIFT_SPAN:
+            return 0.0
+        mean_t = sum(s.local_time for s in samples) / len(samples)
+        mean_o = sum(s.offset for s in samples) / len(samples)
+        var = sum((s.local_time - mean_t) ** 2 for s in samples)
+        cov = sum((s.local_time - mean_t) * (s.offset - mean_o) for s in samples)
+        drift = cov / var if var else 0.0
+        return drift if abs(drift) <= MAX_DRIFT else 0.0
+
+    def _remaining_slew(self, now):
+        return max(abs(self.slew_error) - self.max_slew_rate * (now - self.slew_time), 0.0)
+
+    def _offset(self, now):
+        if self.base_time is None:
+            return 0.0
+        target = self.base_offset + self.drift * (now - self.base_time)
+        return target - math.copysign(self._remaining_slew(now), self.slew_error)
+
+    def _bound(self, now):
+        """Error bound of the applied offset, excluding the remaining slew"""
+        return self.base_delay / 2 + PHI * max(now - self.base_time, 0.0)
+
+    # ------------------------------------------------------------------
+    # Reading
+
+    def offset(self, now=None):
+        """Seconds to add to local time to get server time"""
+        now = time.time() if now is None else now
+        with self.lock:
+            return self._offset(now)
+
+    def accuracy(self, now=None):
+        """Upper bound on |applied offset - true offset| in seconds, None before the first sync"""
+        now = time.time() if now is None else now
+        with self.lock:
+            if self.base_time is None:
+                return None
+            return self._bound(now) + self._remaining_slew(now)
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'syncs': self.syncs,
+                'offset': self._offset(time.time()),
+                'drift_ppm': self.drift * 1e6,
+                'delay': self.base_delay,
+                'interval': self.interval
+            }
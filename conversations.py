@@ -0,0 +1,190 @@
+"""
+Bounded conversation memory for AI replies
+
+Each conversation (a user in a room, or a whole room) keeps its last
+`max_turns` turns in a ring buffer, so one that runs for days holds as
+much as one that ran for a minute. When a prompt is built, only the
+newest turns that fit in `max_tokens` are sent, so prompt size stays flat
+too. With `summarize` on, turns pushed out of the ring buffer are kept
+aside until there are enough of them to fold into a short rolling
+summary, which is sent ahead of the recent turns.
+
+Conversations are kept in least-recently-used order. Ones idle for
+`idle_ttl` seconds are dropped, and the least recently used go first
+whenever the whole store exceeds `max_bytes` or `max_conversations`.
+
+Token counts are estimated from the text length (about four characters
+per token for English), which is close enough for a budget and needs no
+tokenizer.
+"""
+
+import threading
+import time
+from collections import OrderedDict, deque
+
+CHARS_PER_TOKEN = 4
+TURN_TOKENS = 4             # the API's per-message overhead
+TURN_BYTES = 120            # rough bytes per stored turn besides its text
+CONVERSATION_BYTES = 600    # rough bytes per conversation besides its turns
+MAX_TURN_CHARS = 2000       # longer turns are cut before they are stored
+SUMMARY_AFTER = 6           # pushed-out turns that trigger a summary
+
+
+def estimate_tokens(text):
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN + TURN_TOKENS
+
+
+def turn_bytes(text):
+    return len(text.encode('utf-8')) + TURN_BYTES
+
+
+class Conversation:
+    """Recent turns of one conversation, plus its summary and turns waiting to be summarized"""
+
+    __slots__ = ('turns', 'folded', 'summary', 'summarizing', 'bytes', 'last_used')
+
+    def __init__(self, max_turns):
+        self.turns = deque(maxlen=max_turns)   # (role, text, tokens), oldest first
+        self.folded = []                        # turns pushed out, not yet in the summary
+        self.summary = ''
+        self.summarizing = False
+        self.bytes = CONVERSATION_BYTES
+        self.last_used = 0.0
+
+
+class ConversationStore:
+    """Thread-safe conversations by key, bounded in turns, tokens and total memory"""
+
+    def __init__(self, max_turns=10, max_tokens=1000, max_bytes=8 * 1024 * 1024, idle_ttl=1800.0,
+                 max_conversations=10000, summarize=False, summary_tokens=150):
+        self.max_turns = max(2, max_turns)
+        self.max_tokens = max_tokens
+        self.max_bytes = max_bytes
+        self.idle_ttl = idle_ttl
+        self.max_conversations = max_conversations
+        self.summarize = summarize
+        self.summary_tokens = summary_tokens
+        self.conversations = OrderedDict()  # key -> Conversation; least recently used first
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.stats = {'evicted': 0, 'expired': 0, 'trimmed': 0, 'summarized': 0}
+
+    def context(self, key, prompt=''):
+        """(summary, [(role, text), ...]) to send before `prompt`, within the token budget"""
+        with self.lock:
+            conversation = self.conversations.get(key)
+            if conversation is None:
+                return '', []
+            if conversation.last_used + self.idle_ttl <= time.time():
+                self._discard(key)
+                self.stats['expired'] += 1
+                return '', []
+            budget = self.max_tokens - estimate_tokens(prompt)
+            if conversation.summary:
+                budget -= estimate_tokens(conversation.summary)
+            kept = []
+            for role, text, tokens in reversed(conversation.turns):
+                if tokens > budget:
+                    break
+                budget -= tokens
+                kept.append((role, text))
+            if len(kept) < len(conversation.turns):
+                self.stats['trimmed'] += 1
+            if kept and kept[-1][0] == 'assistant':
+                kept.pop()  # a reply without its question only confuses the model
+            kept.reverse()
+            return conversation.summary, kept
+
+    def record(self, key, prompt, reply):
+        """Add a question and its reply, then evict idle and least recently used conversations"""
+        now = time.time()
+        with self.lock:
+            conversation = self.conversations.get(key)
+            if conversation is None:
+                conversation = self.conversations[key] = Conversation(self.max_turns)
+                self.bytes += conversation.bytes
+            else:
+                self.conversations.move_to_end(key)
+            conversation.last_used = now
+            for role, text in (('user', prompt), ('assistant', reply)):
+                text = text[:MAX_TURN_CHARS]
+                if len(conversation.turns) == conversation.turns.maxlen:
+                    self._push_out(conversation, conversation.turns[0])
+                conversation.turns.append((role, text, estimate_tokens(text)))
+                self._resize(conversation, turn_bytes(text))
+            self._evict(key, now)
+
+    def _push_out(self, conversation, turn):
+        """The oldest turn is about to leave the ring buffer; call with the lock held"""
+        self._resize(conversation, -turn_bytes(turn[1]))
+        if self.summarize and len(conversation.folded) < 2 * SUMMARY_AFTER:
+            # Past that, a summary is overdue and older turns are simply dropped
+            conversation.folded.append(turn)
+            self._resize(conversation, turn_bytes(turn[1]))
+
+    def _resize(self, conversation, delta):
+        conversation.bytes += delta
+        self.bytes += delta
+
+    def _discard(self, key):
+        self.bytes -= self.conversations.pop(key).bytes
+
+    def _evict(self, keep, now):
+        """Drop expired conversations, then least recently used ones over the caps"""
+        while self.conversations:
+            key, conversation = next(iter(self.conversations.items()))
+            if conversation.last_used + self.idle_ttl > now:
+                break
+            self._discard(key)
+            self.stats['expired'] += 1
+        while len(self.conversations) > 1 and (self.bytes > self.max_bytes or
+                                               len(self.conversations) > self.max_conversations):
+            key = next(iter(self.conversations))
+            if key == keep:
+                break
+            self._discard(key)
+            self.stats['evicted'] += 1
+
+    def take_for_summary(self, key):
+        """(summary, turns) to fold into a new summary, or None if it isn't time yet
+
+        The caller must hand the result to finish_summary() even if
+        summarizing failed, so the conversation can be summarized again.
+        """
+        with self.lock:
+            conversation = self.conversations.get(key)
+            if conversation is None or conversation.summarizing or len(conversation.folded) < SUMMARY_AFTER:
+                return None
+            conversation.summarizing = True
+            turns = conversation.folded
+            conversation.folded = []
+            return conversation.summary, [(role, text) for role, text, _ in turns]
+
+    def finish_summary(self, key, turns, summary):
+        """Store a new summary for the turns taken, or None to drop them unsummarized"""
+        with self.lock:
+            conversation = self.conversations.get(key)
+            if conversation is None or not conversation.summarizing:
+                return  # evicted meanwhile
+            conversation.summarizing = False
+            self._resize(conversation, -sum(turn_bytes(text) for _, text in turns))
+            if summary is not None:
+                summary = summary[:self.summary_tokens * CHARS_PER_TOKEN]
+                self._resize(conversation, len(summary.encode('utf-8')) - len(conversation.summary.encode('utf-8')))
+                conversation.summary = summary
+                self.stats['summarized'] += 1
+
+    def forget(self, key):
+        with self.lock:
+            if key in self.conversations:
+                self._discard(key)
+
+    def __len__(self):
+        return len(self.conversations)
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats['conversations'] = len(self.conversations)
+            stats['bytes'] = self.bytes
+        return stats
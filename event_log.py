@@ -0,0 +1,173 @@
+"""
+Structured server logging that never blocks a handler thread
+
+Code logs named events instead of printing:
+
+    log.info('chat', "%s: %s", username, text, room=room)
+
+A call checks the level and the event's sample rate, then puts a plain
+tuple on a queue without waiting; if more than `queue_size` entries are
+pending it is dropped and counted instead. A single listener thread turns
+the entries into `logging` records, formats them and hands them to the
+handlers: a readable line on the console, and optionally one JSON object
+per line in a rotating file. A slow terminal or disk then only delays the
+listener, never a client. The stdlib `Logger` is bypassed on the hot path
+because building a record there (caller lookup, handler locks) costs
+several times more than the queue put.
+
+High-frequency events can be sampled: with `sample={'clock_sync': 100}`
+only every 100th clock sync is logged, and its JSON line carries
+`"sample_rate": 100`.
+
+Until a LogService is started, warnings and errors go straight to the
+`chat` stdlib logger and everything else is dropped.
+"""
+
+import itertools
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+
+LOGGER_NAME = 'chat'
+QUEUE_SIZE = 10000
+DEFAULT_SAMPLE = {'clock_sync': 100}
+LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR')
+
+
+class EventLogger:
+    """Logs named events with structured fields; arguments are formatted later, off the caller's thread"""
+
+    def __init__(self, name=LOGGER_NAME):
+        self.logger = logging.getLogger(name)
+        self.level = logging.WARNING
+        self.queue = None           # SimpleQueue while a LogService runs
+        self.queue_size = QUEUE_SIZE
+        self.dropped = 0
+        self.sample = {}
+        self.counters = {}
+
+    def set_sampling(self, sample):
+        """Log only every Nth record of each event in {event: N}"""
+        self.sample = {event: rate for event, rate in sample.items() if rate > 1}
+        self.counters = {event: itertools.count() for event in self.sample}
+
+    def log(self, level, event, msg, *args, **fields):
+        if level < self.level:
+            return
+        counter = self.counters.get(event)
+        if counter is not None:
+            if next(counter) % self.sample[event]:
+                return
+            fields['sample_rate'] = self.sample[event]
+        entries = self.queue
+        if entries is None:
+            self.logger.log(level, msg, *args, extra={'event': event, 'fields': fields})
+        elif entries.qsize() >= self.queue_size:
+            self.dropped += 1
+        else:
+            entries.put((time.time(), level, event, msg, args, fields))
+
+    def debug(self, event, msg, *args, **fields):
+        self.log(logging.DEBUG, event, msg, *args, **fields)
+
+    def info(self, event, msg, *args, **fields):
+        self.log(logging.INFO, event, msg, *args, **fields)
+
+    def warning(self, event, msg, *args, **fields):
+        self.log(logging.WARNING, event, msg, *args, **fields)
+
+    def error(self, event, msg, *args, **fields):
+        self.log(logging.ERROR, event, msg, *args, **fields)
+
+
+class ConsoleFormatter(logging.Formatter):
+    """The server's usual console lines; warnings and errors are marked"""
+
+    def format(self, record):
+        text = record.getMessage()
+        if record.levelno >= logging.WARNING:
+            return f" {record.levelname}: {text}"
+        return f" {text}"
+
+
+class JSONLinesFormatter(logging.Formatter):
+    """One JSON object per record: time, level, event, message and the event's fields"""
+
+    def format(self, record):
+        entry = {
+            'time': record.created,
+            'level': record.levelname,
+            'event': getattr(record, 'event', None),
+            'message': record.getMessage()
+        }
+        entry.update(getattr(record, 'fields', {}))
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class LogService:
+    """Owns the queue of `log` and the listener thread that writes its entries"""
+
+    def __init__(self, level='INFO', console=True, json_path=None, max_bytes=16 * 1024 * 1024,
+                 backups=5, sample=None, queue_size=QUEUE_SIZE):
+        self.level = logging.getLevelName(level) if isinstance(level, str) else level
+        self.queue_size = queue_size
+        self.sample = DEFAULT_SAMPLE if sample is None else sample
+        self.handlers = []
+        if console:
+            console_handler = logging.StreamHandler(sys.stdout)
+            console_handler.setFormatter(ConsoleFormatter())
+            self.handlers.append(console_handler)
+        if json_path:
+            file_handler = logging.handlers.RotatingFileHandler(
+                json_path, maxBytes=max_bytes, backupCount=backups, encoding='utf-8'
+            )
+            file_handler.setFormatter(JSONLinesFormatter())
+            self.handlers.append(file_handler)
+        self.queue = queue.SimpleQueue()
+        self.thread = None
+
+    def start(self):
+        log.level = self.level
+        log.queue_size = self.queue_size
+        log.set_sampling(self.sample)
+        log.queue = self.queue
+        self.thread = threading.Thread(target=self._listen, name="event-log", daemon=True)
+        self.thread.start()
+
+    def _listen(self):
+        logger = log.logger
+        while True:
+            entry = self.queue.get()
+            if entry is None:
+                break
+            created, level, event, msg, args, fields = entry
+            record = logger.makeRecord(logger.name, level, '(unknown file)', 0, msg, args, None,
+                                       extra={'event': event, 'fields': fields})
+            record.created = created
+            record.msecs = (created % 1) * 1000
+            for handler in self.handlers:
+                if level >= handler.level:
+                    handler.handle(record)
+
+    def stop(self):
+        """Write out everything queued so far, then stop the listener"""
+        if self.thread is None:
+            return
+        if log.queue is self.queue:
+            log.queue = None
+            log.level = logging.WARNING
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+        for handler in self.handlers:
+            handler.close()
+
+    def get_stats(self):
+        return {'queued': self.queue.qsize(), 'dropped': log.dropped}
+
+
+log = EventLogger()
@@ -0,0 +1,147 @@
+"""
+Hybrid logical clocks and in-order delivery of chat events
+
+A hybrid logical clock (HLC) timestamp is wall-clock milliseconds plus a
+logical counter, packed into one integer:
+
+    hlc = (milliseconds << 16) | logical
+
+Packed values compare like the (physical, logical) pair, so a plain max()
+applies the HLC rules: a local event takes max(now, last + 1), and a
+received timestamp is merged with max(now, last + 1, remote + 1).
+Timestamps stay within clock skew of real time yet never go backwards
+along a causal chain. A remote timestamp more than `max_drift` seconds
+ahead of the local clock, or one that isn't an integer, is ignored, so
+one bad peer can't drag every later timestamp into the future. Clients stamp what they send with their own HLC,
+and the server merges it into the timestamp it assigns. So a reply always
+sorts after every message its author had seen.
+
+The server's clock is shared by all handler threads without a lock. A
+racing update can only hand equal or slightly inverted timestamps to
+events that are concurrent anyway. Causally related events are ordered by
+the remote timestamp they carry. Each sender's own stream is stamped by
+its single handler, so it is strictly increasing with consecutive `seq`
+numbers in each room. A sender is one connection, named by the `sender` id
+the server gives it; one user may have several. Every client sorts by
+(hlc, username, sender, seq), so all clients show the same order.
+
+ReorderBuffer holds received events for a short window and releases them
+in that order.
+"""
+
+import heapq
+import time
+
+LOGICAL_BITS = 16
+MAX_DRIFT = 60.0    # seconds a remote timestamp may run ahead of the local clock
+
+
+def physical_time(hlc):
+    """Wall-clock seconds of an HLC timestamp"""
+    return (hlc >> LOGICAL_BITS) / 1000.0
+
+
+def order_key(message):
+    """Sort key giving every client the same total order of events"""
+    return (message.get('hlc', 0), message.get('username') or '', message.get('sender') or '',
+            message.get('seq') or 0)
+
+
+class HybridLogicalClock:
+    """HLC over time.time(); see the module docstring for thread-safety"""
+
+    def __init__(self, clock=time.time, max_drift=MAX_DRIFT):
+        self.clock = clock
+        self.max_drift = int(max_drift * 1000) << LOGICAL_BITS
+        self.last = 0
+        self.rejected = 0   # remote timestamps ignored as malformed or too far ahead
+
+    def _physical(self):
+        return int(self.clock() * 1000) << LOGICAL_BITS
+
+    def now(self):
+        """Timestamp for a local or send event"""
+        hlc = max(self._physical(), self.last + 1)
+        self.last = hlc
+        return hlc
+
+    def update(self, remote):
+        """Timestamp for an event caused by a message stamped `remote`"""
+        physical = self._physical()
+        if type(remote) is not int or remote < 0 or remote > physical + self.max_drift:
+            if remote is not None:
+                self.rejected += 1
+            remote = 0
+        hlc = max(physical, self.last + 1, remote + 1)
+        self.last = hlc
+        return hlc
+
+
+class ReorderBuffer:
+    """Bounded buffer that releases events in HLC order after a short hold
+
+    An event is released once it has waited `hold` seconds, or at once if
+    the buffer is over `max_size`. Everything ahead of it in HLC order is
+    released first. An event whose sender has an earlier `seq` in the same
+    room still missing waits up to `gap_hold` for it. Events replayed with an
+    already released seq are dropped as duplicates.
+    """
+
+    def __init__(self, hold=0.05, gap_hold=0.5, max_size=1000):
+        self.hold = hold
+        self.gap_hold = gap_hold
+        self.max_size = max_size
+        self.heap = []
+        self.counter = 0        # heap tiebreaker; messages themselves don't compare
+        self.next_seq = {}      # (room, sender id) -> next expected seq
+        self.stats = {'reordered': 0, 'late': 0, 'duplicates': 0, 'gaps': 0}
+        self.last_released = None
+        self.max_pushed = None
+
+    def __len__(self):
+        return len(self.heap)
+
+    def push(self, message, now=None):
+        now = time.time() if now is None else now
+        key = order_key(message)
+        if self.max_pushed is not None and key < self.max_pushed:
+            self.stats['reordered'] += 1    # arrived after an event that sorts later
+        else:
+            self.max_pushed = key
+        self.counter += 1
+        heapq.heappush(self.heap, (key, self.counter, now, message))
+
+    def pop_ready(self, now=None):
+        """Release every event that is due, in order"""
+        now = time.time() if now is None else now
+        released = []
+        while self.heap:
+            key, _, arrived, message = self.heap[0]
+            waited = now - arrived
+            overfull = len(self.heap) > self.max_size
+            if waited < self.hold and not overfull:
+                break
+            # Messages from older servers have no sender id; their username stands in
+            sender, seq = (message.get('room'), key[2] or key[1]), key[3]
+            expected = self.next_seq.get(sender)
+            if seq and expected is not None and seq > expected and waited < self.gap_hold and not overfull:
+                break               # an earlier message from this sender may still arrive
+            heapq.heappop(self.heap)
+
+            if seq and expected is not None:
+                if seq < expected and seq != 1:
+                    self.stats['duplicates'] += 1
+                    continue
+                if seq > expected:
+                    self.stats['gaps'] += 1
+            if seq:
+                self.next_seq[sender] = seq + 1     # seq 1 again means the sender reconnected
+            if self.last_released is not None and key < self.last_released:
+                self.stats['late'] += 1             # arrived after later events were shown
+            self.last_released = key
+            released.append(message)
+        return released
+
+    def flush(self):
+        """Release everything regardless of hold times"""
+        return self.pop_ready(now=float('inf'))
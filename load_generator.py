@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+"""
+Headless load generator for the chat server
+
+Opens thousands of simulated clients from a few worker processes, each
+running one asyncio event loop. Every worker drives its clients with a
+scripted mix of chat / clock_sync / leave+rejoin actions at a target rate,
+and reports:
+
+  - throughput: actions sent and chat deliveries received per second
+  - end-to-end delivery latency (send -> receipt by every other client),
+    p50 / p99 / p999
+  - clock_sync round-trip time and join latency
+
+Chat messages carry their send time, so any other client that receives one
+can compute delivery latency. Everything runs on localhost, so all
+processes share one clock. With --start-server a local server is launched
+with the stub AI responder, so no network or API key is needed.
+
+Usage:
+    python load_generator.py --start-server --clients 2000 --processes 4 --rate 2000 --duration 30
+"""
+
+import argparse
+import asyncio
+import math
+import multiprocessing
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+from protocol import CODECS, JSON_CODEC, FrameDecoder, RECV_BUFFER_SIZE, decode_message, encode_frame
+
+TICK = 0.01             # scheduler resolution in seconds
+MARKER = 'lg'           # prefix of generated chat text: "lg <send_time> <client_id>"
+
+
+class LatencyHistogram:
+    """Log-bucketed histogram (~1% resolution) that merges across processes"""
+
+    GROWTH = 1.01
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.max_value = 0.0
+
+    def record(self, seconds):
+        micros = max(seconds * 1e6, 1.0)
+        bucket = int(math.log(micros, self.GROWTH))
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        if seconds > self.max_value:
+            self.max_value = seconds
+
+    def merge(self, other):
+        for bucket, count in other.buckets.items():
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+        self.count += other.count
+        self.max_value = max(self.max_value, other.max_value)
+
+    def percentile(self, p):
+        """Latency in seconds at percentile p (0-100)"""
+        if not self.count:
+            return None
+        target = math.ceil(self.count * p / 100)
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= target:
+                return self.GROWTH ** (bucket + 1) / 1e6
+        return self.max_value
+
+
+class SimClient:
+    """One simulated connection"""
+
+    def __init__(self, worker, client_id):
+        self.worker = worker
+        self.client_id = client_id
+        self.username = f"load_{client_id}"
+        self.reader = None
+        self.writer = None
+        self.joined = asyncio.Event()
+        self.join_sent_at = 0.0
+        self.reader_task = None
+        self.leaving = False
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.worker.host, self.worker.port)
+        self.joined.clear()
+        self.join_sent_at = time.time()
+        self.send({
+            'type': 'join',
+            'username': self.username,
+            'timestamp': self.join_sent_at,
+            'codecs': [self.worker.codec.name],
+            'history_limit': 0
+        })
+        self.reader_task = asyncio.get_running_loop().create_task(self.read_loop())
+
+    def send(self, message):
+        frame = encode_frame(message, self.worker.codec)
+        self.writer.write(frame)
+        self.worker.stats['bytes_out'] += len(frame)
+
+    async def read_loop(self):
+        decoder = FrameDecoder()
+        worker = self.worker
+        try:
+            while True:
+                data = await self.reader.read(RECV_BUFFER_SIZE)
+                if not data:
+                    break
+                received_at = time.time()
+                worker.stats['bytes_in'] += len(data)
+                for payload in decoder.feed(data):
+                    worker.handle(self, decode_message(payload), received_at)
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            if not worker.stopping and not self.leaving:
+                worker.stats['disconnects'] += 1
+
+    async def leave_and_rejoin(self):
+        self.leaving = True
+        self.send({'type': 'leave', 'username': self.username, 'timestamp': time.time()})
+        self.writer.close()
+        if self.reader_task:
+            self.reader_task.cancel()
+        await self.connect()
+        self.leaving = False
+
+    def close(self):
+        if self.reader_task:
+            self.reader_task.cancel()
+        if self.writer:
+            self.writer.close()
+
+
+class Worker:
+    """Runs a share of the simulated clients on one event loop"""
+
+    def __init__(self, index, args, client_ids):
+        self.index = index
+        self.host = args.host
+        self.port = args.port
+        self.codec = CODECS.get(args.codec, JSON_CODEC)
+        self.duration = args.duration
+        self.rate = args.rate * len(client_ids) / args.clients   # this worker's share
+        self.connect_rate = args.connect_rate / args.processes
+        self.mix = args.mix
+        self.clients = [SimClient(self, client_id) for client_id in client_ids]
+        self.measuring = False
+        self.stopping = False
+
+        self.delivery_latency = LatencyHistogram()
+        self.sync_rtt = LatencyHistogram()
+        self.join_latency = LatencyHistogram()
+        self.stats = {
+            'sent_chat': 0, 'sent_clock_sync': 0, 'sent_churn': 0,
+            'deliveries': 0, 'ai_replies': 0, 'presence': 0,
+            'bytes_in': 0, 'bytes_out': 0, 'disconnects': 0, 'errors': 0
+        }
+
+    def handle(self, client, message, received_at):
+        msg_type = message.get('type')
+        if msg_type == 'chat_message':
+            text = message.get('message') or ''
+            if text.startswith(MARKER + ' '):
+                if self.measuring:
+                    self.stats['deliveries'] += 1
+                    self.delivery_latency.record(received_at - float(text.split(' ', 2)[1]))
+            else:
+                self.stats['ai_replies'] += 1
+        elif msg_type == 'ai_done':
+            self.stats['ai_replies'] += 1
+        elif msg_type == 'clock_sync_response':
+            if self.measuring:
+                self.sync_rtt.record(received_at - message.get('client_request_time', received_at))
+        elif msg_type == 'join_success':
+            self.join_latency.record(received_at - client.join_sent_at)
+            client.joined.set()
+        elif msg_type in ('user_joined', 'user_left'):
+            self.stats['presence'] += 1
+
+    async def run(self):
+        # Connect gradually so presence broadcasts don't arrive as one storm
+        interval = 1.0 / self.connect_rate if self.connect_rate > 0 else 0
+        for client in self.clients:
+            try:
+                await client.connect()
+            except OSError:
+                self.stats['errors'] += 1
+            if interval:
+                await asyncio.sleep(interval)
+        await asyncio.wait_for(
+            asyncio.gather(*(client.joined.wait() for client in self.clients if client.writer)),
+            timeout=60
+        )
+
+        self.measuring = True
+        started = time.time()
+        await self.drive(started + self.duration)
+        elapsed = time.time() - started
+        self.measuring = False
+
+        # Let in-flight deliveries land before closing
+        await asyncio.sleep(0.5)
+        self.stopping = True
+        for client in self.clients:
+            client.close()
+        return elapsed
+
+    async def drive(self, stop_at):
+        """Issue actions at the target rate from randomly chosen clients"""
+        actions, weights = zip(*self.mix)
+        credit = 0.0
+        next_tick = time.time()
+        while time.time() < stop_at:
+            credit += self.rate * TICK
+            count = int(credit)
+            credit -= count
+            for action in random.choices(actions, weights, k=count):
+                client = random.choice(self.clients)
+                if not client.writer or client.writer.is_closing():
+                    continue
+                now = time.time()
+                try:
+                    if action == 'chat':
+                        client.send({'type': 'chat', 'message': f"{MARKER} {now:.6f} {client.client_id}",
+                                     'username': client.username, 'timestamp': now})
+                        self.stats['sent_chat'] += 1
+                    elif action == 'clock_sync':
+                        client.send({'type': 'clock_sync', 'client_time': now})
+                        self.stats['sent_clock_sync'] += 1
+                    elif action == 'churn':
+                        self.stats['sent_churn'] += 1
+                        asyncio.get_running_loop().create_task(client.leave_and_rejoin())
+                except (ConnectionError, OSError):
+                    self.stats['errors'] += 1
+            next_tick += TICK
+            await asyncio.sleep(max(0.0, next_tick - time.time()))
+
+
+def worker_main(index, args, client_ids, results):
+    worker = Worker(index, args, client_ids)
+    try:
+        elapsed = asyncio.run(worker.run())
+    except Exception as e:
+        results.put((index, None, f"{type(e).__name__}: {e}"))
+        return
+    results.put((index, {
+        'elapsed': elapsed,
+        'stats': worker.stats,
+        'delivery_latency': worker.delivery_latency,
+        'sync_rtt': worker.sync_rtt,
+        'join_latency': worker.join_latency
+    }, None))
+
+
+def parse_mix(text):
+    """'chat=80,clock_sync=15,churn=5' -> [('chat', 80.0), ...]"""
+    mix = []
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if name not in ('chat', 'clock_sync', 'churn'):
+            raise argparse.ArgumentTypeError(f"Unknown action in mix: {name}")
+        mix.append((name, float(weight or 1)))
+    return mix
+
+
+def start_local_server(args):
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py'),
+               '--host', args.host, '--port', str(args.port), '--mode', args.server_mode,
+               '--backlog', '4096', '--ai-backend', 'stub',
+               '--ai-stub-latency', str(args.ai_stub_latency), '--no-history',
+               '--nodes', str(args.server_nodes)]
+    server = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    deadline = time.time() + 15
+    while time.time() < deadline:
+        try:
+            with socket.create_connection((args.host, args.port), timeout=0.5):
+                return server
+        except OSError:
+            time.sleep(0.1)
+    server.terminate()
+    raise RuntimeError("Local server did not start")
+
+
+def format_ms(seconds):
+    return "n/a" if seconds is None else f"{seconds * 1000:.2f} ms"
+
+
+def report(args, results):
+    stats = {}
+    delivery, sync_rtt, joins = LatencyHistogram(), LatencyHistogram(), LatencyHistogram()
+    elapsed = 0.0
+    for result in results:
+        for key, value in result['stats'].items():
+            stats[key] = stats.get(key, 0) + value
+        delivery.merge(result['delivery_latency'])
+        sync_rtt.merge(result['sync_rtt'])
+        joins.merge(result['join_latency'])
+        elapsed = max(elapsed, result['elapsed'])
+
+    sent = stats['sent_chat'] + stats['sent_clock_sync'] + stats['sent_churn']
+    print("=" * 60)
+    print(f" Clients: {args.clients} in {args.processes} processes, {elapsed:.1f}s measured")
+    print(f" Sent: {sent} actions ({sent / elapsed:.0f}/s) - chat {stats['sent_chat']}, "
+          f"clock_sync {stats['sent_clock_sync']}, churn {stats['sent_churn']}")
+    print(f" Deliveries: {stats['deliveries']} ({stats['deliveries'] / elapsed:.0f}/s), "
+          f"AI replies {stats['ai_replies']}, presence {stats['presence']}")
+    print(f" Traffic: {stats['bytes_out'] / elapsed / 1024 / 1024:.2f} MB/s out, "
+          f"{stats['bytes_in'] / elapsed / 1024 / 1024:.2f} MB/s in")
+    print(f" Delivery latency: p50 {format_ms(delivery.percentile(50))}  p99 {format_ms(delivery.percentile(99))}  "
+          f"p999 {format_ms(delivery.percentile(99.9))}  max {format_ms(delivery.max_value or None)}")
+    print(f" Clock sync RTT:   p50 {format_ms(sync_rtt.percentile(50))}  p99 {format_ms(sync_rtt.percentile(99))}")
+    print(f" Join latency:     p50 {format_ms(joins.percentile(50))}  p99 {format_ms(joins.percentile(99))}")
+    print(f" Disconnects: {stats['disconnects']}  Errors: {stats['errors']}")
+    print("=" * 60)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless load generator for the chat server")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=50001)
+    parser.add_argument('--clients', type=int, default=1000, help="Total simulated clients")
+    parser.add_argument('--processes', type=int, default=max(1, min(4, os.cpu_count() or 1)))
+    parser.add_argument('--rate', type=float, default=1000, help="Total actions per second across all clients")
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('chat=80,clock_sync=15,churn=5'),
+                        help="Action weights, e.g. chat=80,clock_sync=15,churn=5")
+    parser.add_argument('--duration', type=float, default=30, help="Seconds of measured load")
+    parser.add_argument('--connect-rate', type=float, default=500, help="New connections per second during ramp-up")
+    parser.add_argument('--codec', choices=['json', 'orjson', 'msgpack'], default='json')
+    parser.add_argument('--start-server', action='store_true', help="Launch a local server with the stub AI responder")
+    parser.add_argument('--server-mode', choices=['threaded', 'asyncio'], default='asyncio')
+    parser.add_argument('--server-nodes', type=int, default=1,
+                        help="With --start-server, run a cluster of this many server processes")
+    parser.add_argument('--ai-stub-latency', type=float, default=0.0)
+    args = parser.parse_args()
+
+    server = start_local_server(args) if args.start_server else None
+    try:
+        ids = list(range(args.clients))
+        results = multiprocessing.Queue()
+        processes = [
+            multiprocessing.Process(target=worker_main, args=(i, args, ids[i::args.processes], results))
+            for i in range(args.processes)
+        ]
+        print(f"🚀 Starting {args.clients} clients in {args.processes} processes against {args.host}:{args.port}")
+        for process in processes:
+            process.start()
+
+        collected = []
+        for _ in processes:
+            index, result, error = results.get()
+            if error:
+                print(f"❌ Worker {index} failed: {error}")
+            else:
+                collected.append(result)
+        for process in processes:
+            process.join()
+
+        if collected:
+            report(args, collected)
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    main()
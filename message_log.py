@@ -0,0 +1,380 @@
+"""
+Durable append-only log of chat messages
+
+Messages are appended to numbered segment files in a directory. Every record
+gets a monotonically increasing offset. A background writer thread batches
+records, writes them and fsyncs at most once per `fsync_interval` (group
+commit), so append() is just a queue insert and never blocks the broadcast
+path. Segments rotate at `segment_bytes`. Old segments are deleted once
+there are more than `max_segments` or they are older than
+`retention_seconds`.
+
+If a write or fsync fails, the writer logs the error and stops, and the
+log is marked failed: append() then returns None rather than handing out
+offsets for records that would never reach disk.
+
+Each segment keeps a sparse in-memory index with one (offset, file position,
+timestamp) entry every `index_interval` bytes. A read seeks to the nearest
+entry and scans forward from there.
+
+On-disk record layout:
+
+    length:u32  crc32:u32  offset:u64  timestamp:f64  payload (JSON)
+"""
+
+import bisect
+import os
+import struct
+import threading
+import time
+import zlib
+from collections import deque
+from event_log import log
+from protocol import CODECS, JSON_CODEC, decode_message
+
+RECORD_HEADER = struct.Struct('!IIQd')
+SEGMENT_SUFFIX = '.log'
+STORAGE_CODEC = CODECS.get('orjson', JSON_CODEC)
+
+
+class Segment:
+    """One log file holding a contiguous range of offsets"""
+
+    def __init__(self, directory, base_offset):
+        self.base_offset = base_offset
+        self.path = os.path.join(directory, f"{base_offset:020d}{SEGMENT_SUFFIX}")
+        self.next_offset = base_offset
+        self.size = 0
+        self.last_timestamp = 0.0
+        self.index_offsets = []
+        self.index_positions = []
+        self.index_timestamps = []
+        self.last_indexed_size = None
+
+    def add_record(self, offset, timestamp, position, record_size, index_interval):
+        """Account for a record written at `position`"""
+        if self.last_indexed_size is None or position - self.last_indexed_size >= index_interval:
+            self.index_offsets.append(offset)
+            self.index_positions.append(position)
+            self.index_timestamps.append(timestamp)
+            self.last_indexed_size = position
+        self.next_offset = offset + 1
+        self.size = position + record_size
+        self.last_timestamp = timestamp
+
+    def position_for_offset(self, offset):
+        """File position of the closest indexed record at or before `offset`"""
+        i = bisect.bisect_right(self.index_offsets, offset) - 1
+        return self.index_positions[i] if i >= 0 else 0
+
+    def position_for_timestamp(self, timestamp):
+        """File position of an indexed record no later than the first one at `timestamp`"""
+        i = bisect.bisect_left(self.index_timestamps, timestamp) - 1
+        return self.index_positions[i] if i >= 0 else 0
+
+
+class MessageLog:
+    """Segmented append-only log with group commit and a sparse offset index"""
+
+    def __init__(self, directory, segment_bytes=64 * 1024 * 1024, max_segments=16,
+                 retention_seconds=None, index_interval=4096, fsync_interval=0.05,
+                 max_pending=100000):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_segments = max_segments
+        self.retention_seconds = retention_seconds
+        self.index_interval = index_interval
+        self.fsync_interval = fsync_interval
+        self.max_pending = max_pending
+
+        self.segments = []
+        self.active_file = None
+
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+        self.pending = deque()
+        self.next_offset = 0      # next offset handed out by append()
+        self.written_offset = 0   # records below this are readable
+        self.durable_offset = 0   # records below this are fsynced
+        self.running = False
+        self.failed = False       # the writer hit an error and stopped
+        self.thread = None
+
+        self.stats = {'appended': 0, 'dropped': 0, 'fsyncs': 0, 'bytes_written': 0, 'segments_deleted': 0}
+
+    # ------------------------------------------------------------------
+    # Lifecycle
+
+    def start(self):
+        """Recover existing segments and start the writer thread"""
+        os.makedirs(self.directory, exist_ok=True)
+        self._recover()
+        self.running = True
+        self.thread = threading.Thread(target=self._writer, name="message-log-writer", daemon=True)
+        self.thread.start()
+
+    def close(self):
+        """Flush everything still queued, fsync and stop the writer"""
+        with self.lock:
+            if not self.running:
+                return
+            self.running = False
+            self.ready.notify()
+        self.thread.join()
+        if self.active_file:
+            self.active_file.close()
+            self.active_file = None
+
+    # ------------------------------------------------------------------
+    # Writing
+
+    def append(self, message, timestamp=None):
+        """Queue a message for the log and return its offset
+
+        Returns None if the writer has fallen `max_pending` records behind
+        and the message was dropped rather than blocking the caller, or if
+        the log has failed.
+        """
+        if timestamp is None:
+            timestamp = message.get('timestamp') or time.time()
+        with self.lock:
+            if not self.running:
+                return None
+            if self.failed or len(self.pending) >= self.max_pending:
+                self.stats['dropped'] += 1
+                return None
+            offset = self.next_offset
+            self.next_offset += 1
+            self.pending.append((offset, timestamp, message))
+            self.stats['appended'] += 1
+            self.ready.notify()
+        return offset
+
+    def _writer(self):
+        last_fsync = time.time()
+        unsynced = False
+        while True:
+            with self.lock:
+                while not self.pending and self.running:
+                    # Wake up in time to fsync whatever the last batch left behind
+                    timeout = self.fsync_interval - (time.time() - last_fsync) if unsynced else None
+                    if timeout is not None and timeout <= 0:
+                        break
+                    self.ready.wait(timeout)
+                batch = list(self.pending)
+                self.pending.clear()
+                stopping = not self.running
+
+            try:
+                if batch:
+                    self._write_batch(batch)
+                    unsynced = True
+
+                if unsynced and (stopping or time.time() - last_fsync >= self.fsync_interval):
+                    self._fsync()
+                    last_fsync = time.time()
+                    unsynced = False
+            except Exception as e:
+                with self.lock:
+                    self.failed = True
+                    lost = len(batch) + len(self.pending)
+                    self.stats['dropped'] += lost
+                    self.pending.clear()
+                log.error('history_write_failed', "Chat history log failed, no longer recording history "
+                          "(%d messages lost): %s", lost, e)
+                return
+
+            if stopping and not batch:
+                return
+
+    def _write_batch(self, batch):
+        chunks = []
+        segment = self.segments[-1]
+        for offset, timestamp, message in batch:
+            payload = STORAGE_CODEC.encode(message)
+            record = RECORD_HEADER.pack(len(payload), zlib.crc32(payload), offset, timestamp) + payload
+
+            if segment.size >= self.segment_bytes and segment.next_offset > segment.base_offset:
+                self._flush_chunks(chunks)
+                chunks = []
+                segment = self._rotate(offset)
+
+            segment.add_record(offset, timestamp, segment.size, len(record), self.index_interval)
+            chunks.append(record)
+
+        self._flush_chunks(chunks)
+        with self.lock:
+            self.written_offset = batch[-1][0] + 1
+
+    def _flush_chunks(self, chunks):
+        if not chunks:
+            return
+        data = b''.join(chunks)
+        self.active_file.write(data)
+        self.active_file.flush()
+        self.stats['bytes_written'] += len(data)
+
+    def _fsync(self):
+        os.fsync(self.active_file.fileno())
+        self.stats['fsyncs'] += 1
+        self.durable_offset = self.written_offset
+
+    def _rotate(self, base_offset):
+        """Close the active segment, start a new one and apply retention"""
+        self._fsync()
+        self.active_file.close()
+        segment = Segment(self.directory, base_offset)
+        self.active_file = open(segment.path, 'ab')
+        with self.lock:
+            self.segments.append(segment)
+        self._apply_retention()
+        return segment
+
+    def _apply_retention(self):
+        cutoff = time.time() - self.retention_seconds if self.retention_seconds else None
+        while len(self.segments) > 1:
+            oldest = self.segments[0]
+            too_many = self.max_segments and len(self.segments) > self.max_segments
+            too_old = cutoff is not None and oldest.last_timestamp < cutoff
+            if not (too_many or too_old):
+                break
+            with self.lock:
+                self.segments.pop(0)
+            try:
+                os.remove(oldest.path)
+            except OSError as e:
+                log.warning('history_delete_failed', "Could not delete log segment %s: %s", oldest.path, e)
+            self.stats['segments_deleted'] += 1
+
+    # ------------------------------------------------------------------
+    # Recovery
+
+    def _recover(self):
+        names = sorted(name for name in os.listdir(self.directory) if name.endswith(SEGMENT_SUFFIX))
+        for name in names:
+            segment = Segment(self.directory, int(name[:-len(SEGMENT_SUFFIX)]))
+            valid_size = self._scan_segment(segment)
+            if valid_size < os.path.getsize(segment.path):
+                # Torn write from a crash: drop the partial tail
+                with open(segment.path, 'r+b') as f:
+                    f.truncate(valid_size)
+                log.warning('history_truncated', "Truncated torn record at end of %s", segment.path)
+            self.segments.append(segment)
+
+        if not self.segments:
+            self.segments.append(Segment(self.directory, 0))
+
+        active = self.segments[-1]
+        self.active_file = open(active.path, 'ab')
+        self.next_offset = self.written_offset = self.durable_offset = active.next_offset
+        self._apply_retention()
+
+    def _scan_segment(self, segment):
+        """Rebuild a segment's sparse index; returns the size of its valid prefix"""
+        position = 0
+        with open(segment.path, 'rb') as f:
+            while True:
+                header = f.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    break
+                length, crc, offset, timestamp = RECORD_HEADER.unpack(header)
+                payload = f.read(length)
+                if len(payload) < length or zlib.crc32(payload) != crc:
+                    break
+                record_size = RECORD_HEADER.size + length
+                segment.add_record(offset, timestamp, position, record_size, self.index_interval)
+                position += record_size
+        return position
+
+    # ------------------------------------------------------------------
+    # Reading
+
+    def first_offset(self):
+        with self.lock:
+            return self.segments[0].base_offset
+
+    def end_offset(self):
+        """Offset one past the last readable record"""
+        with self.lock:
+            return self.written_offset
+
+    def read(self, start_offset, limit):
+        """Return up to `limit` (offset, message) pairs starting at `start_offset`"""
+        with self.lock:
+            end = self.written_offset
+            segments = list(self.segments)
+        start_offset = max(start_offset, segments[0].base_offset)
+        if limit <= 0 or start_offset >= end:
+            return []
+
+        bases = [segment.base_offset for segment in segments]
+        i = max(bisect.bisect_right(bases, start_offset) - 1, 0)
+        records = []
+        for segment in segments[i:]:
+            position = segment.position_for_offset(start_offset)
+            records.extend(self._scan(segment, position, start_offset, end, limit - len(records)))
+            if len(records) >= limit:
+                break
+        return records
+
+    def offset_for_timestamp(self, timestamp):
+        """First offset whose record timestamp is >= `timestamp`"""
+        with self.lock:
+            end = self.written_offset
+            segments = list(self.segments)
+        for segment in segments:
+            if segment.next_offset > segment.base_offset and segment.last_timestamp >= timestamp:
+                position = segment.position_for_timestamp(timestamp)
+                for offset, record_ts in self._scan_headers(segment, position, end):
+                    if record_ts >= timestamp:
+                        return offset
+        return end
+
+    def _scan(self, segment, position, start_offset, end_offset, limit):
+        records = []
+        try:
+            with open(segment.path, 'rb') as f:
+                f.seek(position)
+                while len(records) < limit:
+                    header = f.read(RECORD_HEADER.size)
+                    if len(header) < RECORD_HEADER.size:
+                        break
+                    length, _, offset, _ = RECORD_HEADER.unpack(header)
+                    if offset >= end_offset:
+                        break
+                    if offset < start_offset:
+                        f.seek(length, os.SEEK_CUR)
+                        continue
+                    records.append((offset, decode_message(f.read(length))))
+        except FileNotFoundError:
+            pass  # deleted by retention while we were reading
+        return records
+
+    def _scan_headers(self, segment, position, end_offset):
+        try:
+            with open(segment.path, 'rb') as f:
+                f.seek(position)
+                while True:
+                    header = f.read(RECORD_HEADER.size)
+                    if len(header) < RECORD_HEADER.size:
+                        return
+                    length, _, offset, timestamp = RECORD_HEADER.unpack(header)
+                    if offset >= end_offset:
+                        return
+                    yield offset, timestamp
+                    f.seek(length, os.SEEK_CUR)
+        except FileNotFoundError:
+            return
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats.update({
+                'failed': self.failed,
+                'segments': len(self.segments),
+                'pending': len(self.pending),
+                'next_offset': self.next_offset,
+                'written_offset': self.written_offset,
+                'durable_offset': self.durable_offset
+            })
+        return stats
@@ -0,0 +1,243 @@
+"""
+Server metrics in the Prometheus text format
+
+Counters and histograms are updated on the hot path, from many threads.
+An update only appends to a deque (atomic in CPython, no lock). Appended
+updates are folded into the totals under a lock when scraped, or by
+the updating thread once FOLD_AT of them are pending. Values that already live
+somewhere else (client counts, outbound queues, AI pool stats) are read
+only when scraped, through callbacks registered with `gauge()` or
+`counter_func()`.
+
+Each metric has at most one label. Its values must come from a small
+fixed set, never straight from client input.
+
+MetricsServer serves `GET /metrics` from a background thread:
+
+    curl http://127.0.0.1:50004/metrics
+"""
+
+import abc
+import threading
+from bisect import bisect_left
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Seconds; fine-grained at the low end where handlers and fan-out live
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+FOLD_AT = 4096      # pending updates that make the updating thread fold them
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class _BatchedMetric(abc.ABC):
+    """Queues (label value, number) updates and folds them in batches"""
+
+    def __init__(self, name, help, label=None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.pending = deque()
+        self.lock = threading.Lock()
+
+    @abc.abstractmethod
+    def _fold(self):
+        """Apply pending updates to the totals; folders take the lock, so only they pop"""
+
+
+class Counter(_BatchedMetric):
+    """Monotonic count, optionally split by one label"""
+
+    kind = 'counter'
+
+    def __init__(self, name, help, label=None):
+        super().__init__(name, help, label)
+        self.values = {}
+
+    def inc(self, label_value=None, amount=1):
+        pending = self.pending
+        pending.append((label_value, amount))
+        if len(pending) > FOLD_AT:
+            self._fold()
+
+    def _fold(self):
+        with self.lock:
+            popleft = self.pending.popleft
+            values = self.values
+            for _ in range(len(self.pending)):
+                label_value, amount = popleft()
+                values[label_value] = values.get(label_value, 0) + amount
+
+    def samples(self):
+        self._fold()
+        with self.lock:
+            values = dict(self.values)
+        for label_value, value in values.items():
+            labels = {self.label: label_value} if self.label else {}
+            yield self.name, labels, value
+
+
+class Histogram(_BatchedMetric):
+    """Bucketed distribution of observed values, optionally split by one label"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS, label=None):
+        super().__init__(name, help, label)
+        self.bounds = tuple(buckets)
+        self.series = {}    # label value -> [bucket counts..., sum, count]
+
+    def observe(self, value, label_value=None):
+        pending = self.pending
+        pending.append((label_value, value))
+        if len(pending) > FOLD_AT:
+            self._fold()
+
+    def _fold(self):
+        with self.lock:
+            popleft = self.pending.popleft
+            bounds = self.bounds
+            all_series = self.series
+            for _ in range(len(self.pending)):
+                label_value, value = popleft()
+                series = all_series.get(label_value)
+                if series is None:
+                    series = all_series[label_value] = [0] * (len(bounds) + 3)
+                series[bisect_left(bounds, value)] += 1
+                series[-2] += value
+                series[-1] += 1
+
+    def samples(self):
+        self._fold()
+        with self.lock:
+            series = {key: list(values) for key, values in self.series.items()}
+        for label_value, values in series.items():
+            labels = {self.label: label_value} if self.label else {}
+            cumulative = 0
+            for bound, count in zip(self.bounds + (float('inf'),), values):
+                cumulative += count
+                yield self.name + '_bucket', dict(labels, le=_format_value(float(bound))), cumulative
+            yield self.name + '_sum', labels, values[-2]
+            yield self.name + '_count', labels, values[-1]
+
+    def counts(self):
+        """Number of observations per label value"""
+        self._fold()
+        with self.lock:
+            return {label_value: values[-1] for label_value, values in self.series.items()}
+
+
+class CallbackMetric:
+    """Value read at scrape time: a number, or {label value: number}"""
+
+    def __init__(self, kind, name, help, func, label=None):
+        self.kind = kind
+        self.name = name
+        self.help = help
+        self.func = func
+        self.label = label
+
+    def samples(self):
+        value = self.func()
+        if value is None:
+            return
+        if isinstance(value, dict):
+            for label_value, number in value.items():
+                yield self.name, {self.label: label_value}, number
+        else:
+            yield self.name, {}, value
+
+
+class MetricsRegistry:
+    """Named metrics rendered together for a scrape"""
+
+    def __init__(self):
+        self.metrics = []
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, label=None):
+        return self._add(Counter(name, help, label))
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS, label=None):
+        return self._add(Histogram(name, help, buckets, label))
+
+    def gauge(self, name, help, func, label=None):
+        return self._add(CallbackMetric('gauge', name, help, func, label))
+
+    def counter_func(self, name, help, func, label=None):
+        """A counter whose total is kept elsewhere and read at scrape time"""
+        return self._add(CallbackMetric('counter', name, help, func, label))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            try:
+                samples = list(metric.samples())
+            except Exception as e:
+                lines.append(f"# {metric.name} unavailable: {_escape(e)}")
+                continue
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in samples:
+                if labels:
+                    label_text = ','.join(f'{key}="{_escape(val)}"' for key, val in labels.items())
+                    lines.append(f"{name}{{{label_text}}} {_format_value(value)}")
+                else:
+                    lines.append(f"{name} {_format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsServer:
+    """Serves a registry at GET /metrics on a background thread"""
+
+    def __init__(self, registry, host, port):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self.httpd = None
+        self.thread = None
+
+    def start(self):
+        registry = self.registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass    # scrapes every few seconds would flood the console
+
+        self.httpd = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="metrics-http", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
@@ -13,36 +13,20 @@ def start_server():
     """Start the chat server"""
     print("🚀 Starting ChatGPT Server...")
     try:
-        # Use the virtual environment Python
-        venv_python = "/Users/aarushkumar/Desktop/College/Distributed Systems/Whatsapp Client Server Interaction/.venv/bin/python"
-        
+        # Use the interpreter running this launcher (respects an active venv)
         if sys.platform == "darwin":  # macOS
             server_cmd = [
                 'osascript', '-e',
-                f'tell app "Terminal" to do script "cd \\"{os.getcwd()}\\" && \\"{venv_python}\\" server.py"'
+                f'tell app "Terminal" to do script "cd \\"{os.getcwd()}\\" && \\"{sys.executable}\\" server.py"'
             ]
             subprocess.run(server_cmd)
         else:  # Linux/Windows
-            subprocess.Popen([venv_python, "server.py"])
+            subprocess.Popen([sys.executable, "server.py"])
         print("✅ ChatGPT Server started successfully")
         return True
     except Exception as e:
         print(f"❌ Error starting server: {e}")
-        print("💡 Trying with regular python3...")
-        try:
-            if sys.platform == "darwin":  # macOS
-                server_cmd = [
-                    'osascript', '-e',
-                    f'tell app "Terminal" to do script "cd \\"{os.getcwd()}\\" && python3 server.py"'
-                ]
-                subprocess.run(server_cmd)
-            else:
-                subprocess.Popen([sys.executable, "server.py"])
-            print("✅ Server started with python3")
-            return True
-        except Exception as e2:
-            print(f"❌ Error starting server with python3: {e2}")
-            return False
+        return False
 
 def start_client():
     """Start a chat client"""
@@ -55,6 +39,18 @@ def start_client():
         print(f"❌ Error starting client: {e}")
         return False
 
+def start_load_test():
+    """Run the headless load generator against a local stub-AI server"""
+    clients = input("How many simulated clients? (default 1000): ").strip() or "1000"
+    rate = input("Target actions per second? (default 1000): ").strip() or "1000"
+    try:
+        subprocess.run([
+            sys.executable, "load_generator.py", "--start-server",
+            "--clients", str(int(clients)), "--rate", str(float(rate)), "--duration", "30"
+        ])
+    except ValueError:
+        print("❌ Invalid number")
+
 def main():
     print("=" * 70)
     print("🤖 WhatsApp Clone - ChatGPT Multi-Client Chat Application")
@@ -75,9 +71,10 @@ Choose an option:
 2. Start Client only  
 3. Start Server + 1 Client
 4. Start Server + Multiple Clients
-5. Exit
+5. Headless load test (thousands of simulated clients)
+6. Exit
 
-Enter your choice (1-5): """).strip()
+Enter your choice (1-6): """).strip()
         
         if choice == "1":
             start_server()
@@ -114,6 +111,10 @@ Enter your choice (1-5): """).strip()
             input("\nPress Enter to continue...")
             
         elif choice == "5":
+            start_load_test()
+            input("\nPress Enter to continue...")
+            
+        elif choice == "6":
             print("👋 Goodbye!")
             break
             
@@ -0,0 +1,186 @@
+"""
+Per-client outbound queues
+
+Every connection gets a bounded queue of encoded frames drained by its own
+writer, so a client with a full TCP window only delays itself: broadcast
+just appends to each queue and moves on. When a queue is full the overflow
+policy decides between dropping the oldest pending frame and disconnecting
+the slow consumer.
+
+Queued frames are immutable bytes and may be shared: a broadcast puts the
+same object into every recipient's queue.
+"""
+
+import abc
+import asyncio
+import socket
+import threading
+from collections import deque
+from protocol import JSON_CODEC, send_frames
+
+DROP_OLDEST = 'drop_oldest'
+DISCONNECT = 'disconnect'
+OVERFLOW_POLICIES = (DROP_OLDEST, DISCONNECT)
+
+
+class SlowConsumerError(ConnectionError):
+    """Raised when a full outbound queue means the client must be disconnected"""
+
+
+class Outbox(abc.ABC):
+    """Bounded frame queue with overflow policy and delivery counters"""
+
+    def __init__(self, max_depth=1000, policy=DROP_OLDEST):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {policy}")
+        self.max_depth = max_depth
+        self.policy = policy
+        self.frames = deque()
+        self.lock = threading.Lock()
+        self.closed = False
+        self.codec = JSON_CODEC  # switched by the join handshake
+
+        self.high_watermark = 0
+        self.dropped = 0
+        self.sent_frames = 0
+        self.sent_bytes = 0
+
+    def put(self, frame):
+        """Queue an encoded frame for delivery"""
+        with self.lock:
+            if self.closed:
+                raise ConnectionResetError("Connection is closed")
+
+            if len(self.frames) >= self.max_depth:
+                if self.policy == DISCONNECT:
+                    self.closed = True
+                    self.frames.clear()
+                    self._wake()
+                    raise SlowConsumerError(f"Outbound queue exceeded {self.max_depth} frames")
+                self.frames.popleft()
+                self.dropped += 1
+
+            self.frames.append(frame)
+            if len(self.frames) > self.high_watermark:
+                self.high_watermark = len(self.frames)
+            self._wake()
+
+    def close(self):
+        """Stop the writer and discard anything still queued"""
+        with self.lock:
+            self.closed = True
+            self.frames.clear()
+            self._wake()
+
+    def depth(self):
+        return len(self.frames)
+
+    def get_stats(self):
+        return {
+            'depth': len(self.frames),
+            'max_depth': self.max_depth,
+            'high_watermark': self.high_watermark,
+            'dropped': self.dropped,
+            'sent_frames': self.sent_frames,
+            'sent_bytes': self.sent_bytes
+        }
+
+    def _take_batch(self):
+        """Remove and return every queued frame; caller holds the lock"""
+        batch = list(self.frames)
+        self.frames.clear()
+        return batch
+
+    def _record_sent(self, batch):
+        self.sent_frames += len(batch)
+        self.sent_bytes += sum(map(len, batch))
+
+    @abc.abstractmethod
+    def _wake(self):
+        """Tell the writer that frames are waiting"""
+
+
+class ThreadedOutbox(Outbox):
+    """Outbox drained by a dedicated writer thread for one blocking socket"""
+
+    def __init__(self, sock, max_depth=1000, policy=DROP_OLDEST):
+        super().__init__(max_depth=max_depth, policy=policy)
+        self.sock = sock
+        self.ready = threading.Condition(self.lock)
+        self.thread = threading.Thread(target=self._writer, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def _wake(self):
+        self.ready.notify()
+
+    def _writer(self):
+        while True:
+            with self.ready:
+                while not self.frames and not self.closed:
+                    self.ready.wait()
+                if self.closed:
+                    return
+                batch = self._take_batch()
+
+            # Everything queued since the last write goes out in one syscall
+            try:
+                send_frames(self.sock, batch)
+            except OSError:
+                self.close()
+                self._shutdown_socket()
+                return
+            self._record_sent(batch)
+
+    def _shutdown_socket(self):
+        """Wake the reader thread so the normal disconnect path runs"""
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class AsyncOutbox(Outbox):
+    """Outbox drained by a writer task for one asyncio StreamWriter
+
+    put() must be called on the event loop thread.
+    """
+
+    def __init__(self, writer, max_depth=1000, policy=DROP_OLDEST):
+        super().__init__(max_depth=max_depth, policy=policy)
+        self.writer = writer
+        self.ready = asyncio.Event()
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.get_running_loop().create_task(self._writer())
+
+    def close(self):
+        super().close()
+        if self.task is not None:
+            self.task.cancel()
+
+    def _wake(self):
+        self.ready.set()
+
+    async def _writer(self):
+        try:
+            while True:
+                await self.ready.wait()
+                self.ready.clear()
+                with self.lock:
+                    if self.closed:
+                        return
+                    batch = self._take_batch()
+                if not batch:
+                    continue
+
+                self.writer.writelines(batch)
+                await self.writer.drain()
+                self._record_sent(batch)
+        except (ConnectionError, OSError):
+            with self.lock:
+                self.closed = True
+                self.frames.clear()
+            self.writer.close()
@@ -0,0 +1,287 @@
+"""
+Wire protocol shared by server.py and client.py
+
+Every message travels as a length-prefixed frame: a 4-byte big-endian
+payload length followed by the encoded payload. TCP is a byte stream, so
+the receiving side feeds whatever recv() returned into a FrameDecoder and
+gets back every complete frame it contains.
+
+Payload codecs are negotiated in the join handshake: the client lists the
+codecs it supports in `codecs` and the server answers with the one it
+picked in `join_success`. Payloads are self-describing (JSON always starts
+with '{', MessagePack maps never do), so a receiver decodes any frame
+regardless of what was negotiated and peers can switch codecs at any time.
+Clients that don't offer any codecs get plain JSON, as before.
+"""
+
+import json
+import struct
+import threading
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+HEADER = struct.Struct('!I')
+HEADER_SIZE = HEADER.size
+MAX_FRAME_SIZE = 16 * 1024 * 1024  # 16 MB, far above any chat payload
+RECV_BUFFER_SIZE = 64 * 1024
+IOV_MAX = 1024  # buffers per sendmsg() call, the common POSIX limit
+
+
+class FrameError(Exception):
+    """Raised when the byte stream cannot be split into valid frames"""
+
+
+class JsonCodec:
+    """Standard library JSON, understood by every client"""
+
+    name = 'json'
+
+    def encode(self, message):
+        return json.dumps(message, ensure_ascii=False).encode('utf-8')
+
+
+class OrjsonCodec:
+    """Same JSON on the wire, produced by the much faster orjson"""
+
+    name = 'orjson'
+
+    def encode(self, message):
+        return orjson.dumps(message)
+
+
+# Compact binary encoding: short keys, redundant fields left out
+SHORT_KEYS = {
+    'type': 't',
+    'username': 'u',
+    'message': 'm',
+    'timestamp': 'ts',
+    'server_time': 'st',
+    'client_time': 'ct',
+    'client_request_time': 'cr',
+    'server_receive_time': 'sr',
+    'processing_time': 'pt',
+    'estimated_rtt': 'rtt',
+    'clients_count': 'n',
+    'codecs': 'cs',
+    'codec': 'c',
+    'offset': 'o',
+    'messages': 'ms',
+    'before_offset': 'bo',
+    'has_more': 'hm',
+    'time_port': 'tp',
+    'hlc': 'h',
+    'seq': 'q',
+    'sender': 'sn',
+    'room': 'r'
+}
+LONG_KEYS = {short: key for key, short in SHORT_KEYS.items()}
+REDUNDANT_FIELDS = frozenset(['sender_address'])
+
+
+def _compact(message):
+    """Shorten keys and drop redundant fields; recurses only into containers"""
+    compact = {}
+    for key, value in message.items():
+        if key in REDUNDANT_FIELDS:
+            continue
+        if value.__class__ is dict:
+            value = _compact(value)
+        elif value.__class__ in (list, tuple):
+            value = [_compact(item) if item.__class__ is dict else item for item in value]
+        compact[SHORT_KEYS.get(key, key)] = value
+    return compact
+
+
+def _expand(message):
+    """Inverse of _compact"""
+    expanded = {}
+    for key, value in message.items():
+        if value.__class__ is dict:
+            value = _expand(value)
+        elif value.__class__ is list:
+            value = [_expand(item) if item.__class__ is dict else item for item in value]
+        expanded[LONG_KEYS.get(key, key)] = value
+    return expanded
+
+
+class MsgpackCodec:
+    """MessagePack with short field keys"""
+
+    name = 'msgpack'
+
+    def encode(self, message):
+        return msgpack.packb(_compact(message), use_bin_type=True)
+
+
+JSON_CODEC = JsonCodec()
+
+# Preference order: smallest and fastest first
+CODECS = {codec.name: codec for codec, available in (
+    (MsgpackCodec(), msgpack is not None),
+    (OrjsonCodec(), orjson is not None),
+    (JSON_CODEC, True)
+) if available}
+
+
+def available_codecs():
+    """Names of the codecs usable in this process, most preferred first"""
+    return list(CODECS)
+
+
+def negotiate_codec(offered, supported=None):
+    """Pick the first codec in the peer's preference list that we also support"""
+    supported = CODECS if supported is None else supported
+    for name in offered or ():
+        if name in supported:
+            return supported[name]
+    return JSON_CODEC
+
+
+def encode_message(message, codec=JSON_CODEC):
+    """Serialize a message dict to payload bytes"""
+    return codec.encode(message)
+
+
+_json_loads = orjson.loads if orjson is not None else json.loads
+
+
+def decode_message(payload):
+    """Deserialize a payload in any supported codec back into a message dict
+
+    Raises ValueError if the payload is malformed or uses a codec this
+    process doesn't have.
+    """
+    if payload[:1] == b'{':
+        return _json_loads(payload)
+    if msgpack is None:
+        raise ValueError("Binary payload received but msgpack is not installed")
+    try:
+        message = msgpack.unpackb(payload, raw=False)
+    except Exception as e:
+        raise ValueError(f"Invalid MessagePack payload: {e}") from e
+    if not isinstance(message, dict):
+        raise ValueError("MessagePack payload is not a map")
+    return _expand(message)
+
+
+def encode_frame(message, codec=JSON_CODEC):
+    """Serialize a message dict into a complete length-prefixed frame"""
+    payload = codec.encode(message)
+    return HEADER.pack(len(payload)) + payload
+
+
+class FrameCache:
+    """Encodes one message at most once per codec, for broadcasts"""
+
+    __slots__ = ('message', 'frames')
+
+    def __init__(self, message):
+        self.message = message
+        self.frames = {}
+
+    def frame(self, codec):
+        frame = self.frames.get(codec.name)
+        if frame is None:
+            frame = self.frames[codec.name] = encode_frame(self.message, codec)
+        return frame
+
+
+class FrameDecoder:
+    """Incremental decoder that splits a TCP byte stream into frame payloads"""
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        self.max_frame_size = max_frame_size
+        self._buffer = bytearray()
+
+    def feed(self, data):
+        """Append received bytes and return the payloads of all complete frames"""
+        buffer = self._buffer
+        buffer += data
+
+        payloads = []
+        pos = 0
+        end = len(buffer)
+
+        while end - pos >= HEADER_SIZE:
+            (length,) = HEADER.unpack_from(buffer, pos)
+            if length > self.max_frame_size:
+                raise FrameError(f"Frame of {length} bytes exceeds limit of {self.max_frame_size}")
+
+            start = pos + HEADER_SIZE
+            if end - start < length:
+                break
+
+            payloads.append(bytes(buffer[start:start + length]))
+            pos = start + length
+
+        # Drop consumed bytes once per recv() instead of once per frame
+        if pos:
+            del buffer[:pos]
+
+        return payloads
+
+    def pending_bytes(self):
+        """Number of buffered bytes belonging to an incomplete frame"""
+        return len(self._buffer)
+
+
+class FrameWriter:
+    """Writes whole frames to a socket that several threads may share"""
+
+    def __init__(self, sock, codec=JSON_CODEC):
+        self.sock = sock
+        self.codec = codec
+        self._lock = threading.Lock()
+
+    def send(self, message):
+        """Encode and send a message dict with the current codec"""
+        self.send_frame(encode_frame(message, self.codec))
+
+    def send_frame(self, frame):
+        """Send an already encoded frame without interleaving with other writers"""
+        with self._lock:
+            self.sock.sendall(frame)
+
+    def send_frames(self, frames):
+        """Send several encoded frames back to back in as few syscalls as possible"""
+        with self._lock:
+            send_frames(self.sock, frames)
+
+
+def send_message(sock, message, codec=JSON_CODEC):
+    """Encode and send a single message on a socket owned by one thread"""
+    sock.sendall(encode_frame(message, codec))
+
+
+def send_frames(sock, frames):
+    """Send a batch of frames with scatter-gather I/O
+
+    Frames are handed to sendmsg() as-is, so a broadcast frame shared by many
+    connections is never copied into a per-connection buffer. Partial writes
+    resume from a memoryview slice. Falls back to one sendall() where
+    sendmsg() is unavailable.
+    """
+    if not hasattr(sock, 'sendmsg'):
+        sock.sendall(b''.join(frames))
+        return
+
+    pending = [memoryview(frame) for frame in frames]
+    while pending:
+        chunk = pending[:IOV_MAX]
+        sent = sock.sendmsg(chunk)
+        # Skip fully written buffers, then trim the partially written one
+        done = 0
+        while done < len(chunk) and sent >= len(chunk[done]):
+            sent -= len(chunk[done])
+            done += 1
+        del pending[:done]
+        if sent:
+            pending[0] = pending[0][sent:]
@@ -0,0 +1,92 @@
+"""
+Token-bucket rate limits for AI requests
+
+Each user has a bucket holding up to `user_burst` tokens that refills at
+`user_rate` tokens per second; one shared bucket does the same for the
+whole server with `global_rate` / `global_burst`. A request takes a token
+from both or is refused straight away, so a flood costs one dict lookup
+per message instead of a queued upstream call. A rate of None means no
+limit at that level.
+
+Buckets of users who have been idle long enough to be full again carry
+no state worth keeping and are pruned once there are many of them.
+"""
+
+import threading
+import time
+
+USER = 'user'
+GLOBAL = 'global'
+PRUNE_AT = 10000    # user buckets kept before full ones are dropped
+
+
+class TokenBucket:
+    """`burst` tokens at most, refilled at `rate` per second"""
+
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst, now=None):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic() if now is None else now
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_take(self, now):
+        self.refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def give_back(self):
+        self.tokens = min(self.burst, self.tokens + 1)
+
+
+class RateLimiter:
+    """Per-key and global token buckets; safe to use from several threads"""
+
+    def __init__(self, user_rate=None, user_burst=1, global_rate=None, global_burst=1):
+        self.user_rate = user_rate
+        self.user_burst = max(1, user_burst)
+        self.buckets = {}   # key -> TokenBucket
+        self.global_bucket = TokenBucket(global_rate, max(1, global_burst)) if global_rate else None
+        self.lock = threading.Lock()
+        self.stats = {'allowed': 0, USER: 0, GLOBAL: 0}
+
+    def acquire(self, key):
+        """Take a token for key; returns None if allowed, else USER or GLOBAL for the limit hit"""
+        now = time.monotonic()
+        with self.lock:
+            bucket = None
+            if self.user_rate:
+                bucket = self.buckets.get(key)
+                if bucket is None:
+                    if len(self.buckets) >= PRUNE_AT:
+                        self._prune(now)
+                    bucket = self.buckets[key] = TokenBucket(self.user_rate, self.user_burst, now)
+                if not bucket.try_take(now):
+                    self.stats[USER] += 1
+                    return USER
+            if self.global_bucket is not None and not self.global_bucket.try_take(now):
+                if bucket is not None:
+                    bucket.give_back()  # the user didn't get anything for it
+                self.stats[GLOBAL] += 1
+                return GLOBAL
+            self.stats['allowed'] += 1
+            return None
+
+    def _prune(self, now):
+        for key, bucket in list(self.buckets.items()):
+            bucket.refill(now)
+            if bucket.tokens >= bucket.burst:
+                del self.buckets[key]
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats['tracked_users'] = len(self.buckets)
+        return stats
@@ -0,0 +1,128 @@
+"""
+Registry of connected clients, indexed by connection and by username
+
+Handler threads add and remove clients while other threads broadcast to
+them. Connections are spread over shards, each a dict with its own lock,
+so joins and leaves mostly don't contend. Readers never take a lock:
+iteration walks per-shard snapshot tuples that are rebuilt only after
+their shard changes (copy-on-write), so a broadcast can't hit "dictionary
+changed size during iteration" and a large fan-out doesn't block joins.
+Lookups by connection are plain dict reads.
+
+The username index maps each name to the tuple of its connections (the
+same user may be connected more than once), so a direct message is
+routed without looking at anyone else.
+"""
+
+import threading
+from itertools import chain
+
+DEFAULT_SHARDS = 16
+
+
+class _Shard:
+    __slots__ = ('lock', 'clients', 'snapshot')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clients = {}       # conn -> client info dict
+        self.snapshot = None    # tuple of conns, None after a change
+
+
+class ClientRegistry:
+    """Thread-safe conn -> client info map with a username index"""
+
+    def __init__(self, shards=DEFAULT_SHARDS):
+        self.shards = [_Shard() for _ in range(shards)]
+        self.usernames = {}     # username -> tuple of conns
+        self.username_lock = threading.Lock()
+
+    def _shard(self, conn):
+        return self.shards[hash(conn) % len(self.shards)]
+
+    def add(self, conn, info):
+        """Register a connection (replacing any previous entry for it)
+
+        If the username can't be indexed (it isn't hashable), the registry
+        is left as it was and the error is raised.
+        """
+        shard = self._shard(conn)
+        with shard.lock:
+            previous = shard.clients.get(conn)
+            shard.clients[conn] = info
+            shard.snapshot = None
+        if previous is not None:
+            self._unindex(previous.get('username'), conn)
+        try:
+            self._index(info.get('username'), conn)
+        except Exception:
+            with shard.lock:
+                if previous is None:
+                    shard.clients.pop(conn, None)
+                else:
+                    shard.clients[conn] = previous
+                shard.snapshot = None
+            if previous is not None:
+                self._index(previous.get('username'), conn)
+            raise
+
+    def remove(self, conn):
+        """Unregister a connection; returns its info, or None if it wasn't registered"""
+        shard = self._shard(conn)
+        with shard.lock:
+            info = shard.clients.pop(conn, None)
+            if info is None:
+                return None
+            shard.snapshot = None
+        try:
+            self._unindex(info.get('username'), conn)
+        except TypeError:
+            pass    # an unhashable name was never indexed; the connection is gone either way
+        return info
+
+    def _index(self, username, conn):
+        with self.username_lock:
+            self.usernames[username] = self.usernames.get(username, ()) + (conn,)
+
+    def _unindex(self, username, conn):
+        with self.username_lock:
+            conns = tuple(c for c in self.usernames.get(username, ()) if c is not conn)
+            if conns:
+                self.usernames[username] = conns
+            else:
+                self.usernames.pop(username, None)
+
+    def get(self, conn, default=None):
+        return self._shard(conn).clients.get(conn, default)
+
+    def __getitem__(self, conn):
+        return self._shard(conn).clients[conn]
+
+    def __contains__(self, conn):
+        return conn in self._shard(conn).clients
+
+    def __len__(self):
+        return sum(len(shard.clients) for shard in self.shards)
+
+    def _snapshot(self, shard):
+        snapshot = shard.snapshot
+        if snapshot is None:
+            with shard.lock:
+                snapshot = shard.snapshot = tuple(shard.clients)
+        return snapshot
+
+    def __iter__(self):
+        """Iterate over connections as of now; later changes are not seen"""
+        return chain.from_iterable([self._snapshot(shard) for shard in self.shards])
+
+    def by_username(self, username):
+        """Every connection logged in as `username` (usually zero or one)"""
+        return self.usernames.get(username, ())
+
+    def clear(self):
+        for shard in self.shards:
+            with shard.lock:
+                shard.clients.clear()
+                shard.snapshot = None
+        with self.username_lock:
+            self.usernames.clear()
@@ -0,0 +1,185 @@
+"""
+Bounded LRU + TTL cache for AI replies
+
+Many prompts repeat ("hi", "hello", "thanks"), and each upstream call
+costs seconds and quota. ResponseCache keeps recent replies by key:
+
+  - entries expire `ttl` seconds after they were stored
+  - the least recently used entries are evicted beyond `max_entries`
+    or beyond `max_bytes` of (approximate) memory
+  - misses are single-flight: while one thread computes a key, others
+    asking for it wait for that result instead of calling upstream too
+  - with a `path`, entries are saved on `save()` (at shutdown) and
+    loaded again on startup, keeping their original expiry
+
+Only successful results are stored; if the computation raises, every
+waiter gets the exception and the next request tries again.
+"""
+
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from event_log import log
+
+ENTRY_OVERHEAD = 200    # rough bytes per entry besides its key and value
+
+
+def normalize_prompt(text):
+    """Case, spacing and trailing '!' or '.' don't make a different prompt"""
+    return ' '.join(text.casefold().split()).rstrip('!. ')
+
+
+class _Flight:
+    """A miss being computed; waiters block on `done`"""
+
+    __slots__ = ('done', 'value', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class ResponseCache:
+    """Thread-safe string -> string cache with LRU eviction, TTL and single-flight misses"""
+
+    def __init__(self, max_entries=1000, max_bytes=16 * 1024 * 1024, ttl=3600.0, path=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.path = path
+        self.entries = OrderedDict()    # key -> (value, expires_at, size); least recently used first
+        self.flights = {}               # key -> _Flight
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'coalesced': 0, 'evicted': 0, 'expired': 0}
+        if path:
+            self.load()
+
+    def _lookup(self, key, now):
+        """Value for key, or None; call with the lock held"""
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[1] <= now:
+            self._discard(key)
+            self.stats['expired'] += 1
+            return None
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def _discard(self, key):
+        self.bytes -= self.entries.pop(key)[2]
+
+    def _store(self, key, value, expires_at):
+        """Insert as most recently used and evict down to the caps; call with the lock held"""
+        if key in self.entries:
+            self._discard(key)
+        size = len(key) + len(value.encode('utf-8')) + ENTRY_OVERHEAD
+        if size > self.max_bytes:
+            return
+        self.entries[key] = (value, expires_at, size)
+        self.bytes += size
+        while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+            self._discard(next(iter(self.entries)))
+            self.stats['evicted'] += 1
+
+    def get(self, key):
+        with self.lock:
+            value = self._lookup(key, time.time())
+            self.stats['hits' if value is not None else 'misses'] += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self._store(key, value, time.time() + self.ttl)
+
+    def get_or_compute(self, key, compute, timeout=None):
+        """Cached value for key, or compute() it once for every concurrent caller
+
+        Callers that find the key already being computed wait up to
+        `timeout` seconds for it, then raise TimeoutError.
+        """
+        with self.lock:
+            value = self._lookup(key, time.time())
+            if value is not None:
+                self.stats['hits'] += 1
+                return value
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = _Flight()
+                self.stats['misses'] += 1
+            else:
+                self.stats['coalesced'] += 1
+
+        if not leader:
+            if not flight.done.wait(timeout):
+                raise TimeoutError(f"Gave up waiting {timeout:.2f}s for an identical request in flight")
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = compute()
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                if flight.value is not None:
+                    self._store(key, flight.value, time.time() + self.ttl)
+                del self.flights[key]
+            flight.done.set()
+        return flight.value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def save(self):
+        """Write unexpired entries to `path`, least recently used first"""
+        if not self.path:
+            return
+        now = time.time()
+        with self.lock:
+            entries = [[key, value, expires_at] for key, (value, expires_at, _) in self.entries.items()
+                       if expires_at > now]
+        temporary = self.path + '.tmp'
+        try:
+            with open(temporary, 'w', encoding='utf-8') as f:
+                json.dump({'version': 1, 'entries': entries}, f, ensure_ascii=False)
+            os.replace(temporary, self.path)
+        except OSError as e:
+            log.warning('ai_cache_save_failed', "Could not save AI reply cache to %s: %s", self.path, e)
+
+    def load(self):
+        """Read entries saved by save(); a missing or unreadable file leaves the cache empty"""
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                saved = json.load(f)
+            entries = saved['entries']
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            log.warning('ai_cache_load_failed', "Ignoring AI reply cache %s: %s", self.path, e)
+            return
+        now = time.time()
+        with self.lock:
+            for key, value, expires_at in entries:
+                if expires_at > now:
+                    self._store(key, value, expires_at)
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats['entries'] = len(self.entries)
+            stats['bytes'] = self.bytes
+            stats['in_flight'] = len(self.flights)
+        return stats
@@ -0,0 +1,117 @@
+"""
+Chat rooms and the membership index behind room broadcasts
+
+Every connection starts in DEFAULT_ROOM and can join or leave more rooms
+with `join_room` / `leave_room`. The index maps each room to the set of
+connections in it, and each connection's entry in ChatServer.clients
+keeps the set of rooms it is in. So a room broadcast touches only that
+room's members, and a departing client is removed from its own rooms
+without scanning the others.
+
+Room-scoped messages (chat, presence) carry a `room` field and go only to
+that room's members. Messages without one go to every client.
+
+Each room names the AI backend that answers its chat messages, or AI_OFF
+for none. A room is created by its first member and dropped when its
+last member leaves, unless it was configured up front on the command line.
+"""
+
+import threading
+import time
+
+DEFAULT_ROOM = 'lobby'
+AI_OFF = 'off'
+MAX_ROOM_NAME = 64
+MAX_ROOMS_PER_CLIENT = 100
+
+
+def valid_room_name(name):
+    return isinstance(name, str) and 0 < len(name) <= MAX_ROOM_NAME and name.isprintable()
+
+
+class Room:
+    """Members and settings of one room"""
+
+    __slots__ = ('name', 'members', 'ai', 'permanent', 'created_at')
+
+    def __init__(self, name, ai=None, permanent=False):
+        self.name = name
+        self.members = set()
+        self.ai = ai                # AI backend name, or AI_OFF
+        self.permanent = permanent
+        self.created_at = time.time()
+
+
+class RoomIndex:
+    """room name -> Room, safe to update from several handler threads
+
+    Joins and leaves take a lock. Broadcasts read `members()` without it:
+    the snapshot is taken in one step, so concurrent changes can't break it.
+    `on_removed(name)` is called after a room is dropped, so per-room state
+    kept elsewhere can go with it.
+    """
+
+    def __init__(self, default_ai=None, on_removed=None):
+        self.default_ai = default_ai
+        self.on_removed = on_removed
+        self.rooms = {}
+        self.lock = threading.Lock()
+        self.configure(DEFAULT_ROOM, default_ai)
+
+    def configure(self, name, ai):
+        """Create or update a room that stays around when empty"""
+        with self.lock:
+            room = self.rooms.get(name)
+            if room is None:
+                room = self.rooms[name] = Room(name, ai, permanent=True)
+            room.ai = ai
+            room.permanent = True
+            return room
+
+    def get(self, name):
+        return self.rooms.get(name)
+
+    def join(self, name, conn, rooms_of_conn, ai=None):
+        """Add conn to a room, creating it with `ai` (or the default) if needed; returns (room, created)"""
+        with self.lock:
+            room = self.rooms.get(name)
+            created = room is None
+            if created:
+                room = self.rooms[name] = Room(name, self.default_ai if ai is None else ai)
+            room.members.add(conn)
+            rooms_of_conn.add(name)
+            return room, created
+
+    def leave(self, name, conn, rooms_of_conn):
+        """Remove conn from a room; returns the room, or None if conn wasn't in it"""
+        with self.lock:
+            rooms_of_conn.discard(name)
+            room = self.rooms.get(name)
+            if room is None or conn not in room.members:
+                return None
+            room.members.discard(conn)
+            removed = not room.members and not room.permanent
+            if removed:
+                del self.rooms[name]
+        if removed and self.on_removed is not None:
+            self.on_removed(name)
+        return room
+
+    def leave_all(self, conn, rooms_of_conn):
+        """Remove conn from every room it is in"""
+        for name in list(rooms_of_conn):
+            self.leave(name, conn, rooms_of_conn)
+
+    def members(self, name):
+        """Snapshot of a room's members (empty if there is no such room)"""
+        room = self.rooms.get(name)
+        return tuple(room.members) if room is not None else ()
+
+    def get_stats(self):
+        rooms = list(self.rooms.values())
+        sizes = [len(room.members) for room in rooms]
+        return {
+            'rooms': len(rooms),
+            'memberships': sum(sizes),
+            'largest_room': max(sizes, default=0)
+        }
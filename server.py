@@ -1,23 +1,184 @@
+import argparse
+import itertools
+import json
+import re
+import signal
 import socket
+import subprocess
+import sys
 import threading
 import time
-import json
 from datetime import datetime
-import openai
 import os
+from ai_backends import BACKENDS, LazyResponder, backend_names, is_installed, offline_backends
+from ai_workers import AIQueueFull, AIWorkerPool, COALESCED, REJECTED, StreamBuffer, THROTTLED
+from conversations import ConversationStore, estimate_tokens
+from event_log import DEFAULT_SAMPLE, LEVELS, LogService, log
+from hlc import HybridLogicalClock
+from message_log import MessageLog
+from metrics import SIZE_BUCKETS, MetricsRegistry, MetricsServer
+from outbound import DROP_OLDEST, OVERFLOW_POLICIES, SlowConsumerError, ThreadedOutbox
+from rate_limit import RateLimiter
+from protocol import (
+    CODECS, FrameCache, FrameDecoder, FrameError, RECV_BUFFER_SIZE,
+    decode_message, negotiate_codec
+)
+from registry import ClientRegistry
+from response_cache import ResponseCache, normalize_prompt
+from rooms import AI_OFF, DEFAULT_ROOM, MAX_ROOMS_PER_CLIENT, RoomIndex, valid_room_name
+from time_service import TimeService
+
+HISTORY_SCAN_FACTOR = 10  # log entries read per history page, per message asked for
+MESSAGE_TYPES = frozenset(['join', 'chat', 'clock_sync', 'leave', 'history_request',
+                           'direct_message', 'join_room', 'leave_room'])
+
+CHATGPT_MODEL = "gpt-3.5-turbo"
+CHATGPT_MAX_TOKENS = 150
+CHATGPT_TEMPERATURE = 0.7
+CHATGPT_SYSTEM_PROMPT = "You are a helpful and friendly assistant in a WhatsApp-like chat app. The user's name is {username}. Keep responses conversational, helpful, and under 100 words. Use some emojis to make it fun and engaging! Be natural and chat-like."
+MAX_CACHED_PROMPT = 200  # longer prompts are unlikely to repeat and skip the reply cache
+USERNAME_PLACEHOLDER = '\x00username\x00'
+CHATGPT_SUMMARY_PROMPT = "Summarize this part of a chat with an assistant in under 80 words. Keep names, facts, decisions and open questions. If an earlier summary is given, fold it in."
+CHATGPT_SUMMARY_TOKENS = 120
+MEMORY_SCOPES = ('user', 'room')
+
+def chatgpt_cache_key(prompt):
+    """Reply cache key: everything that shapes the reply except the asker's name"""
+    return json.dumps([CHATGPT_MODEL, CHATGPT_TEMPERATURE, CHATGPT_MAX_TOKENS, CHATGPT_SYSTEM_PROMPT,
+                       normalize_prompt(prompt)], ensure_ascii=False)
+
+def chatgpt_history(summary, turns):
+    """API messages for a conversation's summary and recent turns"""
+    messages = [{"role": "system", "content": f"Summary of the conversation so far: {summary}"}] if summary else []
+    messages.extend({"role": role, "content": text} for role, text in turns)
+    return messages
+
+def depersonalize(reply, username):
+    """Swap the asker's name in a reply for a placeholder filled in on every hit"""
+    return re.sub(r'(?<!\w)' + re.escape(username) + r'(?!\w)', USERNAME_PLACEHOLDER, reply) if username else reply
 
 class ChatServer:
-    def __init__(self, host='127.0.0.1', port=50001):
+    def __init__(self, host='127.0.0.1', port=50001, backlog=128,
+                 ai_backend='openai', ai_workers=4, ai_queue_size=100,
+                 ai_timeout=30.0, ai_stub_latency=0.5, ai_cache_size=1000,
+                 ai_cache_bytes=16 * 1024 * 1024, ai_cache_ttl=3600.0, ai_cache_path=None,
+                 ai_coalesce_window=0.0, ai_user_rate=None, ai_user_burst=1, ai_global_rate=None,
+                 ai_global_burst=1, ai_max_in_flight=None, ai_stream=False, ai_stream_interval=0.05,
+                 ai_memory_turns=0, ai_memory_tokens=1000, ai_memory_bytes=8 * 1024 * 1024,
+                 ai_memory_idle=1800.0, ai_memory_scope='user', ai_memory_summarize=False, ai_preload=False,
+                 outbound_queue_size=1000, slow_consumer_policy=DROP_OLDEST,
+                 codecs=None, history_dir='chat_history', history_segment_bytes=64 * 1024 * 1024,
+                 history_max_segments=16, history_retention_seconds=None,
+                 history_replay_count=50, history_page_limit=200, time_port=None,
+                 node_id=0, bus=None, reuse_port=False, room_ai=None, metrics_port=None,
+                 log_service=None):
         self.host = host
         self.port = port
-        self.clients = {}  # {socket: {'username': str, 'address': tuple}}
+        self.backlog = backlog
+        self.ai_backend = ai_backend
+        self.clients = ClientRegistry()  # socket -> {'username': str, 'address': tuple, 'rooms': set}
+        self.outboxes = {}  # {socket: Outbox}
         self.server_socket = None
         self.running = False
+        self.log_service = log_service  # started and stopped by whoever created it
+        
+        # Scale-out: several nodes share the port and exchange broadcasts over a bus
+        self.node_id = node_id
+        self.bus = bus
+        self.reuse_port = reuse_port
+        self.node_counts = {}  # {node id: clients connected there}
+        
+        # Each connection's writes go through its own bounded queue
+        self.outbound_queue_size = outbound_queue_size
+        self.slow_consumer_policy = slow_consumer_policy
+        self.slow_consumer_disconnects = 0
+        
+        # Event ordering: HLC timestamps plus per-sender sequence numbers.
+        # Each connection's seq/hlc is only touched by its own handler;
+        # the AI sender is stamped from several workers, hence its lock.
+        # Sequence numbers count per room.
+        self.hlc = HybridLogicalClock()
+        self.ai_stamp_lock = threading.Lock()
+        self.ai_seq = {}  # {room: last AI seq}; dropped with the room
+        self.sender_ids = itertools.count(1)  # a connection's seq stream is keyed by its sender id
+        self.ai_last_hlc = 0
+        
+        # Wire codecs this server will agree to in the join handshake
+        self.codecs = {name: CODECS[name] for name in (codecs or CODECS) if name in CODECS}
         
-        # HATGPT API SETUP - USING ENVIRONMENT VARIABLE
-        self.openai_client = openai.OpenAI(
-            api_key=os.getenv("OPENAI_API_KEY")
+        # Rooms pick one of these backends: the default, any a --room-ai names and the offline ones.
+        # Each is loaded when a room first asks it something (or at startup with ai_preload)
+        self.openai_client = None   # created by load_chatgpt()
+        self.ai_stub_latency = ai_stub_latency
+        self.ai_preload = ai_preload
+        enabled = set(offline_backends()) | {ai_backend} | set((room_ai or {}).values())
+        enabled.discard(AI_OFF)
+        for name in enabled:
+            if name not in BACKENDS:
+                raise ValueError(f"Unknown AI backend {name!r}")
+        self.responders = {name: LazyResponder(name, self) for name in sorted(enabled)}
+        responder = self.responders.get(ai_backend)
+        
+        # Repeated prompts are answered from recent replies instead of the API
+        self.ai_cache = None
+        if ai_cache_size > 0 and 'openai' in self.responders:
+            self.ai_cache = ResponseCache(ai_cache_size, ai_cache_bytes, ai_cache_ttl, ai_cache_path)
+        
+        # Recent turns of each conversation go along with the next prompt, within a token budget
+        self.conversations = None
+        self.ai_memory_scope = ai_memory_scope
+        self.ai_timeout = ai_timeout
+        if ai_memory_turns > 0 and 'openai' in self.responders:
+            self.conversations = ConversationStore(ai_memory_turns, ai_memory_tokens, ai_memory_bytes,
+                                                   ai_memory_idle, summarize=ai_memory_summarize)
+        
+        # Room membership index: chat fan-out only touches the room's members
+        self.rooms = RoomIndex(default_ai=ai_backend, on_removed=self.forget_room)
+        for name, backend in (room_ai or {}).items():
+            self.rooms.configure(name, backend)
+        
+        # Durable chat history; appends are handed to a background writer
+        self.message_log = None
+        if history_dir:
+            self.message_log = MessageLog(
+                history_dir,
+                segment_bytes=history_segment_bytes,
+                max_segments=history_max_segments,
+                retention_seconds=history_retention_seconds
+            )
+        
+        self.history_replay_count = history_replay_count
+        self.history_page_limit = history_page_limit
+        
+        # Optional UDP clock sync endpoint, answered off the chat connections
+        self.time_service = TimeService(host, time_port, reuse_port) if time_port is not None else None
+        
+        # AI replies are produced off the client handler threads
+        # A user's quick lines are merged into one request, and floods are refused up front
+        self.ai_limiter = None
+        if ai_user_rate or ai_global_rate:
+            self.ai_limiter = RateLimiter(ai_user_rate, ai_user_burst, ai_global_rate, ai_global_burst)
+        self.ai_pool = AIWorkerPool(
+            responder,
+            workers=ai_workers,
+            max_queue=ai_queue_size,
+            job_timeout=ai_timeout,
+            coalesce_window=ai_coalesce_window,
+            limiter=self.ai_limiter
         )
+        # Upstream API calls in flight at once, on top of the worker count
+        self.ai_max_in_flight = ai_max_in_flight
+        
+        # Streamed replies go out as ai_chunk frames, then one ai_done with the whole text
+        self.ai_stream = ai_stream
+        self.ai_stream_interval = ai_stream_interval
+        self.reply_ids = itertools.count(1)
+        self.upstream_slots = threading.BoundedSemaphore(ai_max_in_flight) if ai_max_in_flight else None
+        
+        # Prometheus metrics, served over HTTP when a port is given
+        self.metrics = MetricsRegistry()
+        self.setup_metrics()
+        self.metrics_server = MetricsServer(self.metrics, host, metrics_port) if metrics_port is not None else None
         
         print("🤖 WhatsApp Server with ChatGPT Integration")
         print("=" * 60)
@@ -27,15 +188,15 @@ class ChatServer:
         try:
             self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if self.reuse_port:
+                # The kernel spreads new connections across every node on this port
+                self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
             self.server_socket.bind((self.host, self.port))
-            self.server_socket.listen(10)
+            self.server_socket.listen(self.backlog)
             self.running = True
+            self.start_services()
             
-            print(f" WhatsApp Chat Server started on {self.host}:{self.port}")
-            print(f" ChatGPT integration: READY")
-            print(f" Server time: {datetime.now().strftime('%H:%M:%S')}")
-            print(" Waiting for client connections...")
-            print("-" * 60)
+            self.print_banner('threaded')
             
             while self.running:
                 try:
@@ -51,38 +212,203 @@ class ChatServer:
                     
                 except socket.error:
                     if self.running:
-                        print(" Error accepting connection")
+                        log.error('accept_error', "Error accepting connection")
                     break
                     
         except Exception as e:
-            print(f" Server error: {e}")
+            log.error('server_error', "Server error: %s", e)
         finally:
             self.cleanup()
             
+    def start_services(self):
+        """Start background workers shared by every server engine"""
+        if self.message_log:
+            self.message_log.start()
+        self.ai_pool.start()
+        if 'openai' in self.responders and not is_installed('openai'):
+            log.warning('openai_missing', "The openai package is not installed; "
+                        "rooms using the openai backend will get error replies")
+        if self.ai_preload:
+            # The port is already open; warm the backends up in the background
+            threading.Thread(target=self.preload_ai_backends, name='ai-preload', daemon=True).start()
+        if self.time_service:
+            try:
+                self.time_service.start()
+            except OSError as e:
+                # Clients fall back to clock_sync over TCP
+                log.warning('time_service_unavailable', "UDP time service unavailable on port %s: %s",
+                            self.time_service.port, e)
+                self.time_service = None
+        if self.bus:
+            self.bus.start(self.node_id, self.on_bus_envelopes)
+            self.publish_client_count()
+        if self.metrics_server:
+            try:
+                self.metrics_server.start()
+            except OSError as e:
+                log.warning('metrics_unavailable', "Metrics endpoint unavailable on port %s: %s",
+                            self.metrics_server.port, e)
+                self.metrics_server = None
+                
+    def preload_ai_backends(self):
+        for responder in self.responders.values():
+            try:
+                responder.load()
+            except Exception:
+                pass    # logged by load(); rooms using it get error replies
+                
+    def setup_metrics(self):
+        """Create the hot-path metrics and register the ones read at scrape time"""
+        metrics = self.metrics
+        # Received messages are counted by the handle_time histogram; unknown types here
+        self.unknown_messages = 0
+        metrics.counter_func('chat_messages_received_total', "Messages received from clients",
+                             lambda: dict(self.handle_time.counts(), unknown=self.unknown_messages), 'type')
+        self.messages_out = metrics.counter('chat_messages_sent_total', "Messages queued for clients", 'type')
+        self.bytes_in = metrics.counter('chat_received_bytes_total', "Bytes received from clients")
+        self.handle_time = metrics.histogram('chat_handle_seconds', "Time spent in process_message", label='type')
+        self.broadcast_time = metrics.histogram('chat_broadcast_seconds', "Time to queue a broadcast for every recipient")
+        self.ai_latency = metrics.histogram('chat_ai_reply_seconds', "AI prompt queued to reply ready", label='outcome')
+        self.ai_first_text = metrics.histogram('chat_ai_first_text_seconds',
+                                               "AI prompt queued to the first reply text sent")
+        self.ai_prompt_tokens = metrics.histogram('chat_ai_prompt_tokens', "Estimated tokens sent per ChatGPT request",
+                                                  SIZE_BUCKETS)
+        self.clock_sync_rtt = metrics.histogram('chat_clock_sync_rtt_seconds', "Clock sync round trips reported by clients")
+        self.disconnects = metrics.counter('chat_disconnects_total', "Closed connections by reason", 'reason')
+        
+        # Outboxes keep their own byte and drop counts; these hold those of closed connections
+        self.closed_lock = threading.Lock()
+        self.closed_sent_bytes = 0
+        self.closed_dropped = 0
+        metrics.counter_func('chat_sent_bytes_total', "Bytes written to clients",
+                             lambda: self.closed_sent_bytes + sum(o.sent_bytes for o in list(self.outboxes.values())))
+        metrics.counter_func('chat_outbound_dropped_total', "Frames dropped from full outbound queues",
+                             lambda: self.closed_dropped + sum(o.dropped for o in list(self.outboxes.values())))
+        metrics.gauge('chat_outbound_queued_frames', "Frames waiting in all outbound queues",
+                      lambda: sum(o.depth() for o in list(self.outboxes.values())))
+        metrics.gauge('chat_outbound_queue_depth_max', "Deepest outbound queue",
+                      lambda: max((o.depth() for o in list(self.outboxes.values())), default=0))
+        metrics.counter_func('chat_hlc_rejected_total', "Received HLC timestamps ignored as malformed or too far ahead",
+                             lambda: self.hlc.rejected)
+        metrics.gauge('chat_clients', "Clients connected to this node", lambda: len(self.clients))
+        metrics.gauge('chat_cluster_clients', "Clients connected to the whole cluster", self.total_clients)
+        metrics.gauge('chat_rooms', "Rooms with members or configured", lambda: self.rooms.get_stats()['rooms'])
+        metrics.gauge('chat_ai_queue_depth', "AI prompts waiting for a worker", self.ai_pool.queue_depth)
+        metrics.counter_func('chat_ai_jobs_total', "AI jobs by outcome", self.get_ai_job_counts, 'outcome')
+        metrics.counter_func('chat_ai_cache_requests_total', "AI reply cache lookups by result",
+                             lambda: self.get_ai_cache_counts(('hits', 'misses', 'coalesced')), 'result')
+        metrics.counter_func('chat_ai_cache_removed_total', "Replies removed from the AI cache",
+                             lambda: self.get_ai_cache_counts(('evicted', 'expired')), 'reason')
+        metrics.gauge('chat_ai_cache_entries', "Replies in the AI cache",
+                      lambda: len(self.ai_cache) if self.ai_cache is not None else None)
+        metrics.gauge('chat_ai_cache_bytes', "Approximate memory held by the AI cache",
+                      lambda: self.ai_cache.bytes if self.ai_cache is not None else None)
+        metrics.gauge('chat_ai_memory_conversations', "Conversations remembered for AI context",
+                      lambda: len(self.conversations) if self.conversations is not None else None)
+        metrics.gauge('chat_ai_memory_bytes', "Approximate memory held by AI conversation memory",
+                      lambda: self.conversations.bytes if self.conversations is not None else None)
+        metrics.counter_func('chat_ai_memory_removed_total', "Conversations dropped from AI memory",
+                             lambda: self.get_ai_memory_counts(('evicted', 'expired')), 'reason')
+        metrics.counter_func('chat_ai_memory_summaries_total', "Old conversation turns folded into a summary",
+                             lambda: self.conversations.get_stats()['summarized']
+                             if self.conversations is not None else None)
+        metrics.counter_func('chat_time_service_probes_total', "UDP clock probes answered",
+                             lambda: self.time_service.served if self.time_service else None)
+        metrics.counter_func('chat_log_dropped_total', "Log records dropped because the log queue was full",
+                             lambda: self.log_service.get_stats()['dropped'] if self.log_service else None)
+        metrics.counter_func('chat_history_dropped_total', "Chat messages not written to the history log",
+                             lambda: self.message_log.get_stats()['dropped'] if self.message_log else None)
+        metrics.gauge('chat_history_failed', "1 once the history log has stopped after a write error",
+                      lambda: int(self.message_log.failed) if self.message_log else None)
+        metrics.gauge('chat_uptime_seconds', "Seconds since the server started",
+                      lambda: time.time() - getattr(self, 'start_time', time.time()))
+        
+    def get_ai_job_counts(self):
+        stats = self.ai_pool.get_stats()
+        return {key: stats[key] for key in ('submitted', 'rejected', 'completed', 'timed_out', 'failed',
+                                            'coalesced', 'throttled')}
+        
+    def get_ai_cache_counts(self, keys):
+        if self.ai_cache is None:
+            return None
+        stats = self.ai_cache.get_stats()
+        return {key: stats[key] for key in keys}
+        
+    def get_ai_memory_counts(self, keys):
+        if self.conversations is None:
+            return None
+        stats = self.conversations.get_stats()
+        return {key: stats[key] for key in keys}
+        
+    def print_banner(self, mode):
+        """Print startup information once the listening socket is ready"""
+        print(f" WhatsApp Chat Server started on {self.host}:{self.port} ({mode} mode, backlog {self.backlog})")
+        if self.ai_backend == AI_OFF:
+            print(f" ChatGPT integration: OFF ({', '.join(self.responders)} available to rooms)")
+        else:
+            print(f" ChatGPT integration: READY ({self.ai_backend} backend, {self.ai_pool.workers} workers)")
+        if self.message_log:
+            print(f" Chat history: {self.message_log.directory} ({self.message_log.end_offset()} messages)")
+        if self.time_service:
+            print(f" UDP time service: {self.host}:{self.time_service.port}")
+        if self.bus:
+            print(f" Cluster node {self.node_id} on bus {self.bus.get_stats().get('address')}")
+        if self.metrics_server:
+            print(f" Metrics: http://{self.host}:{self.metrics_server.port}/metrics")
+        print(f" Server time: {datetime.now().strftime('%H:%M:%S')}")
+        print(" Waiting for client connections...")
+        print("-" * 60)
+            
     def handle_client(self, conn, addr):
         """Handle individual client connection"""
+        self.outboxes[conn] = self.create_outbox(conn)
+        decoder = FrameDecoder()
+        reason = 'closed'
+        
         try:
             while self.running:
-                data = conn.recv(1024).decode('utf-8')
+                data = conn.recv(RECV_BUFFER_SIZE)
                 if not data:
                     break
+                received_at = time.time()
+                self.bytes_in.inc(amount=len(data))
                     
-                try:
-                    message = json.loads(data)
+                # One recv() may carry several frames, or only part of one
+                for payload in decoder.feed(data):
+                    try:
+                        message = decode_message(payload)
+                    except ValueError:
+                        log.warning('invalid_message', "Invalid JSON from %s", addr)
+                        continue
+                    if message.get('type') == 'clock_sync':
+                        # Stamp at receipt so queueing behind other frames counts as processing time
+                        message['server_receive_time'] = received_at
                     self.process_message(conn, addr, message)
-                except json.JSONDecodeError:
-                    print(f" Invalid JSON from {addr}")
+                    if conn not in self.outboxes:
+                        return  # removed while handling the message, e.g. after a leave
                     
+        except FrameError as e:
+            log.warning('frame_error', "Dropping client %s: %s", addr, e)
+            reason = 'frame_error'
         except ConnectionResetError:
-            print(f" Client {addr} disconnected unexpectedly")
+            log.info('connection_reset', "Client %s disconnected unexpectedly", addr)
+            reason = 'reset'
         except Exception as e:
-            print(f" Error handling client {addr}: {e}")
+            if conn in self.outboxes:
+                log.error('client_error', "Error handling client %s: %s", addr, e)
+                reason = 'error'
+            # Otherwise another thread removed the client and closed the socket under recv()
         finally:
-            self.remove_client(conn, addr)
+            self.remove_client(conn, addr, reason)
             
     def process_message(self, conn, addr, message):
         """Process different types of messages"""
         msg_type = message.get('type')
+        if msg_type not in MESSAGE_TYPES:
+            log.warning('unknown_message', "Unknown message type from %s: %s", addr, msg_type)
+            self.unknown_messages += 1
+            return
+        started = time.perf_counter()
         
         if msg_type == 'join':
             self.handle_join(conn, addr, message)
@@ -92,112 +418,305 @@ class ChatServer:
             self.handle_clock_sync(conn, addr, message)
         elif msg_type == 'leave':
             self.handle_leave(conn, addr, message)
-        else:
-            print(f" Unknown message type from {addr}: {msg_type}")
+        elif msg_type == 'history_request':
+            self.handle_history_request(conn, addr, message)
+        elif msg_type == 'direct_message':
+            self.handle_direct_message(conn, addr, message)
+        elif msg_type == 'join_room':
+            self.handle_join_room(conn, addr, message)
+        elif msg_type == 'leave_room':
+            self.handle_leave_room(conn, addr, message)
+            
+        self.handle_time.observe(time.perf_counter() - started, msg_type)
             
     def handle_join(self, conn, addr, message):
         """Handle client joining the chat"""
         username = message.get('username', f'User_{addr[1]}')
+        if not isinstance(username, str) or not username.strip():
+            self.send_error(conn, "Username must be a non-empty string")
+            return
+        
+        # Old clients don't offer codecs and keep talking plain JSON
+        codec = negotiate_codec(message.get('codecs'), self.codecs)
+        outbox = self.outboxes.get(conn)
+        if outbox is not None:
+            outbox.codec = codec
         
-        # Add client to our list
-        self.clients[conn] = {
+        # Add client to our list; everyone starts in the lobby
+        previous = self.clients.get(conn)
+        if previous is not None:
+            self.rooms.leave_all(conn, previous['rooms'])
+        client = {
             'username': username,
             'address': addr,
-            'joined_at': time.time()
+            'joined_at': time.time(),
+            'seq': {},
+            'sender': f"{self.node_id}.{next(self.sender_ids)}",
+            'hlc': 0,
+            'rooms': set()
         }
+        self.clients.add(conn, client)
+        self.rooms.join(DEFAULT_ROOM, conn, client['rooms'])
         
-        print(f" {username} joined from {addr}")
-        print(f" Active clients: {len(self.clients)}")
+        self.publish_client_count()
+        log.info('join', "%s joined from %s (codec: %s), %d active clients",
+                 username, addr, codec.name, len(self.clients), username=username, address=addr)
         
         # Send join confirmation to the client
         response = {
             'type': 'join_success',
             'message': f'Welcome to ChatGPT Chat, {username}! 🤖 Type anything to chat with AI!',
             'server_time': time.time(),
-            'clients_count': len(self.clients)
+            'clients_count': self.total_clients(),
+            'codec': codec.name,
+            'room': DEFAULT_ROOM,
+            'hlc': self.hlc.update(message.get('hlc'))
         }
+        if self.time_service:
+            response['time_port'] = self.time_service.port
         self.send_to_client(conn, response)
         
+        # Replay recent history as one batched frame; clients may ask for fewer
+        try:
+            replay_count = self.requested_count(message, 'history_limit', self.history_replay_count)
+        except ValueError as e:
+            self.send_error(conn, str(e))
+            replay_count = 0
+        if self.message_log and replay_count > 0:
+            self.send_history_page(conn, self.message_log.end_offset(), replay_count, DEFAULT_ROOM)
+        
         # Notify other clients about new user
         notification = {
             'type': 'user_joined',
             'username': username,
             'message': f'{username} joined the chat',
             'timestamp': time.time(),
-            'clients_count': len(self.clients)
+            'clients_count': self.total_clients(),
+            'room': DEFAULT_ROOM,
+            'hlc': self.hlc.now()
         }
         self.broadcast_message(notification, exclude=conn)
         
     def handle_chat_message(self, conn, addr, message):
         """Handle chat messages with ChatGPT and broadcast to all clients"""
-        if conn not in self.clients:
+        client = self.clients.get(conn)
+        if client is None:
             return
             
-        username = self.clients[conn]['username']
+        username = client['username']
+        room_name = message.get('room', DEFAULT_ROOM)
+        if not valid_room_name(room_name):
+            self.send_error(conn, "Invalid room name")
+            return
+        if room_name not in client['rooms']:
+            self.send_error(conn, f"You are not in room {room_name!r}")
+            return
         chat_text = message.get('message', '')
         server_timestamp = time.time()
         
-        print(f" [{datetime.fromtimestamp(server_timestamp).strftime('%H:%M:%S')}] {username}: {chat_text}")
+        # After everything the sender had seen, and after its own previous message
+        hlc = max(self.hlc.update(message.get('hlc')), client['hlc'] + 1)
+        client['hlc'] = hlc
+        seq = client['seq'][room_name] = client['seq'].get(room_name, 0) + 1
+        
+        log.info('chat', "[%s] %s: %s", datetime.fromtimestamp(server_timestamp).strftime('%H:%M:%S'),
+                 username, chat_text, username=username, room=room_name, hlc=hlc, seq=seq)
         
-        # First, broadcast the user's message to all other clients
+        # First, broadcast the user's message to the other room members
         user_broadcast_msg = {
             'type': 'chat_message',
             'username': username,
             'message': chat_text,
             'timestamp': server_timestamp,
-            'sender_address': addr
+            'sender_address': addr,
+            'room': room_name,
+            'hlc': hlc,
+            'seq': seq,
+            'sender': client['sender']
         }
-        self.broadcast_message(user_broadcast_msg, exclude=conn)
+        self.broadcast_chat_message(user_broadcast_msg, exclude=conn)
         
         # Send delivery confirmation to sender
         confirmation = {
             'type': 'message_delivered',
-            'timestamp': server_timestamp
+            'timestamp': server_timestamp,
+            'room': room_name,
+            'hlc': hlc,
+            'seq': seq
         }
         self.send_to_client(conn, confirmation)
         
-        # 🤖 Get ChatGPT response and broadcast to ALL clients (including sender)
-        gpt_response = self.get_chatgpt_response(chat_text, username)
+        # 🤖 Queue the request for the room's AI backend; the reply goes to the whole room when ready
+        room = self.rooms.get(room_name)
+        responder = self.responders.get(room.ai) if room else None
+        if responder is None:
+            return
+        # Lines sent in quick succession in one room become a single request
+        result = self.ai_pool.submit(chat_text, username, self.on_ai_reply, context=(hlc, room_name),
+                                     responder=responder, key=(username, room_name),
+                                     on_chunk=self.on_ai_chunk if self.ai_stream else None,
+                                     conversation=self.conversation_key(username, room_name))
+        if result == THROTTLED:
+            log.info('ai_throttled', "Rate limit hit, not asking ChatGPT for %s", username, username=username)
+            self.send_to_client(conn, self.make_ai_message(
+                f"Easy there {username}, I can only answer so fast! 🐢 Give me a few seconds.",
+                room_name
+            ))
+        elif result == REJECTED:
+            log.warning('ai_rejected', "ChatGPT queue full, rejecting request from %s", username, username=username)
+            self.send_to_client(conn, self.make_ai_message(
+                f"Sorry {username}, I'm getting too many messages right now! ⏳ Try again in a moment.",
+                room_name
+            ))
+        elif result == COALESCED:
+            log.debug('ai_coalesced', "Merged %s's message into the pending ChatGPT request", username,
+                      username=username)
         
-        chatgpt_broadcast_msg = {
+    def on_ai_reply(self, job, reply, error):
+        """Called on an AI worker thread when a job finishes"""
+        self.ai_latency.observe(time.time() - job.submitted_at,
+                                'ok' if error is None else 'timeout' if isinstance(error, TimeoutError) else 'error')
+        if error is not None:
+            if isinstance(error, AIQueueFull):
+                reply = f"Sorry {job.username}, I'm getting too many messages right now! ⏳ Try again in a moment."
+            elif isinstance(error, TimeoutError):
+                reply = f"Sorry {job.username}, that took me too long to think about! ⌛ Try asking again."
+            else:
+                reply = f"Sorry {job.username}, I'm having trouble connecting to my brain right now! 🤖💭 Try again in a moment."
+            log.warning('ai_failed', "ChatGPT job for %s failed: %s", job.username, error, username=job.username)
+        else:
+            log.info('ai_reply', "ChatGPT responded: %.50s...", reply, username=job.username,
+                     seconds=time.time() - job.submitted_at)
+            
+        prompt_hlc, room_name = job.context
+        message = self.stamp_ai_message(self.make_ai_message(reply, room_name), prompt_hlc)
+        stream = job.stream
+        if stream is None or stream.first_at is None:
+            self.ai_first_text.observe(time.time() - job.submitted_at)
+        if self.ai_stream:
+            # Closes the bubble the chunks grew; carries the whole text for history and late joiners
+            message['type'] = 'ai_done'
+            message['reply_id'] = stream.reply_id if stream is not None else self.next_reply_id()
+        self.call_in_io_thread(self.broadcast_chat_message, message)
+        
+        if job.conversation is not None:
+            # On this worker thread, after the reply is on its way
+            self.summarize_conversation(job.conversation)
+        
+    def conversation_key(self, username, room_name):
+        """Whose earlier turns an AI prompt continues: the user's in this room, or the whole room's"""
+        if self.conversations is None:
+            return None
+        return (room_name,) if self.ai_memory_scope == 'room' else (room_name, username)
+        
+    def on_ai_chunk(self, job, text):
+        """Called on an AI worker thread with each new piece of a streamed reply"""
+        stream = job.stream
+        if stream is None:
+            stream = job.stream = StreamBuffer(self.next_reply_id(), self.ai_stream_interval)
+        text = stream.add(text)
+        if text is None:
+            return
+        if stream.chunks == 1:
+            self.ai_first_text.observe(stream.first_at - job.submitted_at)
+        chunk = {
+            'type': 'ai_chunk',
+            'reply_id': stream.reply_id,
+            'index': stream.chunks - 1,
+            'username': 'ChatGPT 🤖',
+            'text': text,
+            'timestamp': time.time(),
+            'room': job.context[1]
+        }
+        self.call_in_io_thread(self.broadcast_message, chunk)
+        
+    def next_reply_id(self):
+        """Unique across the cluster, so chunks relayed from other nodes never collide"""
+        return f"{self.node_id}-{next(self.reply_ids)}"
+        
+    def call_in_io_thread(self, callback, *args):
+        """Run callback where socket writes are allowed; any thread is fine when threaded"""
+        callback(*args)
+        
+    def call_off_io_thread(self, func, callback, *args):
+        """Run func(*args), which may block, then callback(result) via call_in_io_thread
+
+        Each connection has its own handler thread here, so blocking it is fine.
+        """
+        callback(func(*args))
+        
+    def make_ai_message(self, text, room=DEFAULT_ROOM):
+        return {
             'type': 'chat_message',
             'username': 'ChatGPT 🤖',
-            'message': gpt_response,
+            'message': text,
             'timestamp': time.time(),
-            'sender_address': ('ChatGPT', 'AI')
+            'sender_address': ('ChatGPT', 'AI'),
+            'room': room,
+            'hlc': self.hlc.now()
         }
-        self.broadcast_message(chatgpt_broadcast_msg)
         
-        print(f" ChatGPT responded: {gpt_response[:50]}...")
+    def stamp_ai_message(self, message, prompt_hlc):
+        """Give a broadcast AI reply its place in the AI sender's seq/hlc stream of its room"""
+        room = message['room']
+        with self.ai_stamp_lock:
+            self.ai_seq[room] = self.ai_seq.get(room, 0) + 1
+            self.ai_last_hlc = max(self.hlc.update(prompt_hlc), self.ai_last_hlc + 1)
+            message['seq'] = self.ai_seq[room]
+            message['sender'] = f"{self.node_id}.ai"    # every node numbers its own AI replies
+            message['hlc'] = self.ai_last_hlc
+            if self.rooms.get(room) is None:
+                # Everyone left before the reply came; seq 1 again is a fresh stream to clients
+                self.ai_seq.pop(room, None)
+        return message
+        
+    def forget_room(self, name):
+        """Drop the AI sender's seq stream of a room that no longer exists"""
+        with self.ai_stamp_lock:
+            self.ai_seq.pop(name, None)
         
-    def get_chatgpt_response(self, user_message, username):
-        """Get response from ChatGPT API"""
+    def load_chatgpt(self):
+        """The openai backend's loader: import openai and create the client on first use"""
+        if self.openai_client is None:
+            import openai
+            self.openai_client = openai.OpenAI(
+                api_key=os.getenv("OPENAI_API_KEY")
+            )
+        return self.get_chatgpt_response
+        
+    def get_chatgpt_response(self, user_message, username, timeout=None, on_delta=None, conversation=None):
+        """Get response from ChatGPT API, or the cached reply to the same prompt
+
+        With `on_delta` the reply is streamed; a cached reply arrives whole.
+        With a `conversation` key, its recent turns are sent along and the
+        new question and reply are added to them.
+        """
         try:
-            print(f"🔄 Sending to ChatGPT: {user_message}")
+            history = []
+            turn = user_message
+            if conversation is not None and self.conversations is not None:
+                if self.ai_memory_scope == 'room':
+                    turn = f"{username}: {user_message}"  # the room's turns come from several people
+                history = chatgpt_history(*self.conversations.context(conversation, turn))
             
-            response = self.openai_client.chat.completions.create(
-                model="gpt-3.5-turbo",
-                messages=[
-                    {
-                        "role": "system", 
-                        "content": f"You are a helpful and friendly assistant in a WhatsApp-like chat app. The user's name is {username}. Keep responses conversational, helpful, and under 100 words. Use some emojis to make it fun and engaging! Be natural and chat-like."
-                    },
-                    {
-                        "role": "user", 
-                        "content": user_message
-                    }
-                ],
-                max_tokens=150,
-                temperature=0.7
-            )
+            if history or self.ai_cache is None or len(user_message) > MAX_CACHED_PROMPT:
+                # A reply that follows on from earlier turns is no answer for anyone else
+                reply = self.request_chatgpt(turn, username, timeout, on_delta, history)
+            else:
+                # Replies are cached without the asker's name, so anyone's "hi" can reuse them
+                reply = self.ai_cache.get_or_compute(
+                    chatgpt_cache_key(user_message),
+                    lambda: depersonalize(self.request_chatgpt(user_message, username, timeout, on_delta), username),
+                    timeout
+                ).replace(USERNAME_PLACEHOLDER, username)
             
-            gpt_reply = response.choices[0].message.content.strip()
-            print(f" ChatGPT response received: {len(gpt_reply)} characters")
-            return gpt_reply
+            if conversation is not None and self.conversations is not None:
+                self.conversations.record(conversation, turn, reply)
+            return reply
             
         except Exception as e:
             error_msg = str(e)
-            print(f" ChatGPT API Error: {error_msg}")
+            log.error('ai_api_error', "ChatGPT API Error: %s", error_msg)
             
             if "api_key" in error_msg.lower() or "authentication" in error_msg.lower():
                 return f"Sorry {username}, I need my API key to be configured! 🔑 Please check the server setup."
@@ -207,84 +726,514 @@ class ChatServer:
                 return f"Hey {username}, there's a model issue on my end! 🤖 The server admin should check this."
             else:
                 return f"Sorry {username}, I'm having trouble connecting to my brain right now! 🤖💭 Try again in a moment."
+                
+    def request_chatgpt(self, user_message, username, timeout=None, on_delta=None, history=()):
+        """One ChatGPT API call, streamed to on_delta if given; raises on failure"""
+        log.debug('ai_request', "🔄 Sending to ChatGPT: %s", user_message, username=username)
+        self.ai_prompt_tokens.observe(estimate_tokens(CHATGPT_SYSTEM_PROMPT) + estimate_tokens(user_message) +
+                                      sum(estimate_tokens(message['content']) for message in history))
+        
+        timeout = self.acquire_upstream_slot(timeout)
+        try:
+            if on_delta is None:
+                gpt_reply = self.call_chatgpt(user_message, username, timeout,
+                                              history=history).choices[0].message.content.strip()
+            else:
+                gpt_reply = self.stream_chatgpt(user_message, username, timeout, on_delta, history)
+        finally:
+            self.release_upstream_slot()
+        
+        log.debug('ai_response', "ChatGPT response received: %d characters", len(gpt_reply))
+        return gpt_reply
+        
+    def acquire_upstream_slot(self, timeout):
+        """Wait for one of the --ai-max-in-flight request slots; returns what is left of timeout"""
+        if self.upstream_slots is None:
+            return timeout
+        waited = time.monotonic()
+        if not self.upstream_slots.acquire(timeout=timeout):
+            raise TimeoutError(f"All {self.ai_max_in_flight} ChatGPT request slots stayed busy")
+        if timeout is not None:
+            timeout = max(0.0, timeout - (time.monotonic() - waited))
+        return timeout
+        
+    def release_upstream_slot(self):
+        if self.upstream_slots is not None:
+            self.upstream_slots.release()
+        
+    def stream_chatgpt(self, user_message, username, timeout, on_delta, history=()):
+        """Pass each token delta to on_delta as the API sends it; returns the whole reply"""
+        parts = []
+        for chunk in self.call_chatgpt(user_message, username, timeout, stream=True, history=history):
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if delta:
+                parts.append(delta)
+                on_delta(delta)
+        return ''.join(parts).strip()
+        
+    def call_chatgpt(self, user_message, username, timeout, stream=False, history=()):
+        return self.openai_client.chat.completions.create(
+            model=CHATGPT_MODEL,
+            messages=[
+                {
+                    "role": "system", 
+                    "content": CHATGPT_SYSTEM_PROMPT.format(username=username)
+                },
+                *history,
+                {
+                    "role": "user", 
+                    "content": user_message
+                }
+            ],
+            max_tokens=CHATGPT_MAX_TOKENS,
+            temperature=CHATGPT_TEMPERATURE,
+            timeout=timeout,
+            stream=stream
+        )
+        
+    def summarize_conversation(self, key):
+        """Fold turns that dropped out of a conversation's memory into its rolling summary"""
+        taken = self.conversations.take_for_summary(key)
+        if taken is None:
+            return
+        summary, turns = taken
+        lines = [f"Earlier summary: {summary}"] if summary else []
+        lines.extend(f"{'Assistant' if role == 'assistant' else 'User'}: {text}" for role, text in turns)
+        new_summary = None
+        try:
+            timeout = self.acquire_upstream_slot(self.ai_timeout)
+            try:
+                response = self.openai_client.chat.completions.create(
+                    model=CHATGPT_MODEL,
+                    messages=[
+                        {"role": "system", "content": CHATGPT_SUMMARY_PROMPT},
+                        {"role": "user", "content": '\n'.join(lines)}
+                    ],
+                    max_tokens=CHATGPT_SUMMARY_TOKENS,
+                    temperature=0,
+                    timeout=timeout
+                )
+            finally:
+                self.release_upstream_slot()
+            new_summary = response.choices[0].message.content.strip()
+        except Exception as e:
+            log.warning('ai_summary_failed', "Could not summarize an AI conversation, dropping %d old turns: %s",
+                        len(turns), e)
+        finally:
+            self.conversations.finish_summary(key, turns, new_summary)
+        
+    def handle_history_request(self, conn, addr, message):
+        """Send the page of a room's history just before an offset or timestamp cursor"""
+        room = message.get('room', DEFAULT_ROOM)
+        client = self.clients.get(conn)
+        if client is None or room not in client['rooms']:
+            self.send_error(conn, f"You are not in room {room!r}")
+            return
+        if not self.message_log:
+            self.send_to_client(conn, {'type': 'history', 'room': room, 'messages': [], 'has_more': False})
+            return
+            
+        try:
+            before_offset = message.get('before_offset')
+            before_timestamp = message.get('before_timestamp')
+            if before_offset is not None:
+                before_offset = max(int(before_offset), 0)
+            elif before_timestamp is not None:
+                before_offset = self.message_log.offset_for_timestamp(float(before_timestamp))
+            else:
+                before_offset = self.message_log.end_offset()
+            limit = self.requested_count(message, 'limit', self.history_page_limit)
+        except (TypeError, ValueError, OverflowError):
+            self.send_error(conn, "Invalid history request: before_offset, before_timestamp and limit must be numbers")
+            return
+        self.send_history_page(conn, before_offset, limit, room)
+        
+    def requested_count(self, message, key, default):
+        """A message count sent by a client, clamped to 0..history_page_limit
+
+        Raises ValueError if it isn't a number.
+        """
+        try:
+            count = int(message.get(key, default))
+        except (TypeError, ValueError, OverflowError):
+            raise ValueError(f"Invalid {key}: expected a whole number") from None
+        return min(max(count, 0), self.history_page_limit)
+        
+    def send_history_page(self, conn, before_offset, limit, room):
+        """Send up to `limit` logged messages of `room` older than `before_offset` in one frame"""
+        self.call_off_io_thread(self.read_history_page, lambda page: self.send_to_client(conn, page),
+                                before_offset, limit, room)
+        
+    def read_history_page(self, before_offset, limit, room):
+        """History page for send_history_page(); reads the log, so it may block on disk
+
+        The log holds every room, so other rooms' messages are skipped. At
+        most HISTORY_SCAN_FACTOR * limit entries are read per page; a quiet
+        room may get a short page whose cursor says where to resume.
+        """
+        first_offset = self.message_log.first_offset()
+        end = min(before_offset, self.message_log.end_offset())
+        start = end
+        found = []
+        while start > first_offset and len(found) < limit and end - start < HISTORY_SCAN_FACTOR * limit:
+            chunk_start = max(first_offset, start - limit)
+            chunk = [(offset, logged) for offset, logged in self.message_log.read(chunk_start, start - chunk_start)
+                     if logged.get('room', DEFAULT_ROOM) == room]
+            found[:0] = chunk
+            start = chunk_start
+        if len(found) > limit:
+            found = found[-limit:]
+            start = found[0][0]
+        
+        messages = []
+        for offset, logged in found:
+            logged['offset'] = offset
+            messages.append(logged)
+            
+        return {
+            'type': 'history',
+            'room': room,
+            'messages': messages,
+            'before_offset': start,
+            'has_more': start > first_offset
+        }
         
     def handle_clock_sync(self, conn, addr, message):
-        client_request_time = message.get('client_time', time.time())
-        server_time = time.time()
+        server_receive_time = message.get('server_receive_time') or time.time()
         
-        estimated_rtt = 0.001
+        # Clients report the round trip their previous probe measured
+        rtt = message.get('estimated_rtt')
+        if isinstance(rtt, (int, float)) and 0 <= rtt < 60:
+            self.clock_sync_rtt.observe(rtt)
         
+        # NTP-style reply: the client subtracts processing_time from its
+        # measured round trip, so only network delay is left
         response = {
             'type': 'clock_sync_response',
-            'server_time': server_time,
-            'client_request_time': client_request_time,
-            'estimated_rtt': estimated_rtt
+            'client_request_time': message.get('client_time', server_receive_time),
+            'server_receive_time': server_receive_time
         }
+        response['server_time'] = time.time()
+        response['processing_time'] = response['server_time'] - server_receive_time
         
         self.send_to_client(conn, response)
         
-        if conn in self.clients:
-            username = self.clients[conn]['username']
-            print(f" Clock sync request from {username} at {addr}")
+        client = self.clients.get(conn)
+        if client is not None:
+            log.info('clock_sync', "Clock sync request from %s at %s", client['username'], addr,
+                     username=client['username'], rtt=rtt)
             
     def handle_leave(self, conn, addr, message):
-        if conn in self.clients:
-            username = self.clients[conn]['username']
-            print(f" {username} left the chat")
+        client = self.clients.get(conn)
+        if client is not None:
+            username = client['username']
+            log.info('leave', "%s left the chat", username, username=username)
+            
+            # Tell each of the user's rooms
+            for room in list(client['rooms']):
+                notification = {
+                    'type': 'user_left',
+                    'username': username,
+                    'message': f'{username} left the chat',
+                    'timestamp': time.time(),
+                    'clients_count': self.total_clients() - 1,
+                    'room': room,
+                    'hlc': self.hlc.now()
+                }
+                self.broadcast_message(notification, exclude=conn)
+            
+        self.remove_client(conn, addr, 'leave')
+        
+    def handle_direct_message(self, conn, addr, message):
+        """Deliver a private message to every connection of one user, and nobody else"""
+        client = self.clients.get(conn)
+        if client is None:
+            return
+        recipient = message.get('to')
+        if not isinstance(recipient, str) or not recipient:
+            self.send_error(conn, "Direct messages need a recipient username in 'to'")
+            return
+        hlc = max(self.hlc.update(message.get('hlc')), client['hlc'] + 1)
+        client['hlc'] = hlc
+        direct = {
+            'type': 'direct_message',
+            'username': client['username'],
+            'to': recipient,
+            'message': message.get('message', ''),
+            'timestamp': time.time(),
+            'hlc': hlc
+        }
+        
+        # Other nodes deliver to their own connections of the user, if any
+        delivered = self.deliver_direct_message(direct)
+        if self.bus:
+            self.bus.publish({'kind': 'direct', 'node': self.node_id, 'message': direct})
+        if delivered:
+            ack = 'message_delivered'
+        elif self.bus:
+            ack = 'message_relayed'     # this node can't tell whether another one has the user
+        else:
+            self.send_error(conn, f"{recipient} is not online")
+            return
+        self.send_to_client(conn, {'type': ack, 'timestamp': direct['timestamp'], 'to': recipient, 'hlc': hlc})
+        
+    def deliver_direct_message(self, message):
+        """Send to the recipient's local connections; returns how many there were"""
+        conns = self.clients.by_username(message['to'])
+        for conn in conns:
+            self.send_to_client(conn, message)
+        return len(conns)
+        
+    def handle_join_room(self, conn, addr, message):
+        """Add the client to a room, creating it if needed, and replay the room's history"""
+        client = self.clients.get(conn)
+        if client is None:
+            return
+        name = message.get('room')
+        ai = message.get('ai')
+        if not valid_room_name(name):
+            self.send_error(conn, "Invalid room name")
+            return
+        if name not in client['rooms'] and len(client['rooms']) >= MAX_ROOMS_PER_CLIENT:
+            self.send_error(conn, f"You can be in at most {MAX_ROOMS_PER_CLIENT} rooms")
+            return
+        if ai is not None and not isinstance(ai, str):
+            self.send_error(conn, "The AI backend must be given by name")
+            return
+        if ai is not None and ai != AI_OFF and ai not in self.responders:
+            self.send_error(conn, f"Unknown AI backend {ai!r}")
+            return
+            
+        # `ai` only applies to a room this join creates
+        room, created = self.rooms.join(name, conn, client['rooms'], ai)
+        log.info('join_room', "%s joined room %s%s", client['username'], name, ' (new)' if created else '',
+                 username=client['username'], room=name)
+        self.send_to_client(conn, {
+            'type': 'room_joined',
+            'room': name,
+            'members': len(room.members),
+            'ai': room.ai,
+            'created': created,
+            'hlc': self.hlc.update(message.get('hlc'))
+        })
+        
+        try:
+            replay_count = self.requested_count(message, 'history_limit', self.history_replay_count)
+        except ValueError as e:
+            self.send_error(conn, str(e))
+            replay_count = 0
+        if self.message_log and replay_count > 0:
+            self.send_history_page(conn, self.message_log.end_offset(), replay_count, name)
             
-            notification = {
-                'type': 'user_left',
-                'username': username,
-                'message': f'{username} left the chat',
-                'timestamp': time.time(),
-                'clients_count': len(self.clients) - 1
-            }
-            self.broadcast_message(notification, exclude=conn)
+        notification = {
+            'type': 'user_joined',
+            'username': client['username'],
+            'message': f"{client['username']} joined {name}",
+            'timestamp': time.time(),
+            'clients_count': self.total_clients(),
+            'room': name,
+            'hlc': self.hlc.now()
+        }
+        self.broadcast_message(notification, exclude=conn)
+        
+    def handle_leave_room(self, conn, addr, message):
+        client = self.clients.get(conn)
+        if client is None:
+            return
+        name = message.get('room')
+        if not valid_room_name(name):
+            self.send_error(conn, "Invalid room name")
+            return
+        if self.rooms.leave(name, conn, client['rooms']) is None:
+            self.send_error(conn, f"You are not in room {name!r}")
+            return
+        client['seq'].pop(name, None)     # seq restarts at 1 if the client comes back
             
-        self.remove_client(conn, addr)
+        log.info('leave_room', "%s left room %s", client['username'], name, username=client['username'], room=name)
+        self.send_to_client(conn, {'type': 'room_left', 'room': name, 'hlc': self.hlc.now()})
+        notification = {
+            'type': 'user_left',
+            'username': client['username'],
+            'message': f"{client['username']} left {name}",
+            'timestamp': time.time(),
+            'clients_count': self.total_clients(),
+            'room': name,
+            'hlc': self.hlc.now()
+        }
+        self.broadcast_message(notification, exclude=conn)
+        
+    def send_error(self, conn, text):
+        self.send_to_client(conn, {'type': 'error', 'message': text, 'timestamp': time.time()})
+        
+    def create_outbox(self, conn):
+        """Create and start the outbound queue for a new connection"""
+        outbox = ThreadedOutbox(conn, max_depth=self.outbound_queue_size, policy=self.slow_consumer_policy)
+        outbox.start()
+        return outbox
         
+    def enqueue_message(self, conn, frames):
+        """Queue a message for conn in its negotiated codec
+
+        `frames` is a FrameCache so a broadcast is encoded at most once per
+        codec. Raises ConnectionError if the client must be dropped.
+        """
+        outbox = self.outboxes.get(conn)
+        if outbox is None:
+            raise ConnectionResetError("Client has no outbound queue")
+        try:
+            outbox.put(frames.frame(outbox.codec))
+        except SlowConsumerError:
+            self.slow_consumer_disconnects += 1
+            raise
+            
     def send_to_client(self, conn, message):
         try:
-            json_message = json.dumps(message)
-            conn.send(json_message.encode('utf-8'))
+            self.enqueue_message(conn, FrameCache(message))
+            self.messages_out.inc(message['type'])
+        except SlowConsumerError as e:
+            log.warning('slow_consumer', "Disconnecting slow client: %s", e)
+            self.remove_client(conn, self.clients.get(conn, {}).get('address'), 'slow_consumer')
         except Exception as e:
-            print(f" Error sending to client: {e}")
+            log.error('send_error', "Error sending to client: %s", e)
             
-    def broadcast_message(self, message, exclude=None):
+    def broadcast_chat_message(self, message, exclude=None, local_only=False):
+        """Record a chat_message in the history log, then broadcast it with its offset"""
+        if self.bus and not local_only:
+            # Offsets are per node: other nodes log it and number it themselves
+            self.bus.publish({'kind': 'chat', 'node': self.node_id, 'message': message})
+        if self.message_log:
+            offset = self.message_log.append(message)
+            if offset is not None:
+                # The log may still be encoding the original dict; send a copy
+                message = dict(message, offset=offset)
+        self.broadcast_message(message, exclude=exclude, local_only=True)
+        
+    def broadcast_message(self, message, exclude=None, local_only=False):
+        """Send to every local client but `exclude`, and to the other nodes unless local_only
+
+        A message with a `room` only goes to that room's members.
+        """
+        if self.bus and not local_only:
+            self.bus.publish({'kind': 'broadcast', 'node': self.node_id, 'message': message})
+        
+        # Serialize once per codec; recipients share the same immutable frame
+        started = time.perf_counter()
+        frames = FrameCache(message)
         disconnected_clients = []
+        room = message.get('room')
+        recipients = self.clients if room is None else self.rooms.members(room)
+        queued = 0
         
-        for client_conn in self.clients:
+        for client_conn in recipients:
             if client_conn != exclude:
                 try:
-                    self.send_to_client(client_conn, message)
-                except:
-                    disconnected_clients.append(client_conn)
+                    self.enqueue_message(client_conn, frames)
+                    queued += 1
+                except ConnectionError as e:
+                    disconnected_clients.append((client_conn, e))
+                    
+        self.broadcast_time.observe(time.perf_counter() - started)
+        self.messages_out.inc(message['type'], queued)
                     
-        for client_conn in disconnected_clients:
-            if client_conn in self.clients:
-                addr = self.clients[client_conn]['address']
-                self.remove_client(client_conn, addr)
+        for client_conn, error in disconnected_clients:
+            client = self.clients.get(client_conn)
+            if client is not None:
+                reason = 'slow_consumer' if isinstance(error, SlowConsumerError) else 'closed'
+                log.warning('broadcast_failed', "Disconnecting slow or closed client %s", client['address'],
+                            username=client['username'], reason=reason)
+                self.remove_client(client_conn, client['address'], reason)
+                
+    def total_clients(self):
+        """Clients connected to the whole cluster, as far as this node knows"""
+        return len(self.clients) + sum(list(self.node_counts.values()))
+        
+    def publish_client_count(self):
+        if self.bus:
+            self.bus.publish({'kind': 'count', 'node': self.node_id, 'count': len(self.clients)})
+            
+    def on_bus_envelopes(self, envelopes):
+        """Called on the bus reader thread with what other nodes published"""
+        self.call_in_io_thread(self.handle_bus_envelopes, envelopes)
+        
+    def handle_bus_envelopes(self, envelopes):
+        for envelope in envelopes:
+            kind = envelope.get('kind')
+            if kind in ('chat', 'broadcast'):
+                message = envelope['message']
+                if 'hlc' in message:
+                    self.hlc.update(message['hlc'])
+                if kind == 'chat':
+                    self.broadcast_chat_message(message, local_only=True)
+                else:
+                    self.broadcast_message(message, local_only=True)
+            elif kind == 'direct':
+                message = envelope['message']
+                self.hlc.update(message.get('hlc'))
+                self.deliver_direct_message(message)
+            elif kind == 'count':
+                self.node_counts[envelope['node']] = envelope['count']
+            elif kind == 'node_up':
+                # Tell the newcomer how many clients we have
+                self.publish_client_count()
+            elif kind == 'node_down':
+                self.node_counts.pop(envelope['node'], None)
                 
-    def remove_client(self, conn, addr):
+    def close_connection(self, conn):
+        """Close a client socket and wake its handler thread blocked in recv()"""
+        try:
+            conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        conn.close()
+        
+    def remove_client(self, conn, addr, reason='closed'):
         try:
-            if conn in self.clients:
-                self.clients.pop(conn)
-            conn.close()
-            print(f" Client {addr} removed")
-            print(f" Active clients: {len(self.clients)}")
+            client = self.clients.remove(conn)
+            if client is not None:
+                self.rooms.leave_all(conn, client.get('rooms', set()))
+                self.publish_client_count()
         except Exception as e:
-            print(f" Error removing client {addr}: {e}")
+            # Still close the connection below, or its socket and writer would leak
+            log.error('remove_error', "Error unregistering client %s: %s", addr, e)
+        try:
+            outbox = self.outboxes.pop(conn, None)
+            if outbox is None:
+                return  # already removed, e.g. by a leave before the handler saw the socket close
+            outbox.close()
+            self.disconnects.inc(reason)
+            with self.closed_lock:
+                self.closed_sent_bytes += outbox.sent_bytes
+                self.closed_dropped += outbox.dropped
+            self.close_connection(conn)
+            log.info('disconnect', "Client %s removed, %d active clients", addr, len(self.clients),
+                     address=addr, reason=reason)
+        except Exception as e:
+            log.error('remove_error', "Error removing client %s: %s", addr, e)
             
     def cleanup(self):
         print("\n🔄 Shutting down server...")
         self.running = False
+        self.ai_pool.stop()
+        if self.ai_cache is not None:
+            self.ai_cache.save()
+        if self.message_log:
+            self.message_log.close()
+        if self.time_service:
+            self.time_service.stop()
+        if self.bus:
+            self.bus.close()
+        if self.metrics_server:
+            self.metrics_server.stop()
         
-        for client_conn in list(self.clients.keys()):
+        for client_conn in list(self.clients):
             try:
-                client_conn.close()
+                self.close_connection(client_conn)
             except:
                 pass
+        for outbox in list(self.outboxes.values()):
+            outbox.close()
         self.clients.clear()
+        self.outboxes.clear()
         
         if self.server_socket:
             self.server_socket.close()
@@ -295,11 +1244,256 @@ class ChatServer:
         return {
             'active_clients': len(self.clients),
             'server_time': time.time(),
-            'uptime': time.time() - getattr(self, 'start_time', time.time())
+            'uptime': time.time() - getattr(self, 'start_time', time.time()),
+            'slow_consumer_disconnects': self.slow_consumer_disconnects,
+            'outbound_queues': self.get_outbound_stats(),
+            'time_service': self.time_service.get_stats() if self.time_service else None,
+            'rooms': self.rooms.get_stats(),
+            'ai_cache': self.ai_cache.get_stats() if self.ai_cache is not None else None,
+            'ai_pool': self.ai_pool.get_stats(),
+            'ai_limits': self.ai_limiter.get_stats() if self.ai_limiter else None,
+            'ai_memory': self.conversations.get_stats() if self.conversations is not None else None,
+            'cluster': self.get_cluster_stats()
         }
+        
+    def get_cluster_stats(self):
+        if not self.bus:
+            return None
+        return {
+            'node_id': self.node_id,
+            'total_clients': self.total_clients(),
+            'other_nodes': dict(self.node_counts),
+            'bus': self.bus.get_stats()
+        }
+        
+    def get_outbound_stats(self):
+        """Per-client outbound queue depth and drop counters, worst stragglers first"""
+        stats = []
+        for conn, outbox in list(self.outboxes.items()):
+            info = self.clients.get(conn, {})
+            entry = outbox.get_stats()
+            entry['username'] = info.get('username')
+            entry['address'] = info.get('address')
+            stats.append(entry)
+        stats.sort(key=lambda entry: (entry['depth'], entry['dropped']), reverse=True)
+        return stats
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="WhatsApp-like chat server with ChatGPT integration")
+    parser.add_argument('--host', default='127.0.0.1', help="Address to listen on")
+    parser.add_argument('--port', type=int, default=50001, help="TCP port to listen on")
+    parser.add_argument('--mode', choices=['threaded', 'asyncio'], default='threaded',
+                        help="threaded: one OS thread per connection; asyncio: single event loop")
+    parser.add_argument('--backlog', type=int, default=128, help="listen() backlog for pending connections")
+    parser.add_argument('--outbound-queue-size', type=int, default=1000,
+                        help="Frames buffered per client before the slow-consumer policy applies")
+    parser.add_argument('--slow-consumer-policy', choices=OVERFLOW_POLICIES, default=DROP_OLDEST,
+                        help="drop_oldest: discard the oldest queued frame; disconnect: drop the client")
+    parser.add_argument('--codecs', nargs='+', choices=['json', 'orjson', 'msgpack'], default=None,
+                        help="Wire codecs to offer clients (default: every installed one)")
+    parser.add_argument('--history-dir', default='chat_history', help="Directory for the chat message log")
+    parser.add_argument('--no-history', action='store_true', help="Don't record chat history")
+    parser.add_argument('--history-segment-mb', type=int, default=64, help="Size at which log segments rotate")
+    parser.add_argument('--history-max-segments', type=int, default=16, help="Log segments kept on disk")
+    parser.add_argument('--history-retention-hours', type=float, default=None,
+                        help="Delete log segments older than this")
+    parser.add_argument('--history-replay', type=int, default=50,
+                        help="Recent messages sent to a client when it joins")
+    parser.add_argument('--udp-time-port', type=int, default=50002,
+                        help="UDP port answering clock sync probes (0 picks a free port)")
+    parser.add_argument('--no-udp-time', action='store_true',
+                        help="Disable the UDP time service; clients sync over TCP")
+    parser.add_argument('--metrics-port', type=int, default=50004,
+                        help="HTTP port serving Prometheus metrics at /metrics (0 picks a free port)")
+    parser.add_argument('--no-metrics', action='store_true', help="Don't serve metrics over HTTP")
+    parser.add_argument('--log-level', choices=LEVELS, default='INFO', help="Least severe log events shown")
+    parser.add_argument('--log-file', default=None,
+                        help="Also write JSON-lines logs to this file (cluster nodes add .node-<id>)")
+    parser.add_argument('--log-file-mb', type=int, default=16, help="Size at which the log file rotates")
+    parser.add_argument('--log-file-backups', type=int, default=5, help="Rotated log files kept")
+    parser.add_argument('--log-sample', type=parse_log_sample, action='append', default=[], metavar='EVENT=N',
+                        help="Log only every Nth event of this kind (default: clock_sync=%d; 1 logs all)"
+                             % DEFAULT_SAMPLE['clock_sync'])
+    parser.add_argument('--nodes', type=int, default=1,
+                        help="Run this many server processes on the port, joined by a bus broker")
+    parser.add_argument('--node-id', type=int, default=0, help="This process's id within a cluster (unique per node)")
+    parser.add_argument('--bus', default=None,
+                        help="Join a cluster through the bus broker at tcp:host:port or unix:/path")
+    parser.add_argument('--reuse-port', action='store_true',
+                        help="Share the listening port with other nodes on this host (SO_REUSEPORT)")
+    parser.add_argument('--ai-backend', choices=backend_names() + [AI_OFF], default='openai',
+                        help="openai: ChatGPT API; echo: offline rule-based replies; "
+                             "stub: offline canned replies for load testing; off: no AI in the default rooms")
+    parser.add_argument('--ai-preload', action='store_true',
+                        help="Load the AI backends right after startup instead of on their first request")
+    parser.add_argument('--ai-workers', type=int, default=4, help="Threads serving AI requests")
+    parser.add_argument('--ai-queue-size', type=int, default=100,
+                        help="Pending AI requests before new ones are rejected")
+    parser.add_argument('--ai-timeout', type=float, default=30.0, help="Seconds before an AI request is abandoned")
+    parser.add_argument('--ai-stub-latency', type=float, default=0.5,
+                        help="Artificial delay of the stub backend in seconds")
+    parser.add_argument('--ai-coalesce-ms', type=int, default=0,
+                        help="Merge a user's messages sent within this many ms into one AI request (0 disables)")
+    parser.add_argument('--ai-user-rate', type=float, default=0,
+                        help="AI requests per minute allowed for each user (0 for no limit)")
+    parser.add_argument('--ai-user-burst', type=int, default=5, help="AI requests a user may make back to back")
+    parser.add_argument('--ai-global-rate', type=float, default=0,
+                        help="AI requests per minute allowed for the whole server (0 for no limit)")
+    parser.add_argument('--ai-global-burst', type=int, default=50, help="AI requests the server may start back to back")
+    parser.add_argument('--ai-max-in-flight', type=int, default=0,
+                        help="ChatGPT API calls in progress at once (0: one per AI worker)")
+    parser.add_argument('--ai-stream', action='store_true',
+                        help="Stream AI replies to clients as ai_chunk frames while they are generated")
+    parser.add_argument('--ai-stream-interval-ms', type=int, default=50,
+                        help="Least time between two ai_chunk frames of one reply")
+    parser.add_argument('--ai-cache-size', type=int, default=1000,
+                        help="Replies kept to answer repeated prompts without the API (0 disables)")
+    parser.add_argument('--ai-cache-mb', type=int, default=16, help="Memory cap of the AI reply cache")
+    parser.add_argument('--ai-cache-ttl', type=float, default=3600.0, help="Seconds a cached AI reply stays valid")
+    parser.add_argument('--ai-cache-file', default=None,
+                        help="Keep the AI reply cache in this file across restarts (cluster nodes add .node-<id>)")
+    parser.add_argument('--ai-memory-turns', type=int, default=10,
+                        help="Recent turns of each conversation remembered for ChatGPT context (0 disables)")
+    parser.add_argument('--ai-memory-tokens', type=int, default=1000,
+                        help="Estimated token budget for the remembered context sent with a prompt")
+    parser.add_argument('--ai-memory-scope', choices=MEMORY_SCOPES, default='user',
+                        help="Remember each user's conversation per room, or one shared conversation per room")
+    parser.add_argument('--ai-memory-mb', type=int, default=8, help="Memory cap of all remembered conversations")
+    parser.add_argument('--ai-memory-idle', type=float, default=1800.0,
+                        help="Seconds after which an idle conversation is forgotten")
+    parser.add_argument('--ai-memory-summarize', action='store_true',
+                        help="Fold turns that drop out of memory into a short summary (costs extra ChatGPT calls)")
+    parser.add_argument('--room-ai', type=parse_room_ai, action='append', default=[], metavar='ROOM=BACKEND',
+                        help=f"Create a permanent room answered by {', '.join(backend_names())} or off (repeatable)")
+    return parser.parse_args(argv)
+
+def parse_room_ai(text):
+    room, _, backend = text.partition('=')
+    if not valid_room_name(room) or (backend not in BACKENDS and backend != AI_OFF):
+        raise argparse.ArgumentTypeError(f"Expected ROOM={'|'.join(backend_names() + [AI_OFF])}, got {text!r}")
+    return room, backend
+
+def parse_log_sample(text):
+    event, _, rate = text.partition('=')
+    if not event or not rate.isdigit() or int(rate) < 1:
+        raise argparse.ArgumentTypeError(f"Expected EVENT=N, got {text!r}")
+    return event, int(rate)
+
+def create_log_service(args):
+    """Console logging plus the optional rotating JSON-lines file"""
+    log_file = args.log_file
+    if log_file and args.bus:
+        log_file = f"{log_file}.node-{args.node_id}"    # one writer per file
+    return LogService(
+        level=args.log_level,
+        json_path=log_file,
+        max_bytes=args.log_file_mb * 1024 * 1024,
+        backups=args.log_file_backups,
+        sample=dict(DEFAULT_SAMPLE, **dict(args.log_sample))
+    )
+
+def create_server(args, log_service=None):
+    """Build the server engine selected on the command line"""
+    history_dir = None if args.no_history else args.history_dir
+    metrics_port = None if args.no_metrics else args.metrics_port
+    ai_cache_path = args.ai_cache_file
+    bus = None
+    if args.bus:
+        from bus import BrokerBus
+        bus = BrokerBus(args.bus)
+        if history_dir:
+            # Every node keeps its own full copy of the history
+            history_dir = os.path.join(history_dir, f"node-{args.node_id}")
+        if metrics_port:
+            metrics_port += args.node_id    # each node is scraped separately
+        if ai_cache_path:
+            ai_cache_path = f"{ai_cache_path}.node-{args.node_id}"
+    
+    options = dict(
+        host=args.host,
+        port=args.port,
+        backlog=args.backlog,
+        ai_backend=args.ai_backend,
+        ai_workers=args.ai_workers,
+        ai_queue_size=args.ai_queue_size,
+        ai_timeout=args.ai_timeout,
+        ai_stub_latency=args.ai_stub_latency,
+        ai_preload=args.ai_preload,
+        ai_coalesce_window=args.ai_coalesce_ms / 1000,
+        ai_user_rate=args.ai_user_rate / 60 if args.ai_user_rate else None,
+        ai_user_burst=args.ai_user_burst,
+        ai_global_rate=args.ai_global_rate / 60 if args.ai_global_rate else None,
+        ai_global_burst=args.ai_global_burst,
+        ai_max_in_flight=args.ai_max_in_flight or None,
+        ai_stream=args.ai_stream,
+        ai_stream_interval=args.ai_stream_interval_ms / 1000,
+        ai_cache_size=args.ai_cache_size,
+        ai_cache_bytes=args.ai_cache_mb * 1024 * 1024,
+        ai_cache_ttl=args.ai_cache_ttl,
+        ai_cache_path=ai_cache_path,
+        ai_memory_turns=args.ai_memory_turns,
+        ai_memory_tokens=args.ai_memory_tokens,
+        ai_memory_bytes=args.ai_memory_mb * 1024 * 1024,
+        ai_memory_idle=args.ai_memory_idle,
+        ai_memory_scope=args.ai_memory_scope,
+        ai_memory_summarize=args.ai_memory_summarize,
+        outbound_queue_size=args.outbound_queue_size,
+        slow_consumer_policy=args.slow_consumer_policy,
+        codecs=args.codecs,
+        history_dir=history_dir,
+        history_segment_bytes=args.history_segment_mb * 1024 * 1024,
+        history_max_segments=args.history_max_segments,
+        history_retention_seconds=args.history_retention_hours * 3600 if args.history_retention_hours else None,
+        history_replay_count=args.history_replay,
+        time_port=None if args.no_udp_time else args.udp_time_port,
+        node_id=args.node_id,
+        bus=bus,
+        reuse_port=args.reuse_port,
+        room_ai=dict(args.room_ai),
+        metrics_port=metrics_port,
+        log_service=log_service
+    )
+    if args.mode == 'asyncio':
+        from async_server import AsyncChatServer
+        return AsyncChatServer(**options)
+    return ChatServer(**options)
+
+def run_cluster(args, argv):
+    """Start a bus broker and `args.nodes` server processes sharing one port"""
+    from bus import DEFAULT_BUS_ADDRESS
+    here = os.path.dirname(os.path.abspath(__file__))
+    bus_address = args.bus or DEFAULT_BUS_ADDRESS
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))    # still stop the children below
+    processes = [subprocess.Popen([sys.executable, os.path.join(here, 'bus.py'), '--listen', bus_address])]
+    time.sleep(0.5)  # let the broker bind before nodes connect
+    
+    # Later flags win, so each child is a single node of the cluster
+    for node_id in range(args.nodes):
+        processes.append(subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__)] + argv +
+            ['--nodes', '1', '--node-id', str(node_id), '--bus', bus_address, '--reuse-port']
+        ))
+    print(f" Cluster of {args.nodes} nodes on {args.host}:{args.port}, bus {bus_address}")
+    try:
+        for process in processes[1:]:
+            process.wait()
+    except KeyboardInterrupt:
+        print("\n Cluster interrupted by user")
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+        for process in processes:
+            process.wait()
 
 if __name__ == "__main__":
-    server = ChatServer()
+    args = parse_args()
+    if args.nodes > 1:
+        run_cluster(args, sys.argv[1:])
+        sys.exit(0)
+    
+    log_service = create_log_service(args)
+    log_service.start()
+    server = create_server(args, log_service)
     server.start_time = time.time()
     
     try:
@@ -310,3 +1504,4 @@ if __name__ == "__main__":
         print(f" Unexpected error: {e}")
     finally:
         server.cleanup()
+        log_service.stop()
@@ -0,0 +1,144 @@
+"""
+UDP time service for clock synchronization
+
+clock_sync over the chat TCP stream can wait behind a big broadcast or
+other frames from the same connection, which inflates the measured round
+trip. TimeService answers timestamp probes on a UDP port from its own
+thread, away from the chat connections, and replies the moment a probe
+arrives.
+
+Probes and replies are the same fixed 28-byte packet:
+
+    magic:4s  t1:f64  t2:f64  t3:f64
+
+The client fills in t1 (its send time) and zeroes the rest. The server
+fills in t2 (receive) and t3 (transmit) and sends the packet back in
+place. A reply is never larger than its probe, so the port can't be used
+to amplify traffic.
+
+TimeClient sends one probe at a time and turns each reply into a
+clock_sync_response message for ClockSync. Clients learn the port from
+`time_port` in join_success and fall back to TCP clock_sync when no
+replies come back.
+"""
+
+import socket
+import struct
+import threading
+import time
+
+MAGIC = b'CTS1'
+TIME_PACKET = struct.Struct('!4sddd')
+SERVER_STAMPS = struct.Struct('!dd')        # t2, t3 written in place after magic and t1
+SERVER_STAMPS_AT = 4 + 8
+
+
+class TimeService:
+    """Answers UDP timestamp probes on a dedicated thread"""
+
+    def __init__(self, host, port, reuse_port=False):
+        self.host = host
+        self.port = port
+        self.reuse_port = reuse_port    # every node of a cluster answers on the same port
+        self.sock = None
+        self.thread = None
+        self.running = False
+        self.served = 0
+        self.invalid = 0
+
+    def start(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1024 * 1024)
+        self.sock.bind((self.host, self.port))
+        self.port = self.sock.getsockname()[1]
+        self.sock.settimeout(0.5)   # lets stop() be noticed
+        self.running = True
+        self.thread = threading.Thread(target=self._serve, name="udp-time-service", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join(timeout=1.0)
+        if self.sock is not None:
+            self.sock.close()
+
+    def _serve(self):
+        # Hot loop: one preallocated buffer, locals instead of attribute lookups
+        packet = bytearray(TIME_PACKET.size)
+        recv_into = self.sock.recvfrom_into
+        sendto = self.sock.sendto
+        stamp = SERVER_STAMPS.pack_into
+        now = time.time
+        size = TIME_PACKET.size
+        served = 0
+        while self.running:
+            try:
+                length, addr = recv_into(packet)
+            except socket.timeout:
+                self.served = served
+                continue
+            except OSError:
+                break
+            received_at = now()
+            if length != size or packet[:4] != MAGIC:
+                self.invalid += 1
+                continue
+            stamp(packet, SERVER_STAMPS_AT, received_at, now())
+            try:
+                sendto(packet, addr)
+            except OSError:
+                continue
+            served += 1
+            if not served & 0xfff:
+                self.served = served
+        self.served = served
+
+    def get_stats(self):
+        return {'port': self.port, 'served': self.served, 'invalid': self.invalid}
+
+
+class TimeClient:
+    """Blocking prober for a TimeService"""
+
+    def __init__(self, host, port, timeout=0.25):
+        self.timeout = timeout
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.connect((host, port))
+
+    def probe(self):
+        """Send one probe; return (clock_sync_response dict, receive time) or None on timeout"""
+        t1 = time.time()
+        self.sock.send(TIME_PACKET.pack(MAGIC, t1, 0.0, 0.0))
+        deadline = t1 + self.timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+            self.sock.settimeout(remaining)
+            try:
+                data = self.sock.recv(TIME_PACKET.size + 1)
+            except socket.timeout:
+                return None
+            except OSError:
+                return None     # e.g. ICMP port unreachable: no service there
+            received_at = time.time()
+            if len(data) != TIME_PACKET.size:
+                continue
+            magic, echo, t2, t3 = TIME_PACKET.unpack(data)
+            if magic != MAGIC or echo != t1:
+                continue        # late reply to an earlier probe
+            return {
+                'type': 'clock_sync_response',
+                'client_request_time': t1,
+                'server_receive_time': t2,
+                'server_time': t3,
+                'processing_time': t3 - t2,
+                'transport': 'udp'
+            }, received_at
+
+    def close(self):
+        self.sock.close()